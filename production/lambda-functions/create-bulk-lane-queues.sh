@@ -0,0 +1,57 @@
+#!/bin/bash
+
+# Create bulk-lane FIFO queues for the ASR/SED/SER workers.
+# Backfill uploads (camera roll, imports, wearable sync) are routed here by
+# watchme-audio-processor so they never delay interactive recordings.
+# Workers defer bulk messages while the interactive queue has a backlog by parking them in
+# the defer queues (create-defer-queues.sh), which does not count as a receive, so
+# maxReceiveCount only counts real failures (same as the fast lane).
+
+set -e
+
+REGION="ap-southeast-2"
+ACCOUNT_ID="754724220380"
+BULK_MAX_RECEIVE_COUNT="${BULK_MAX_RECEIVE_COUNT:-5}"
+
+create_fifo_with_dlq() {
+  local name="$1"
+  local dlq_name="$2"
+
+  local dlq_arn="arn:aws:sqs:${REGION}:${ACCOUNT_ID}:${dlq_name}"
+
+  echo "Creating ${dlq_name}..."
+  aws sqs create-queue \
+    --queue-name "${dlq_name}" \
+    --region "${REGION}" \
+    --attributes '{
+      "FifoQueue": "true",
+      "ContentBasedDeduplication": "false",
+      "MessageRetentionPeriod": "1209600"
+    }' >/dev/null || echo "DLQ already exists"
+
+  echo "Creating ${name}..."
+  aws sqs create-queue \
+    --queue-name "${name}" \
+    --region "${REGION}" \
+    --attributes "{
+      \"FifoQueue\": \"true\",
+      \"ContentBasedDeduplication\": \"false\",
+      \"MessageRetentionPeriod\": \"1209600\",
+      \"VisibilityTimeout\": \"360\",
+      \"ReceiveMessageWaitTimeSeconds\": \"20\",
+      \"RedrivePolicy\": \"{\\\"deadLetterTargetArn\\\":\\\"${dlq_arn}\\\",\\\"maxReceiveCount\\\":${BULK_MAX_RECEIVE_COUNT}}\"
+    }" >/dev/null || echo "Queue already exists"
+
+  echo "Queue URL:"
+  aws sqs get-queue-url --queue-name "${name}" --region "${REGION}" --query 'QueueUrl' --output text
+  aws sqs get-queue-url --queue-name "${dlq_name}" --region "${REGION}" --query 'QueueUrl' --output text
+  echo ""
+}
+
+echo "🚀 Creating bulk-lane queues (ASR/SED/SER)..."
+
+create_fifo_with_dlq "watchme-asr-bulk-queue-v2.fifo" "watchme-asr-bulk-dlq-v2.fifo"
+create_fifo_with_dlq "watchme-sed-bulk-queue-v2.fifo" "watchme-sed-bulk-dlq-v2.fifo"
+create_fifo_with_dlq "watchme-ser-bulk-queue-v2.fifo" "watchme-ser-bulk-dlq-v2.fifo"
+
+echo "✅ Bulk-lane queue creation completed"
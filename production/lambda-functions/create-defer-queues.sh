@@ -0,0 +1,54 @@
+#!/bin/bash
+
+# Create the defer queues for the ASR/SED/SER workers.
+# Workers park deferred messages (bulk lane behind interactive work, admission backpressure,
+# open circuit breaker) here with DelaySeconds instead of ChangeMessageVisibility, and re-send
+# them to their FIFO queue when the delay is up. A deferral therefore no longer counts as a
+# receive on the FIFO queues, whose maxReceiveCount stays low for real failures
+# (update-interactive-queue-redrive.sh).
+# Standard queues: FIFO queues do not support per-message DelaySeconds.
+
+set -e
+
+REGION="ap-southeast-2"
+ACCOUNT_ID="754724220380"
+DEFER_MAX_RECEIVE_COUNT="${DEFER_MAX_RECEIVE_COUNT:-5}"
+
+create_standard_with_dlq() {
+  local name="$1"
+  local dlq_name="$2"
+
+  local dlq_arn="arn:aws:sqs:${REGION}:${ACCOUNT_ID}:${dlq_name}"
+
+  echo "Creating ${dlq_name}..."
+  aws sqs create-queue \
+    --queue-name "${dlq_name}" \
+    --region "${REGION}" \
+    --attributes '{
+      "MessageRetentionPeriod": "1209600"
+    }' >/dev/null || echo "DLQ already exists"
+
+  echo "Creating ${name}..."
+  aws sqs create-queue \
+    --queue-name "${name}" \
+    --region "${REGION}" \
+    --attributes "{
+      \"MessageRetentionPeriod\": \"1209600\",
+      \"VisibilityTimeout\": \"360\",
+      \"ReceiveMessageWaitTimeSeconds\": \"20\",
+      \"RedrivePolicy\": \"{\\\"deadLetterTargetArn\\\":\\\"${dlq_arn}\\\",\\\"maxReceiveCount\\\":${DEFER_MAX_RECEIVE_COUNT}}\"
+    }" >/dev/null || echo "Queue already exists"
+
+  echo "Queue URL:"
+  aws sqs get-queue-url --queue-name "${name}" --region "${REGION}" --query 'QueueUrl' --output text
+  aws sqs get-queue-url --queue-name "${dlq_name}" --region "${REGION}" --query 'QueueUrl' --output text
+  echo ""
+}
+
+echo "🚀 Creating defer queues (ASR/SED/SER)..."
+
+create_standard_with_dlq "watchme-asr-defer-queue" "watchme-asr-defer-dlq"
+create_standard_with_dlq "watchme-sed-defer-queue" "watchme-sed-defer-dlq"
+create_standard_with_dlq "watchme-ser-defer-queue" "watchme-ser-defer-dlq"
+
+echo "✅ Defer queue creation completed"
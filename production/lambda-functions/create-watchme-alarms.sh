@@ -11,6 +11,12 @@ DLQ_QUEUES=(
     "watchme-asr-dlq-v2.fifo"
     "watchme-sed-dlq-v2.fifo"
     "watchme-ser-dlq-v2.fifo"
+    "watchme-asr-bulk-dlq-v2.fifo"
+    "watchme-sed-bulk-dlq-v2.fifo"
+    "watchme-ser-bulk-dlq-v2.fifo"
+    "watchme-asr-defer-dlq"
+    "watchme-sed-defer-dlq"
+    "watchme-ser-defer-dlq"
     "watchme-spot-analysis-dlq.fifo"
     "watchme-dashboard-summary-dlq"
     "watchme-dashboard-analysis-dlq"
@@ -25,6 +31,14 @@ SOURCE_QUEUES=(
     "watchme-dashboard-analysis-queue"
 )
 
+# Interactive lanes carry user-facing latency; alarm well before the generic 5 minute age alarm
+INTERACTIVE_QUEUES=(
+    "watchme-asr-queue-v2.fifo"
+    "watchme-sed-queue-v2.fifo"
+    "watchme-ser-queue-v2.fifo"
+)
+INTERACTIVE_AGE_THRESHOLD_SECONDS="${INTERACTIVE_AGE_THRESHOLD_SECONDS:-60}"
+
 LAMBDA_FUNCTIONS=(
     "watchme-audio-processor"
     "watchme-asr-worker"
@@ -96,6 +110,21 @@ for queue in "${SOURCE_QUEUES[@]}"; do
         --dimensions "Name=QueueName,Value=${queue}"
 done
 
+for queue in "${INTERACTIVE_QUEUES[@]}"; do
+    echo "Configuring interactive latency alarm for ${queue}..."
+    put_alarm \
+        --alarm-name "${queue}-interactive-latency" \
+        --alarm-description "Interactive lane ${queue} has messages older than ${INTERACTIVE_AGE_THRESHOLD_SECONDS} seconds" \
+        --metric-name ApproximateAgeOfOldestMessage \
+        --namespace AWS/SQS \
+        --statistic Maximum \
+        --period 60 \
+        --evaluation-periods 3 \
+        --threshold "${INTERACTIVE_AGE_THRESHOLD_SECONDS}" \
+        --comparison-operator GreaterThanThreshold \
+        --dimensions "Name=QueueName,Value=${queue}"
+done
+
 for function_name in "${LAMBDA_FUNCTIONS[@]}"; do
     echo "Configuring Lambda error alarm for ${function_name}..."
     put_alarm \
@@ -62,6 +62,7 @@ aws lambda create-event-source-mapping \
     --function-name watchme-dashboard-summary-worker \
     --event-source-arn arn:aws:sqs:${REGION}:${ACCOUNT_ID}:watchme-dashboard-summary-queue \
     --batch-size 1 \
+    --function-response-types ReportBatchItemFailures \
     --region $REGION || echo "Event source mapping may already exist"
 
 cd ..
@@ -108,6 +109,7 @@ aws lambda create-event-source-mapping \
     --function-name watchme-dashboard-analysis-worker \
     --event-source-arn arn:aws:sqs:${REGION}:${ACCOUNT_ID}:watchme-dashboard-analysis-queue \
     --batch-size 1 \
+    --function-response-types ReportBatchItemFailures \
     --region $REGION || echo "Event source mapping may already exist"
 
 cd ..
@@ -13,6 +13,23 @@ WORKER_CONNECT_TIMEOUT="${WORKER_CONNECT_TIMEOUT:-3}"
 WORKER_READ_TIMEOUT="${WORKER_READ_TIMEOUT:-10}"
 WORKER_API_HOST_HEADER="${WORKER_API_HOST_HEADER:-api.hey-watch.me}"
 WORKER_VERIFY_TLS="${WORKER_VERIFY_TLS:-false}"
+WORKER_BULK_DEFER_SECONDS="${WORKER_BULK_DEFER_SECONDS:-60}"
+WORKER_BULK_MAX_DEFER_SECONDS="${WORKER_BULK_MAX_DEFER_SECONDS:-900}"
+# "local" (per container) until feature_api_controller exists, then "supabase" (see docs/DEPLOYMENT_RUNBOOK.md)
+WORKER_CONTROLLER_BACKEND="${WORKER_CONTROLLER_BACKEND:-local}"
+# Reserved concurrency = sum of the worker's event source mapping MaximumConcurrency
+# (setup-sqs-triggers.sh: interactive + bulk 2 + defer 2), so no mapping is throttled;
+# a throttled batch goes back to the queue and counts as a receive.
+# In-flight EC2 requests per stage = dispatching invocations x MAX_CONCURRENCY. Defer-queue
+# invocations never dispatch, and bulk waits while the interactive queue has messages
+# waiting or in flight, so one lane (2 invocations for SED/SER) dispatches at a time.
+# SED/SER must stay at or below 2 (EC2 CPU limit, see docs/SCALABILITY_ROADMAP.md)
+ASR_WORKER_MAX_CONCURRENCY="${ASR_WORKER_MAX_CONCURRENCY:-5}"
+ASR_WORKER_RESERVED_CONCURRENCY="${ASR_WORKER_RESERVED_CONCURRENCY:-10}"
+SED_WORKER_MAX_CONCURRENCY="${SED_WORKER_MAX_CONCURRENCY:-1}"
+SED_WORKER_RESERVED_CONCURRENCY="${SED_WORKER_RESERVED_CONCURRENCY:-6}"
+SER_WORKER_MAX_CONCURRENCY="${SER_WORKER_MAX_CONCURRENCY:-1}"
+SER_WORKER_RESERVED_CONCURRENCY="${SER_WORKER_RESERVED_CONCURRENCY:-6}"
 ASR_WORKER_API_ENDPOINT_URL="${ASR_WORKER_API_ENDPOINT_URL:-https://3.24.16.82/vibe-analysis/transcriber/async-process}"
 SED_WORKER_API_ENDPOINT_URL="${SED_WORKER_API_ENDPOINT_URL:-https://3.24.16.82/behavior-analysis/features/async-process}"
 SER_WORKER_API_ENDPOINT_URL="${SER_WORKER_API_ENDPOINT_URL:-https://3.24.16.82/emotion-analysis/feature-extractor/async-process}"
@@ -36,6 +53,9 @@ build_environment_string() {
         "ASR_QUEUE_URL='https://sqs.ap-southeast-2.amazonaws.com/${ACCOUNT_ID}/watchme-asr-queue-v2.fifo'"
         "SED_QUEUE_URL='https://sqs.ap-southeast-2.amazonaws.com/${ACCOUNT_ID}/watchme-sed-queue-v2.fifo'"
         "SER_QUEUE_URL='https://sqs.ap-southeast-2.amazonaws.com/${ACCOUNT_ID}/watchme-ser-queue-v2.fifo'"
+        "ASR_BULK_QUEUE_URL='https://sqs.ap-southeast-2.amazonaws.com/${ACCOUNT_ID}/watchme-asr-bulk-queue-v2.fifo'"
+        "SED_BULK_QUEUE_URL='https://sqs.ap-southeast-2.amazonaws.com/${ACCOUNT_ID}/watchme-sed-bulk-queue-v2.fifo'"
+        "SER_BULK_QUEUE_URL='https://sqs.ap-southeast-2.amazonaws.com/${ACCOUNT_ID}/watchme-ser-bulk-queue-v2.fifo'"
         "FEATURE_COMPLETED_QUEUE_URL='https://sqs.ap-southeast-2.amazonaws.com/${ACCOUNT_ID}/watchme-feature-completed-queue'"
         "SPOT_ANALYSIS_QUEUE_URL='https://sqs.ap-southeast-2.amazonaws.com/${ACCOUNT_ID}/watchme-spot-analysis-queue.fifo'"
         "DASHBOARD_SUMMARY_QUEUE_URL='https://sqs.ap-southeast-2.amazonaws.com/${ACCOUNT_ID}/watchme-dashboard-summary-queue'"
@@ -46,7 +66,14 @@ build_environment_string() {
     case "${function_name}" in
         watchme-asr-worker)
             env_vars+=(
+                "STAGE='asr'"
+                "MAX_CONCURRENCY='${ASR_WORKER_MAX_CONCURRENCY}'"
                 "API_ENDPOINT_URL='${ASR_WORKER_API_ENDPOINT_URL}'"
+                "INTERACTIVE_QUEUE_URL='https://sqs.ap-southeast-2.amazonaws.com/${ACCOUNT_ID}/watchme-asr-queue-v2.fifo'"
+                "DEFER_QUEUE_URL='https://sqs.ap-southeast-2.amazonaws.com/${ACCOUNT_ID}/watchme-asr-defer-queue'"
+                "BULK_DEFER_SECONDS='${WORKER_BULK_DEFER_SECONDS}'"
+                "BULK_MAX_DEFER_SECONDS='${WORKER_BULK_MAX_DEFER_SECONDS}'"
+                "CONTROLLER_BACKEND='${WORKER_CONTROLLER_BACKEND}'"
                 "API_HOST_HEADER='${WORKER_API_HOST_HEADER}'"
                 "VERIFY_TLS='${WORKER_VERIFY_TLS}'"
                 "REQUEST_CONNECT_TIMEOUT='${WORKER_CONNECT_TIMEOUT}'"
@@ -55,7 +82,14 @@ build_environment_string() {
             ;;
         watchme-sed-worker)
             env_vars+=(
+                "STAGE='sed'"
+                "MAX_CONCURRENCY='${SED_WORKER_MAX_CONCURRENCY}'"
                 "API_ENDPOINT_URL='${SED_WORKER_API_ENDPOINT_URL}'"
+                "INTERACTIVE_QUEUE_URL='https://sqs.ap-southeast-2.amazonaws.com/${ACCOUNT_ID}/watchme-sed-queue-v2.fifo'"
+                "DEFER_QUEUE_URL='https://sqs.ap-southeast-2.amazonaws.com/${ACCOUNT_ID}/watchme-sed-defer-queue'"
+                "BULK_DEFER_SECONDS='${WORKER_BULK_DEFER_SECONDS}'"
+                "BULK_MAX_DEFER_SECONDS='${WORKER_BULK_MAX_DEFER_SECONDS}'"
+                "CONTROLLER_BACKEND='${WORKER_CONTROLLER_BACKEND}'"
                 "API_HOST_HEADER='${WORKER_API_HOST_HEADER}'"
                 "VERIFY_TLS='${WORKER_VERIFY_TLS}'"
                 "REQUEST_CONNECT_TIMEOUT='${WORKER_CONNECT_TIMEOUT}'"
@@ -64,7 +98,14 @@ build_environment_string() {
             ;;
         watchme-ser-worker)
             env_vars+=(
+                "STAGE='ser'"
+                "MAX_CONCURRENCY='${SER_WORKER_MAX_CONCURRENCY}'"
                 "API_ENDPOINT_URL='${SER_WORKER_API_ENDPOINT_URL}'"
+                "INTERACTIVE_QUEUE_URL='https://sqs.ap-southeast-2.amazonaws.com/${ACCOUNT_ID}/watchme-ser-queue-v2.fifo'"
+                "DEFER_QUEUE_URL='https://sqs.ap-southeast-2.amazonaws.com/${ACCOUNT_ID}/watchme-ser-defer-queue'"
+                "BULK_DEFER_SECONDS='${WORKER_BULK_DEFER_SECONDS}'"
+                "BULK_MAX_DEFER_SECONDS='${WORKER_BULK_MAX_DEFER_SECONDS}'"
+                "CONTROLLER_BACKEND='${WORKER_CONTROLLER_BACKEND}'"
                 "API_HOST_HEADER='${WORKER_API_HOST_HEADER}'"
                 "VERIFY_TLS='${WORKER_VERIFY_TLS}'"
                 "REQUEST_CONNECT_TIMEOUT='${WORKER_CONNECT_TIMEOUT}'"
@@ -80,11 +121,13 @@ build_environment_string() {
 }
 
 # Function to create/update Lambda function
+# SOURCE_DIR defaults to the function name (ASR/SED/SER share watchme-feature-worker)
 deploy_lambda() {
     local FUNCTION_NAME=$1
     local HANDLER=$2
     local TIMEOUT=$3
     local MEMORY=$4
+    local SOURCE_DIR=${5:-$1}
     local ENVIRONMENT
 
     ENVIRONMENT=$(build_environment_string "${FUNCTION_NAME}")
@@ -92,7 +135,7 @@ deploy_lambda() {
     echo ""
     echo "📦 Deploying ${FUNCTION_NAME}..."
 
-    cd /Users/kaya.matsumoto/projects/watchme/server-configs/production/lambda-functions/${FUNCTION_NAME}
+    cd /Users/kaya.matsumoto/projects/watchme/server-configs/production/lambda-functions/${SOURCE_DIR}
 
     # Create deployment package
     rm -rf package function.zip
@@ -147,18 +190,30 @@ deploy_lambda() {
 }
 
 # Deploy each Lambda function
-# Function name, Handler, Timeout (seconds), Memory (MB)
+# Function name, Handler, Timeout (seconds), Memory (MB)[, Source directory]
 
 echo "1️⃣ Deploying ASR Worker..."
-deploy_lambda "watchme-asr-worker" "lambda_function.lambda_handler" 60 256
+deploy_lambda "watchme-asr-worker" "lambda_function.lambda_handler" 60 256 "watchme-feature-worker"
+aws lambda put-function-concurrency \
+    --function-name watchme-asr-worker \
+    --reserved-concurrent-executions ${ASR_WORKER_RESERVED_CONCURRENCY} \
+    --region ${REGION}
 
 echo ""
 echo "2️⃣ Deploying SED Worker..."
-deploy_lambda "watchme-sed-worker" "lambda_function.lambda_handler" 60 256
+deploy_lambda "watchme-sed-worker" "lambda_function.lambda_handler" 60 256 "watchme-feature-worker"
+aws lambda put-function-concurrency \
+    --function-name watchme-sed-worker \
+    --reserved-concurrent-executions ${SED_WORKER_RESERVED_CONCURRENCY} \
+    --region ${REGION}
 
 echo ""
 echo "3️⃣ Deploying SER Worker..."
-deploy_lambda "watchme-ser-worker" "lambda_function.lambda_handler" 60 256
+deploy_lambda "watchme-ser-worker" "lambda_function.lambda_handler" 60 256 "watchme-feature-worker"
+aws lambda put-function-concurrency \
+    --function-name watchme-ser-worker \
+    --reserved-concurrent-executions ${SER_WORKER_RESERVED_CONCURRENCY} \
+    --region ${REGION}
 
 echo ""
 echo "4️⃣ Deploying Aggregator Checker..."
@@ -181,7 +236,7 @@ echo "  SED: ${SED_WORKER_API_ENDPOINT_URL}"
 echo "  SER: ${SER_WORKER_API_ENDPOINT_URL}"
 echo ""
 echo "Next steps:"
-echo "1. Create feature job FIFO queues (create-feature-job-queues.sh)"
+echo "1. Create feature job FIFO queues (create-feature-job-queues.sh, create-bulk-lane-queues.sh)"
 echo "2. Create the spot analysis FIFO queue"
 echo "3. Configure SQS triggers for each Lambda function"
 echo "4. Configure the EventBridge reconciliation schedule"
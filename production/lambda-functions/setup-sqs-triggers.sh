@@ -5,6 +5,28 @@ set -e
 
 REGION="ap-southeast-2"
 ACCOUNT_ID="754724220380"
+# ASR/SED/SER workers dispatch a batch concurrently (per-stage max_concurrency)
+# Worst case at SED/SER concurrency 1: batch x (3s connect + 10s read) must fit the 60s timeout
+FEATURE_BATCH_SIZE="${FEATURE_BATCH_SIZE:-4}"
+# MaximumConcurrency per mapping (interactive + bulk + defer) must add up to the worker's
+# reserved concurrency in deploy-new-lambdas.sh: ASR 6 + 2 + 2 = 10, SED/SER 2 + 2 + 2 = 6
+BULK_MAX_CONCURRENCY="${BULK_MAX_CONCURRENCY:-2}"
+DEFER_MAX_CONCURRENCY="${DEFER_MAX_CONCURRENCY:-2}"
+ASR_INTERACTIVE_MAX_CONCURRENCY="${ASR_INTERACTIVE_MAX_CONCURRENCY:-6}"
+SED_INTERACTIVE_MAX_CONCURRENCY="${SED_INTERACTIVE_MAX_CONCURRENCY:-2}"
+SER_INTERACTIVE_MAX_CONCURRENCY="${SER_INTERACTIVE_MAX_CONCURRENCY:-2}"
+
+interactive_max_concurrency() {
+  case "$1" in
+    asr) echo "${ASR_INTERACTIVE_MAX_CONCURRENCY}" ;;
+    sed) echo "${SED_INTERACTIVE_MAX_CONCURRENCY}" ;;
+    ser) echo "${SER_INTERACTIVE_MAX_CONCURRENCY}" ;;
+  esac
+}
+# Aggregator checker coalesces the three completion notifications of a recording when
+# they arrive in one batch; the batching window gives them time to land together
+CHECKER_BATCH_SIZE="${CHECKER_BATCH_SIZE:-10}"
+CHECKER_BATCHING_WINDOW_SECONDS="${CHECKER_BATCHING_WINDOW_SECONDS:-5}"
 
 echo "🔗 Setting up SQS triggers for Lambda functions..."
 
@@ -13,8 +35,10 @@ echo "Setting up watchme-asr-worker trigger..."
 aws lambda create-event-source-mapping \
   --function-name watchme-asr-worker \
   --event-source-arn arn:aws:sqs:${REGION}:${ACCOUNT_ID}:watchme-asr-queue-v2.fifo \
-  --batch-size 1 \
+  --batch-size ${FEATURE_BATCH_SIZE} \
   --maximum-batching-window-in-seconds 0 \
+  --function-response-types ReportBatchItemFailures \
+  --scaling-config MaximumConcurrency=${ASR_INTERACTIVE_MAX_CONCURRENCY} \
   --region ${REGION} 2>/dev/null || echo "Trigger already exists"
 
 # 2. SED Worker - triggered by SED queue
@@ -22,8 +46,10 @@ echo "Setting up watchme-sed-worker trigger..."
 aws lambda create-event-source-mapping \
   --function-name watchme-sed-worker \
   --event-source-arn arn:aws:sqs:${REGION}:${ACCOUNT_ID}:watchme-sed-queue-v2.fifo \
-  --batch-size 1 \
+  --batch-size ${FEATURE_BATCH_SIZE} \
   --maximum-batching-window-in-seconds 0 \
+  --function-response-types ReportBatchItemFailures \
+  --scaling-config MaximumConcurrency=${SED_INTERACTIVE_MAX_CONCURRENCY} \
   --region ${REGION} 2>/dev/null || echo "Trigger already exists"
 
 # 3. SER Worker - triggered by SER queue
@@ -31,28 +57,134 @@ echo "Setting up watchme-ser-worker trigger..."
 aws lambda create-event-source-mapping \
   --function-name watchme-ser-worker \
   --event-source-arn arn:aws:sqs:${REGION}:${ACCOUNT_ID}:watchme-ser-queue-v2.fifo \
-  --batch-size 1 \
+  --batch-size ${FEATURE_BATCH_SIZE} \
   --maximum-batching-window-in-seconds 0 \
+  --function-response-types ReportBatchItemFailures \
+  --scaling-config MaximumConcurrency=${SER_INTERACTIVE_MAX_CONCURRENCY} \
   --region ${REGION} 2>/dev/null || echo "Trigger already exists"
 
+# 3b. Bulk lanes - same workers, capped concurrency so backfill never starves interactive work
+#     ReportBatchItemFailures is required: workers hand deferred bulk messages back individually
+for stage in asr sed ser; do
+  echo "Setting up watchme-${stage}-worker bulk-lane trigger..."
+  aws lambda create-event-source-mapping \
+    --function-name watchme-${stage}-worker \
+    --event-source-arn arn:aws:sqs:${REGION}:${ACCOUNT_ID}:watchme-${stage}-bulk-queue-v2.fifo \
+    --batch-size 1 \
+    --maximum-batching-window-in-seconds 0 \
+    --function-response-types ReportBatchItemFailures \
+    --scaling-config MaximumConcurrency=${BULK_MAX_CONCURRENCY} \
+    --region ${REGION} 2>/dev/null || echo "Trigger already exists"
+done
+
+# 3b'. Defer queues (create-defer-queues.sh) - deferred messages are re-sent from here to their FIFO queue
+#      ReportBatchItemFailures is required: runs that could not be re-sent stay in the defer queue
+for stage in asr sed ser; do
+  echo "Setting up watchme-${stage}-worker defer-queue trigger..."
+  aws lambda create-event-source-mapping \
+    --function-name watchme-${stage}-worker \
+    --event-source-arn arn:aws:sqs:${REGION}:${ACCOUNT_ID}:watchme-${stage}-defer-queue \
+    --batch-size 10 \
+    --maximum-batching-window-in-seconds 0 \
+    --function-response-types ReportBatchItemFailures \
+    --scaling-config MaximumConcurrency=${DEFER_MAX_CONCURRENCY} \
+    --region ${REGION} 2>/dev/null || echo "Trigger already exists"
+done
+
+# 3c. Existing ASR/SED/SER mappings: workers return batchItemFailures, so enable partial batch responses
+for stage in asr sed ser; do
+  for uuid in $(aws lambda list-event-source-mappings \
+    --function-name watchme-${stage}-worker \
+    --region ${REGION} \
+    --query "EventSourceMappings[?FunctionResponseTypes==\`[]\` || !FunctionResponseTypes].UUID" \
+    --output text); do
+    echo "Enabling ReportBatchItemFailures on watchme-${stage}-worker mapping ${uuid}..."
+    aws lambda update-event-source-mapping \
+      --uuid ${uuid} \
+      --function-response-types ReportBatchItemFailures \
+      --region ${REGION} >/dev/null
+  done
+
+  for uuid in $(aws lambda list-event-source-mappings \
+    --function-name watchme-${stage}-worker \
+    --event-source-arn arn:aws:sqs:${REGION}:${ACCOUNT_ID}:watchme-${stage}-queue-v2.fifo \
+    --region ${REGION} \
+    --query "EventSourceMappings[].UUID" \
+    --output text); do
+    echo "Setting batch size ${FEATURE_BATCH_SIZE} and MaximumConcurrency $(interactive_max_concurrency ${stage}) on watchme-${stage}-worker mapping ${uuid}..."
+    aws lambda update-event-source-mapping \
+      --uuid ${uuid} \
+      --batch-size ${FEATURE_BATCH_SIZE} \
+      --scaling-config MaximumConcurrency=$(interactive_max_concurrency ${stage}) \
+      --region ${REGION} >/dev/null
+  done
+
+  for uuid in $(aws lambda list-event-source-mappings \
+    --function-name watchme-${stage}-worker \
+    --event-source-arn arn:aws:sqs:${REGION}:${ACCOUNT_ID}:watchme-${stage}-bulk-queue-v2.fifo \
+    --region ${REGION} \
+    --query "EventSourceMappings[].UUID" \
+    --output text); do
+    echo "Setting MaximumConcurrency ${BULK_MAX_CONCURRENCY} on watchme-${stage}-worker bulk mapping ${uuid}..."
+    aws lambda update-event-source-mapping \
+      --uuid ${uuid} \
+      --scaling-config MaximumConcurrency=${BULK_MAX_CONCURRENCY} \
+      --region ${REGION} >/dev/null
+  done
+done
+
 # 4. Aggregator Checker - triggered by feature-completed queue
+#    ReportBatchItemFailures is required: only the notifications of a failed recording are retried
 echo "Setting up watchme-aggregator-checker trigger..."
 aws lambda create-event-source-mapping \
   --function-name watchme-aggregator-checker \
   --event-source-arn arn:aws:sqs:${REGION}:${ACCOUNT_ID}:watchme-feature-completed-queue \
-  --batch-size 1 \
-  --maximum-batching-window-in-seconds 0 \
+  --batch-size ${CHECKER_BATCH_SIZE} \
+  --maximum-batching-window-in-seconds ${CHECKER_BATCHING_WINDOW_SECONDS} \
+  --function-response-types ReportBatchItemFailures \
   --region ${REGION} 2>/dev/null || echo "Trigger already exists"
 
+for uuid in $(aws lambda list-event-source-mappings \
+  --function-name watchme-aggregator-checker \
+  --event-source-arn arn:aws:sqs:${REGION}:${ACCOUNT_ID}:watchme-feature-completed-queue \
+  --region ${REGION} \
+  --query "EventSourceMappings[].UUID" \
+  --output text); do
+  echo "Setting batch size ${CHECKER_BATCH_SIZE} on watchme-aggregator-checker mapping ${uuid}..."
+  aws lambda update-event-source-mapping \
+    --uuid ${uuid} \
+    --batch-size ${CHECKER_BATCH_SIZE} \
+    --maximum-batching-window-in-seconds ${CHECKER_BATCHING_WINDOW_SECONDS} \
+    --function-response-types ReportBatchItemFailures \
+    --region ${REGION} >/dev/null
+done
+
 # 5. Spot Analysis Worker - triggered by spot analysis FIFO queue
+#    ReportBatchItemFailures is required: the worker hands messages back before the Lambda deadline
 echo "Setting up watchme-spot-analysis-worker trigger..."
 aws lambda create-event-source-mapping \
   --function-name watchme-spot-analysis-worker \
   --event-source-arn arn:aws:sqs:${REGION}:${ACCOUNT_ID}:watchme-spot-analysis-queue.fifo \
   --batch-size 1 \
   --maximum-batching-window-in-seconds 0 \
+  --function-response-types ReportBatchItemFailures \
   --region ${REGION} 2>/dev/null || echo "Trigger already exists"
 
+# 5b. Existing mappings of the deadline-aware workers: enable partial batch responses
+for function in watchme-spot-analysis-worker watchme-dashboard-summary-worker watchme-dashboard-analysis-worker; do
+  for uuid in $(aws lambda list-event-source-mappings \
+    --function-name ${function} \
+    --region ${REGION} \
+    --query "EventSourceMappings[?FunctionResponseTypes==\`[]\` || !FunctionResponseTypes].UUID" \
+    --output text); do
+    echo "Enabling ReportBatchItemFailures on ${function} mapping ${uuid}..."
+    aws lambda update-event-source-mapping \
+      --uuid ${uuid} \
+      --function-response-types ReportBatchItemFailures \
+      --region ${REGION} >/dev/null
+  done
+done
+
 echo ""
 echo "✅ All SQS triggers configured!"
 echo ""
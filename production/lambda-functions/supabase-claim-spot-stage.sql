@@ -0,0 +1,124 @@
+-- claim_spot_stage: conditional status transition of a spot pipeline stage in one
+-- round trip (POST /rest/v1/rpc/claim_spot_stage).
+-- Used by watchme-aggregator-checker (profiler -> queued) and
+-- watchme-spot-analysis-worker (aggregator / profiler -> processing).
+--
+--   p_stage          'aggregator' (spot_aggregators.aggregator_status)
+--                    or 'profiler' (spot_results.profiler_status)
+--   p_from_statuses  statuses that may be claimed; a NULL status is always claimable
+--   p_to_status      status set by the claim
+--   p_local_date     local_date of the placeholder row when the row does not exist yet
+--
+-- A missing row is claimed by inserting a placeholder (same content the Lambdas used
+-- to upsert). Existing rows are locked (FOR UPDATE) before the status is checked, so
+-- concurrent claimers are serialized and see each other's transition.
+--
+-- Returns one row:
+--   claimed          this call performed the transition
+--   previous_status  status before the call (NULL if the row did not exist)
+--   new_status       status after the call
+--   completed        the stage's result already exists (never claimed)
+--
+-- After creating / changing the function: NOTIFY pgrst, 'reload schema';
+
+-- device_id is uuid in spot_aggregators / spot_results; drop the earlier text overload
+-- so PostgREST does not see two candidates
+DROP FUNCTION IF EXISTS claim_spot_stage(text, text, timestamptz, text[], text, date);
+
+CREATE OR REPLACE FUNCTION claim_spot_stage(
+  p_stage text,
+  p_device_id uuid,
+  p_recorded_at timestamptz,
+  p_from_statuses text[],
+  p_to_status text,
+  p_local_date date DEFAULT NULL
+)
+RETURNS TABLE (claimed boolean, previous_status text, new_status text, completed boolean)
+LANGUAGE plpgsql
+AS $$
+DECLARE
+  v_status text;
+  v_completed boolean;
+BEGIN
+  IF p_stage = 'aggregator' THEN
+    INSERT INTO spot_aggregators (device_id, recorded_at, prompt, context_data, aggregator_status, local_date)
+    VALUES (
+      p_device_id,
+      p_recorded_at,
+      '',
+      jsonb_build_object('pipeline_state', p_to_status),
+      p_to_status,
+      p_local_date
+    )
+    ON CONFLICT (device_id, recorded_at) DO NOTHING;
+
+    IF FOUND THEN
+      RETURN QUERY SELECT true, NULL::text, p_to_status, false;
+      RETURN;
+    END IF;
+
+    SELECT a.aggregator_status,
+           a.aggregator_status = 'completed' AND coalesce(a.prompt, '') <> ''
+      INTO v_status, v_completed
+      FROM spot_aggregators a
+     WHERE a.device_id = p_device_id AND a.recorded_at = p_recorded_at
+       FOR UPDATE;
+
+  ELSIF p_stage = 'profiler' THEN
+    INSERT INTO spot_results (device_id, recorded_at, profile_result, profiler_status, local_date)
+    VALUES (
+      p_device_id,
+      p_recorded_at,
+      jsonb_build_object('pipeline_state', p_to_status),
+      p_to_status,
+      p_local_date
+    )
+    ON CONFLICT (device_id, recorded_at) DO NOTHING;
+
+    IF FOUND THEN
+      RETURN QUERY SELECT true, NULL::text, p_to_status, false;
+      RETURN;
+    END IF;
+
+    -- Same rule as is_profiler_completed in the Lambdas
+    SELECT r.profiler_status,
+           r.profiler_status = 'completed'
+           OR coalesce(r.summary, '') <> ''
+           OR r.vibe_score IS NOT NULL
+           OR (
+             r.profile_result IS NOT NULL
+             AND r.profile_result NOT IN (
+               'null'::jsonb,
+               '{}'::jsonb,
+               '{"pipeline_state": "queued"}'::jsonb,
+               '{"pipeline_state": "processing"}'::jsonb
+             )
+           )
+      INTO v_status, v_completed
+      FROM spot_results r
+     WHERE r.device_id = p_device_id AND r.recorded_at = p_recorded_at
+       FOR UPDATE;
+
+  ELSE
+    RAISE EXCEPTION 'Unknown spot stage: %', p_stage;
+  END IF;
+
+  v_completed := coalesce(v_completed, false);
+  IF v_completed OR NOT (v_status IS NULL OR v_status = ANY (p_from_statuses)) THEN
+    RETURN QUERY SELECT false, v_status, v_status, v_completed;
+    RETURN;
+  END IF;
+
+  IF p_stage = 'aggregator' THEN
+    UPDATE spot_aggregators
+       SET aggregator_status = p_to_status
+     WHERE device_id = p_device_id AND recorded_at = p_recorded_at;
+  ELSE
+    UPDATE spot_results
+       SET profiler_status = p_to_status
+     WHERE device_id = p_device_id AND recorded_at = p_recorded_at;
+  END IF;
+
+  RETURN QUERY SELECT true, v_status, p_to_status, false;
+END;
+$$;
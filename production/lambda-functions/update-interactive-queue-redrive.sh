@@ -0,0 +1,56 @@
+#!/bin/bash
+
+# Set maxReceiveCount on the interactive and bulk-lane ASR/SED/SER queues.
+# watchme-feature-worker parks deferred messages (open circuit breaker, admission
+# backpressure) in the defer queues (create-defer-queues.sh) and re-sends them, so a
+# deferral does not count as a receive here. maxReceiveCount only counts real dispatch
+# failures: with the default of 5 and the 300 s visibility timeout, a poison message
+# reaches the DLQ (and its alarm in create-watchme-alarms.sh) in about 25 minutes.
+# Deploy the defer queues and DEFER_QUEUE_URL before lowering the limit: without them the
+# worker falls back to ChangeMessageVisibility, which does count as a receive.
+
+set -e
+
+REGION="ap-southeast-2"
+ACCOUNT_ID="754724220380"
+INTERACTIVE_MAX_RECEIVE_COUNT="${INTERACTIVE_MAX_RECEIVE_COUNT:-5}"
+BULK_MAX_RECEIVE_COUNT="${BULK_MAX_RECEIVE_COUNT:-5}"
+
+update_redrive() {
+  local name="$1"
+  local dlq_name="$2"
+  local max_receive_count="$3"
+
+  local queue_url="https://sqs.${REGION}.amazonaws.com/${ACCOUNT_ID}/${name}"
+  local dlq_arn="arn:aws:sqs:${REGION}:${ACCOUNT_ID}:${dlq_name}"
+
+  echo "Updating ${name} (maxReceiveCount=${max_receive_count})..."
+  aws sqs set-queue-attributes \
+    --queue-url "${queue_url}" \
+    --region "${REGION}" \
+    --attributes "{
+      \"RedrivePolicy\": \"{\\\"deadLetterTargetArn\\\":\\\"${dlq_arn}\\\",\\\"maxReceiveCount\\\":${max_receive_count}}\"
+    }"
+
+  aws sqs get-queue-attributes \
+    --queue-url "${queue_url}" \
+    --region "${REGION}" \
+    --attribute-names RedrivePolicy \
+    --query 'Attributes.RedrivePolicy' \
+    --output text
+  echo ""
+}
+
+echo "🚀 Updating interactive queue redrive policies (ASR/SED/SER)..."
+
+update_redrive "watchme-asr-queue-v2.fifo" "watchme-asr-dlq-v2.fifo" "${INTERACTIVE_MAX_RECEIVE_COUNT}"
+update_redrive "watchme-sed-queue-v2.fifo" "watchme-sed-dlq-v2.fifo" "${INTERACTIVE_MAX_RECEIVE_COUNT}"
+update_redrive "watchme-ser-queue-v2.fifo" "watchme-ser-dlq-v2.fifo" "${INTERACTIVE_MAX_RECEIVE_COUNT}"
+
+echo "🚀 Updating bulk-lane queue redrive policies (ASR/SED/SER)..."
+
+update_redrive "watchme-asr-bulk-queue-v2.fifo" "watchme-asr-bulk-dlq-v2.fifo" "${BULK_MAX_RECEIVE_COUNT}"
+update_redrive "watchme-sed-bulk-queue-v2.fifo" "watchme-sed-bulk-dlq-v2.fifo" "${BULK_MAX_RECEIVE_COUNT}"
+update_redrive "watchme-ser-bulk-queue-v2.fifo" "watchme-ser-bulk-dlq-v2.fifo" "${BULK_MAX_RECEIVE_COUNT}"
+
+echo "✅ Queue redrive update completed"
@@ -1,6 +1,10 @@
 import hashlib
 import json
 import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
 
 import boto3
@@ -17,11 +21,60 @@ RECONCILIATION_LOOKBACK_MINUTES = int(
     os.environ.get("RECONCILIATION_LOOKBACK_MINUTES", "1440")
 )
 RECONCILIATION_BATCH_SIZE = int(os.environ.get("RECONCILIATION_BATCH_SIZE", "200"))
+# Recordings per bulk in.() state query (keeps the request URL short)
+RECONCILIATION_QUERY_CHUNK_SIZE = int(os.environ.get("RECONCILIATION_QUERY_CHUNK_SIZE", "100"))
+# The sweep resumes from a persisted (recorded_at, device_id) cursor and pages
+# (RECONCILIATION_BATCH_SIZE rows each) until caught up or out of time budget.
+# Once caught up, it rewinds to the start of the lookback window every
+# RECONCILIATION_REWIND_MINUTES to catch recordings that completed behind the cursor.
+# The cursor is keyed on recorded_at, not completion time (spot_features has no
+# completion timestamp): a recording that completes after the cursor has passed it
+# waits for the next rewind, i.e. up to RECONCILIATION_REWIND_MINUTES. The completion
+# notifications are the primary path; this sweep only catches the ones that were lost.
+RECONCILIATION_TIME_BUDGET_SECONDS = float(os.environ.get("RECONCILIATION_TIME_BUDGET_SECONDS", "120"))
+RECONCILIATION_REWIND_MINUTES = int(os.environ.get("RECONCILIATION_REWIND_MINUTES", "60"))
+# Candidates of a page are evaluated (claim + enqueue) by a pool of this many threads
+RECONCILIATION_CONCURRENCY = max(1, int(os.environ.get("RECONCILIATION_CONCURRENCY", "8")))
+# Claimed spot-analysis messages of a page are sent with SendMessageBatch (SQS max 10)
+SPOT_SEND_BATCH_SIZE = 10
+# "supabase" (reconciliation_cursors table) or "sqlite" (local stand-in)
+RECONCILIATION_CURSOR_BACKEND = os.environ.get("RECONCILIATION_CURSOR_BACKEND", "supabase")
+RECONCILIATION_CURSOR_SQLITE_PATH = os.environ.get(
+    "RECONCILIATION_CURSOR_SQLITE_PATH", "/tmp/reconciliation_cursors.db"
+)
+RECONCILIATION_CURSOR_NAME = "spot-analysis"
+# Per-recording completion bitmask set from the notifications themselves:
+# "supabase" (feature_completion_masks table + RPC), "sqlite" (local stand-in)
+# or "none" (read spot_features on every notification as before)
+COMPLETION_JOIN_BACKEND = os.environ.get("COMPLETION_JOIN_BACKEND", "supabase")
+COMPLETION_JOIN_SQLITE_PATH = os.environ.get(
+    "COMPLETION_JOIN_SQLITE_PATH", "/tmp/feature_completion_masks.db"
+)
+# FIFO MessageGroupId strategy for spot analysis: "device", "recording" or "sharded"
+SPOT_GROUP_ID_STRATEGY = os.environ.get("SPOT_GROUP_ID_STRATEGY", "device")
+SPOT_GROUP_ID_SHARDS = max(1, int(os.environ.get("SPOT_GROUP_ID_SHARDS", "4")))
 
 FEATURE_STATUS_FIELDS = ("vibe_status", "behavior_status", "emotion_status")
+# Stage registry shared with watchme-audio-processor: only the status fields of enabled
+# stages are required ("env" = all three, "json" = STAGE_REGISTRY_JSON, "supabase" =
+# pipeline_stage_registry), reloaded every STAGE_REGISTRY_TTL_SECONDS
+STAGE_REGISTRY_SOURCE = os.environ.get("STAGE_REGISTRY_SOURCE", "env")
+STAGE_REGISTRY_JSON = os.environ.get("STAGE_REGISTRY_JSON", "")
+STAGE_REGISTRY_TTL_SECONDS = float(os.environ.get("STAGE_REGISTRY_TTL_SECONDS", "300"))
+FEATURE_STAGE_STATUS_FIELDS = {"asr": "vibe_status", "sed": "behavior_status", "ser": "emotion_status"}
 PROFILER_IN_PROGRESS_STATUSES = {"queued", "processing"}
+# One bit per FEATURE_STATUS_FIELDS entry; notifications may name the feature or the worker
+FEATURE_COMPLETION_BITS = {"vibe": 1, "behavior": 2, "emotion": 4}
+FEATURE_TYPE_ALIASES = {"asr": "vibe", "transcriber": "vibe", "sed": "behavior", "ser": "emotion"}
+FEATURE_COMPLETION_MASK = 7
+AGGREGATOR_SELECT = "aggregator_status,prompt,created_at"
+PROFILER_SELECT = "profiler_status,created_at,summary,vibe_score,profile_result,daily_aggregator_status"
 
 sqs = boto3.client("sqs", region_name="ap-southeast-2")
+# Supabase reads and claim RPCs made by this container (for the coalescing metrics)
+supabase_reads = {"count": 0}
+completion_store = {"store": None}
+required_features = {"fields": None, "loaded_at": 0.0}
 
 
 def lambda_handler(event, context):
@@ -29,10 +82,14 @@ def lambda_handler(event, context):
         return handle_sqs_notifications(event)
 
     if is_scheduled_event(event):
-        return reconcile_recent_recordings("eventbridge")
+        return reconcile_recent_recordings("eventbridge", context)
 
     if isinstance(event, dict) and event.get("action") == "reconcile_recent":
-        return reconcile_recent_recordings(event.get("source", "manual-reconcile"))
+        return reconcile_recent_recordings(
+            event.get("source", "manual-reconcile"),
+            context,
+            rewind=bool(event.get("rewind")),
+        )
 
     if isinstance(event, dict) and event.get("device_id") and event.get("recorded_at"):
         result = attempt_enqueue(
@@ -64,14 +121,29 @@ def is_scheduled_event(event):
 
 
 def handle_sqs_notifications(event):
+    """
+    Notifications for the same recording (one per feature) are coalesced so each
+    recording is evaluated once per batch; the result lists the features it covers.
+    A recording that fails is retried by reporting its notifications in
+    batchItemFailures (the mapping uses ReportBatchItemFailures), so the other
+    recordings of the batch are not redelivered.
+    """
     print(f"Processing {len(event['Records'])} feature completion notifications")
     results = []
+    recordings = {}
+    message_ids = {}
+    local_dates = {}
 
     for record in event["Records"]:
-        message = json.loads(record["body"])
+        try:
+            message = json.loads(record["body"])
+            device_id = message["device_id"]
+            recorded_at = message["recorded_at"]
+        except (ValueError, KeyError, TypeError) as e:
+            # Retrying cannot fix a malformed notification; drop it
+            print(f"Invalid feature completion notification {record['messageId']}: {e}")
+            continue
 
-        device_id = message["device_id"]
-        recorded_at = message["recorded_at"]
         feature_type = message.get("feature_type", "unknown")
         status = message.get("status")
 
@@ -92,34 +164,347 @@ def handle_sqs_notifications(event):
             )
             continue
 
-        results.append(attempt_enqueue(device_id, recorded_at, f"sqs:{feature_type}"))
+        recordings.setdefault((device_id, recorded_at), []).append(feature_type)
+        message_ids.setdefault((device_id, recorded_at), []).append(record["messageId"])
+        if message.get("local_date"):
+            local_dates[(device_id, recorded_at)] = message["local_date"]
+
+    saved_reads = 0
+    batch_item_failures = []
+    for (device_id, recorded_at), feature_types in recordings.items():
+        reads_before = supabase_reads["count"]
+        try:
+            result = join_feature_completion(
+                device_id,
+                recorded_at,
+                feature_types,
+                f"sqs:{'+'.join(feature_types)}",
+                local_dates.get((device_id, recorded_at)),
+            )
+        except Exception as e:
+            print(f"Failed to evaluate {device_id}/{recorded_at}, retrying its notifications: {e}")
+            batch_item_failures.extend(
+                {"itemIdentifier": message_id}
+                for message_id in message_ids[(device_id, recorded_at)]
+            )
+            result = {
+                "device_id": device_id,
+                "recorded_at": recorded_at,
+                "status": "error",
+                "error": str(e),
+            }
+        # Each coalesced notification would have repeated the same status reads
+        saved_reads += (supabase_reads["count"] - reads_before) * (len(feature_types) - 1)
+        results.append({**result, "feature_types": feature_types})
+
+    log_coalescing_metrics(len(event["Records"]), recordings, saved_reads, results)
+    print(f"Results: {json.dumps(results)}")
+    return {"batchItemFailures": batch_item_failures}
+
+
+def join_feature_completion(device_id, recorded_at, feature_types, trigger_source, local_date=None):
+    """
+    Set the recording's completion bits from the notifications and evaluate it (status
+    and pipeline state reads, claim, enqueue) only on the notification that completes
+    the mask. Anything the join misses is picked up by the reconciliation sweep.
+    """
+    bits = get_completion_bits(feature_types)
+    store = get_completion_store()
+    if bits is None or store is None:
+        return attempt_enqueue(device_id, recorded_at, trigger_source)
+
+    try:
+        previous_mask, mask = store.set_bits(device_id, recorded_at, bits)
+    except Exception as e:
+        print(f"Warning: Could not update completion mask for {device_id}/{recorded_at}: {e}")
+        return attempt_enqueue(device_id, recorded_at, trigger_source)
+
+    required_mask = get_required_completion_mask()
+    if mask & required_mask != required_mask:
+        print(f"[{trigger_source}] Completion mask {mask:03b} for {device_id}/{recorded_at}")
+        return {
+            "device_id": device_id,
+            "recorded_at": recorded_at,
+            "status": "waiting_for_features",
+            "completion_mask": mask,
+        }
+
+    if previous_mask & required_mask == required_mask:
+        # Redelivered / repeated notification: the first evaluation may not have
+        # finished, so check again against Supabase (the claim is idempotent)
+        return attempt_enqueue(device_id, recorded_at, trigger_source)
 
-    return {"statusCode": 200, "body": json.dumps({"results": results})}
+    if not local_date:
+        # The notification did not carry local_date; spot_features has it (and the
+        # spot_results placeholder and the spot message need it)
+        return attempt_enqueue(device_id, recorded_at, trigger_source)
 
+    return attempt_enqueue(
+        device_id,
+        recorded_at,
+        trigger_source,
+        statuses={
+            **{field: "completed" for field in get_required_feature_fields()},
+            "local_date": local_date,
+        },
+    )
 
-def reconcile_recent_recordings(trigger_source):
-    candidates = get_recent_completed_candidates()
-    print(
-        f"Reconciliation trigger={trigger_source} found {len(candidates)} "
-        "completed candidates"
+
+def get_completion_bits(feature_types):
+    """
+    Returns None if a feature type does not map to a bit (evaluate via spot_features)
+    """
+    bits = 0
+    for feature_type in feature_types:
+        name = str(feature_type).lower().replace("-", "_").split("_")[0]
+        name = FEATURE_TYPE_ALIASES.get(name, name)
+        if name not in FEATURE_COMPLETION_BITS:
+            return None
+        bits |= FEATURE_COMPLETION_BITS[name]
+    return bits
+
+
+def get_required_completion_mask():
+    return sum(
+        FEATURE_COMPLETION_BITS[field.removesuffix("_status")]
+        for field in get_required_feature_fields()
     )
 
+
+def get_required_feature_fields():
+    """
+    Status fields of the enabled stages in the stage registry (FEATURE_STATUS_FIELDS order)
+    The last good set (or all fields) is kept if a reload fails
+    """
+    now = time.monotonic()
+    if required_features["fields"] is None or now - required_features["loaded_at"] >= STAGE_REGISTRY_TTL_SECONDS:
+        try:
+            enabled = {
+                FEATURE_STAGE_STATUS_FIELDS.get(stage.get("api_type"))
+                for stage in load_stage_registry()
+                if stage.get("enabled", True)
+            }
+            fields = tuple(field for field in FEATURE_STATUS_FIELDS if field in enabled)
+            if not fields:
+                raise ValueError("no enabled feature stage")
+            if fields != required_features["fields"]:
+                print(f"Required features ({STAGE_REGISTRY_SOURCE}): {', '.join(fields)}")
+            required_features["fields"] = fields
+        except Exception as e:
+            print(f"Warning: Failed to load stage registry ({STAGE_REGISTRY_SOURCE}): {e}")
+            if required_features["fields"] is None:
+                required_features["fields"] = FEATURE_STATUS_FIELDS
+        required_features["loaded_at"] = now
+    return required_features["fields"]
+
+
+def load_stage_registry():
+    """
+    Stage entries (api_type, enabled) from STAGE_REGISTRY_SOURCE, as read by watchme-audio-processor
+    """
+    if STAGE_REGISTRY_SOURCE == "json":
+        raw = STAGE_REGISTRY_JSON
+        if not raw.lstrip().startswith(("{", "[")):
+            with open(raw) as f:
+                raw = f.read()
+        document = json.loads(raw)
+        return document.get("stages", []) if isinstance(document, dict) else document
+
+    if STAGE_REGISTRY_SOURCE == "supabase":
+        response = requests.get(
+            f"{SUPABASE_URL}/rest/v1/pipeline_stage_registry",
+            params={"select": "api_type,enabled"},
+            headers=supabase_headers(),
+            timeout=10,
+        )
+        if response.status_code != 200:
+            raise RuntimeError(f"{response.status_code} {response.text}")
+        return response.json()
+
+    return [{"api_type": api_type, "enabled": True} for api_type in FEATURE_STAGE_STATUS_FIELDS]
+
+
+def log_coalescing_metrics(notification_count, recordings, saved_reads, results):
+    joined = [result for result in results if "feature_types" in result]
+    metrics = {
+        "event": "feature_notifications_coalesced",
+        "notifications": notification_count,
+        "recordings_evaluated": len(recordings),
+        "notifications_coalesced": sum(len(features) - 1 for features in recordings.values()),
+        "supabase_reads_saved": saved_reads,
+        "recordings_waiting_on_mask": sum(1 for result in joined if "completion_mask" in result),
+    }
+    print(f"METRICS: {json.dumps(metrics)}")
+
+
+def reconcile_recent_recordings(trigger_source, context=None, rewind=False):
+    """
+    Enqueue completed recordings that have no spot result yet, resuming from the
+    persisted cursor so each run only reads rows past the last checkpoint
+    """
+    started = time.monotonic()
+    budget = RECONCILIATION_TIME_BUDGET_SECONDS
+    if context is not None:
+        # Leave time for the claims and enqueues already in flight and the cursor save
+        budget = min(budget, context.get_remaining_time_in_millis() / 1000 - 30)
+    deadline = started + budget
+
+    store = get_cursor_store()
+    cursor = load_cursor(store)
+    now = datetime.now(timezone.utc)
+    if rewind or should_rewind(cursor, now):
+        cursor = {"recorded_at": None, "device_id": None, "pass_started_at": now.isoformat(), "caught_up": False}
+        print(f"Reconciliation trigger={trigger_source} starting a pass from the start of the window")
+
     results = []
-    for candidate in candidates:
-        results.append(
-            attempt_enqueue(
+    pages = 0
+    while True:
+        # A failed read raises: the cursor keeps the last saved page and is not marked
+        # caught up, so the next run reads the same rows again
+        candidates = get_recent_completed_candidates(cursor)
+        pages += 1
+        print(
+            f"Reconciliation trigger={trigger_source} page {pages} found {len(candidates)} "
+            f"completed candidates after {cursor['recorded_at']} / {cursor['device_id']}"
+        )
+
+        page_results = reconcile_candidates(candidates, trigger_source, deadline)
+        # The cursor only moves past the evaluated prefix; candidates skipped at the
+        # deadline are read again by the next run
+        evaluated = next(
+            (index for index, result in enumerate(page_results) if result is None),
+            len(page_results),
+        )
+        results.extend(result for result in page_results if result is not None)
+
+        caught_up = len(candidates) < RECONCILIATION_BATCH_SIZE and evaluated == len(candidates)
+        if evaluated:
+            cursor["recorded_at"] = candidates[evaluated - 1]["recorded_at"]
+            cursor["device_id"] = candidates[evaluated - 1]["device_id"]
+        cursor["caught_up"] = caught_up
+        save_cursor(store, cursor)
+
+        if caught_up or time.monotonic() >= deadline:
+            break
+
+    print(
+        f"Reconciliation trigger={trigger_source} read {pages} pages, evaluated {len(results)} "
+        f"candidates in {time.monotonic() - started:.1f}s with {RECONCILIATION_CONCURRENCY} workers, "
+        f"{'caught up' if cursor['caught_up'] else 'stopped at time budget'}"
+    )
+    return {
+        "statusCode": 200,
+        "body": json.dumps({"results": results, "pages": pages, "cursor": cursor}),
+    }
+
+
+def should_rewind(cursor, now):
+    if cursor is None:
+        return True
+    if not cursor.get("caught_up"):
+        return False
+    pass_started_at = datetime.fromisoformat(cursor["pass_started_at"])
+    return now - pass_started_at >= timedelta(minutes=RECONCILIATION_REWIND_MINUTES)
+
+
+def reconcile_candidates(candidates, trigger_source, deadline=None):
+    """
+    The candidates already carry their feature statuses; the pipeline state of the whole
+    candidate set is read with bulk in.() queries, so Supabase is only called per
+    candidate for the claim. Candidates are evaluated by RECONCILIATION_CONCURRENCY
+    threads; one that has not started by the deadline is skipped.
+
+    Claimed messages are collected and sent with SendMessageBatch once the page is done.
+
+    A candidate that raises is reported with status error and does not stop the page.
+
+    Returns:
+        list of results in candidate order (None for a skipped candidate)
+    """
+    outbox = []
+    pipeline_states = get_pipeline_states(candidates)
+    if pipeline_states is None:
+        print("Bulk pipeline state query failed, falling back to per-candidate reads")
+
+    def evaluate(candidate):
+        if deadline is not None and time.monotonic() >= deadline:
+            return None
+
+        try:
+            return evaluate_candidate(candidate)
+        except Exception as e:
+            # One failing candidate must not discard the page; the next rewind pass
+            # reads it again
+            print(
+                f"[{trigger_source}] Reconciliation failed for "
+                f"{candidate['device_id']}/{candidate['recorded_at']}: {e}"
+            )
+            return {
+                "device_id": candidate["device_id"],
+                "recorded_at": candidate["recorded_at"],
+                "status": "error",
+                "error": str(e),
+            }
+
+    def evaluate_candidate(candidate):
+        if pipeline_states is None:
+            return attempt_enqueue(
                 candidate["device_id"],
                 candidate["recorded_at"],
                 trigger_source,
+                outbox=outbox,
             )
-        )
-
-    return {"statusCode": 200, "body": json.dumps({"results": results})}
 
+        return attempt_enqueue(
+            candidate["device_id"],
+            candidate["recorded_at"],
+            trigger_source,
+            statuses={
+                **{field: "completed" for field in get_required_feature_fields()},
+                "local_date": candidate.get("local_date"),
+            },
+            pipeline_state=pipeline_states[
+                (candidate["device_id"], candidate["recorded_at"])
+            ],
+            outbox=outbox,
+        )
 
-def attempt_enqueue(device_id, recorded_at, trigger_source):
+    workers = min(RECONCILIATION_CONCURRENCY, len(candidates))
+    try:
+        if workers <= 1:
+            results = [evaluate(candidate) for candidate in candidates]
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(evaluate, candidates))
+    finally:
+        # Claims already made are sent (or reverted) even if the page fails, so no
+        # row is left queued without a message
+        outcomes = send_spot_messages(outbox, trigger_source)
+
+    for result in results:
+        if result and result["status"] == "pending_send":
+            result.update(outcomes[(result["device_id"], result["recorded_at"])])
+    return results
+
+
+def attempt_enqueue(
+    device_id,
+    recorded_at,
+    trigger_source,
+    statuses=None,
+    pipeline_state=None,
+    outbox=None,
+):
+    """
+    statuses may be passed in when already known; otherwise they are read from Supabase.
+    pipeline_state (bulk reconciliation) lets completed / in-progress recordings skip
+    the claim RPC; without it the RPC alone decides. With an outbox (list) the claimed
+    message is appended to it (status pending_send) for send_spot_messages instead of
+    being sent here.
+    """
     recording_key = f"{device_id}/{recorded_at}"
-    statuses = get_feature_statuses(device_id, recorded_at)
+    if statuses is None:
+        statuses = get_feature_statuses(device_id, recorded_at)
 
     if not statuses:
         print(f"[{trigger_source}] No feature status found for {recording_key}")
@@ -129,7 +514,7 @@ def attempt_enqueue(device_id, recorded_at, trigger_source):
             "status": "missing_feature_status",
         }
 
-    if not all(statuses.get(field) == "completed" for field in FEATURE_STATUS_FIELDS):
+    if not all(statuses.get(field) == "completed" for field in get_required_feature_fields()):
         print(f"[{trigger_source}] Not all features complete yet for {recording_key}")
         return {
             "device_id": device_id,
@@ -138,8 +523,7 @@ def attempt_enqueue(device_id, recorded_at, trigger_source):
             "feature_statuses": statuses,
         }
 
-    pipeline_state = get_pipeline_state(device_id, recorded_at)
-    if pipeline_state["profiler_completed"]:
+    if pipeline_state and pipeline_state["profiler_completed"]:
         print(f"[{trigger_source}] Spot analysis already completed for {recording_key}")
         return {
             "device_id": device_id,
@@ -163,20 +547,18 @@ def attempt_enqueue(device_id, recorded_at, trigger_source):
             **claim_result,
         }
 
+    message = build_spot_message(device_id, recorded_at, local_date, trigger_source)
+    if outbox is not None:
+        outbox.append({"device_id": device_id, "recorded_at": recorded_at, **message})
+        return {
+            "device_id": device_id,
+            "recorded_at": recorded_at,
+            "status": "pending_send",
+            "trigger_source": trigger_source,
+        }
+
     try:
-        response = sqs.send_message(
-            QueueUrl=SPOT_ANALYSIS_QUEUE_URL,
-            MessageBody=json.dumps(
-                {
-                    "device_id": device_id,
-                    "recorded_at": recorded_at,
-                    "local_date": local_date,
-                    "trigger_source": trigger_source,
-                }
-            ),
-            MessageGroupId=f"{device_id}-spot-analysis",
-            MessageDeduplicationId=get_deduplication_id(device_id, recorded_at),
-        )
+        response = sqs.send_message(QueueUrl=SPOT_ANALYSIS_QUEUE_URL, **message)
     except Exception:
         revert_profiler_queue_claim(device_id, recorded_at)
         raise
@@ -195,52 +577,113 @@ def attempt_enqueue(device_id, recorded_at, trigger_source):
     }
 
 
-def claim_profiler_queue_slot(device_id, recorded_at, local_date, pipeline_state):
-    profiler_row = pipeline_state["profiler_row"]
-    profiler_status = pipeline_state["profiler_status"]
+def build_spot_message(device_id, recorded_at, local_date, trigger_source):
+    return {
+        "MessageBody": json.dumps(
+            {
+                "device_id": device_id,
+                "recorded_at": recorded_at,
+                "local_date": local_date,
+                "trigger_source": trigger_source,
+            }
+        ),
+        "MessageGroupId": get_message_group_id(device_id, recorded_at),
+        "MessageDeduplicationId": get_deduplication_id(device_id, recorded_at),
+    }
 
-    if pipeline_state["profiler_completed"]:
-        return {"status": "already_completed"}
 
-    if profiler_status in PROFILER_IN_PROGRESS_STATUSES:
-        return {"status": "already_in_progress", "profiler_status": profiler_status}
+def send_spot_messages(outbox, trigger_source):
+    """
+    Send claimed messages with SendMessageBatch (SPOT_SEND_BATCH_SIZE per call); the
+    queue claim is reverted only for the entries that failed
 
-    if profiler_row:
-        updated_rows = patch_rows(
-            "spot_results",
+    Returns:
+        dict (device_id, recorded_at) -> {status: queued, message_id}
+        or {status: enqueue_failed, error}
+    """
+    outcomes = {}
+    for start in range(0, len(outbox), SPOT_SEND_BATCH_SIZE):
+        chunk = outbox[start:start + SPOT_SEND_BATCH_SIZE]
+        entries = [
             {
-                "device_id": f"eq.{device_id}",
-                "recorded_at": f"eq.{recorded_at}",
-                "or": (
-                    "(profiler_status.is.null,"
-                    "profiler_status.eq.pending,"
-                    "profiler_status.eq.failed)"
-                ),
-            },
-            {"profiler_status": "queued"},
+                "Id": str(index),
+                "MessageBody": item["MessageBody"],
+                "MessageGroupId": item["MessageGroupId"],
+                "MessageDeduplicationId": item["MessageDeduplicationId"],
+            }
+            for index, item in enumerate(chunk)
+        ]
+
+        try:
+            response = sqs.send_message_batch(QueueUrl=SPOT_ANALYSIS_QUEUE_URL, Entries=entries)
+            succeeded = {entry["Id"]: entry["MessageId"] for entry in response.get("Successful", [])}
+            failed = {
+                entry["Id"]: f"{entry.get('Code')}: {entry.get('Message')}"
+                for entry in response.get("Failed", [])
+            }
+        except Exception as e:
+            succeeded = {}
+            failed = {entry["Id"]: str(e) for entry in entries}
+
+        for index, item in enumerate(chunk):
+            key = (item["device_id"], item["recorded_at"])
+            recording_key = f"{item['device_id']}/{item['recorded_at']}"
+            if str(index) in succeeded:
+                outcomes[key] = {"status": "queued", "message_id": succeeded[str(index)]}
+                continue
+
+            error = failed.get(str(index), "missing from SendMessageBatch response")
+            print(f"[{trigger_source}] Failed to enqueue spot analysis for {recording_key}: {error}")
+            try:
+                revert_profiler_queue_claim(item["device_id"], item["recorded_at"])
+            except Exception as e:
+                print(f"[{trigger_source}] Could not revert queue claim for {recording_key}: {e}")
+            outcomes[key] = {"status": "enqueue_failed", "error": error}
+
+    if outbox:
+        print(
+            f"[{trigger_source}] Enqueued {sum(1 for o in outcomes.values() if o['status'] == 'queued')}"
+            f"/{len(outbox)} spot analyses in {-(-len(outbox) // SPOT_SEND_BATCH_SIZE)} batch calls"
         )
+    return outcomes
 
-        if updated_rows:
-            return {"status": "claimed", "profiler_status": "queued"}
 
-        refreshed_state = get_pipeline_state(device_id, recorded_at)
-        if refreshed_state["profiler_completed"]:
+def claim_profiler_queue_slot(device_id, recorded_at, local_date, pipeline_state=None):
+    if pipeline_state:
+        if pipeline_state["profiler_completed"]:
             return {"status": "already_completed"}
 
-        refreshed_status = refreshed_state["profiler_status"]
-        if refreshed_status in PROFILER_IN_PROGRESS_STATUSES:
+        if pipeline_state["profiler_status"] in PROFILER_IN_PROGRESS_STATUSES:
             return {
                 "status": "already_in_progress",
-                "profiler_status": refreshed_status,
+                "profiler_status": pipeline_state["profiler_status"],
             }
 
+    claim = claim_stage(
+        "profiler",
+        device_id,
+        recorded_at,
+        ["pending", "failed"],
+        "queued",
+        local_date,
+    )
+
+    if claim["claimed"]:
+        return {"status": "claimed", "profiler_status": "queued"}
+
+    if claim["completed"]:
+        return {"status": "already_completed"}
+
+    if claim["previous_status"] in PROFILER_IN_PROGRESS_STATUSES:
         return {
-            "status": "claim_failed",
-            "profiler_status": refreshed_status,
+            "status": "already_in_progress",
+            "profiler_status": claim["previous_status"],
         }
 
-    create_profiler_placeholder(device_id, recorded_at, local_date, "queued")
-    return {"status": "claimed", "profiler_status": "queued"}
+    return {
+        "status": "claim_failed",
+        "profiler_status": claim["previous_status"],
+    }
 
 
 def revert_profiler_queue_claim(device_id, recorded_at):
@@ -255,18 +698,18 @@ def revert_profiler_queue_claim(device_id, recorded_at):
     )
 
 
-def create_profiler_placeholder(device_id, recorded_at, local_date, profiler_status):
-    payload = {
-        "device_id": device_id,
-        "recorded_at": recorded_at,
-        "profile_result": {"pipeline_state": profiler_status},
-        "profiler_status": profiler_status,
-    }
-
-    if local_date:
-        payload["local_date"] = local_date
+def get_message_group_id(device_id, recorded_at):
+    group_id = f"{device_id}-spot-analysis"
+    if SPOT_GROUP_ID_STRATEGY == "device":
+        return group_id
 
-    upsert_row("spot_results", payload, "device_id,recorded_at")
+    # Stable per recording so retries and re-enqueues land in the same group
+    digest = hashlib.sha256(f"{device_id}-{recorded_at}".encode()).hexdigest()
+    if SPOT_GROUP_ID_STRATEGY == "recording":
+        return f"{group_id}-{digest[:16]}"
+    if SPOT_GROUP_ID_SHARDS <= 1:
+        return group_id
+    return f"{group_id}-s{int(digest[:8], 16) % SPOT_GROUP_ID_SHARDS}"
 
 
 def get_deduplication_id(device_id, recorded_at):
@@ -274,6 +717,7 @@ def get_deduplication_id(device_id, recorded_at):
 
 
 def get_feature_statuses(device_id, recorded_at):
+    supabase_reads["count"] += 1
     response = requests.get(
         f"{SUPABASE_URL}/rest/v1/spot_features",
         params={
@@ -296,20 +740,31 @@ def get_feature_statuses(device_id, recorded_at):
     return data[0] if data else {}
 
 
-def get_pipeline_state(device_id, recorded_at):
-    aggregator_row = fetch_single_row(
-        "spot_aggregators",
-        device_id,
-        recorded_at,
-        "aggregator_status,prompt,created_at",
-    )
-    profiler_row = fetch_single_row(
-        "spot_results",
-        device_id,
-        recorded_at,
-        "profiler_status,created_at,summary,vibe_score,profile_result,daily_aggregator_status",
-    )
+def get_pipeline_states(recordings):
+    """
+    Pipeline state for many recordings: one spot_aggregators and one spot_results
+    query per RECONCILIATION_QUERY_CHUNK_SIZE recordings
+
+    Returns:
+        dict (device_id, recorded_at) -> pipeline state (see build_pipeline_state),
+        or None if a query failed
+    """
+    aggregator_rows = fetch_rows_for_recordings("spot_aggregators", recordings, AGGREGATOR_SELECT)
+    profiler_rows = fetch_rows_for_recordings("spot_results", recordings, PROFILER_SELECT)
+    if aggregator_rows is None or profiler_rows is None:
+        return None
+
+    states = {}
+    for recording in recordings:
+        key = get_recording_key(recording["device_id"], recording["recorded_at"])
+        states[(recording["device_id"], recording["recorded_at"])] = build_pipeline_state(
+            aggregator_rows.get(key),
+            profiler_rows.get(key),
+        )
+    return states
 
+
+def build_pipeline_state(aggregator_row, profiler_row):
     profiler_status = (profiler_row or {}).get("profiler_status")
     profiler_completed = is_profiler_completed(profiler_row)
 
@@ -340,27 +795,99 @@ def is_profiler_completed(profiler_row):
     )
 
 
-def fetch_single_row(table_name, device_id, recorded_at, select_clause):
-    response = requests.get(
-        f"{SUPABASE_URL}/rest/v1/{table_name}",
-        params={
-            "device_id": f"eq.{device_id}",
-            "recorded_at": f"eq.{recorded_at}",
-            "select": select_clause,
+def fetch_rows_for_recordings(table_name, recordings, select_clause):
+    """
+    Rows of table_name for the given recordings, keyed by (device_id, recorded_at)
+
+    device_id=in.() and recorded_at=in.() select a superset (every device x every
+    timestamp in the chunk); rows outside the requested pairs are dropped here.
+
+    Returns:
+        dict get_recording_key(device_id, recorded_at) -> row, or None if a query failed
+    """
+    ordered = sorted({(recording["device_id"], recording["recorded_at"]) for recording in recordings})
+    wanted = {get_recording_key(device_id, recorded_at) for device_id, recorded_at in ordered}
+    rows = {}
+
+    for start in range(0, len(ordered), RECONCILIATION_QUERY_CHUNK_SIZE):
+        chunk = ordered[start:start + RECONCILIATION_QUERY_CHUNK_SIZE]
+        device_ids = sorted({device_id for device_id, _ in chunk})
+        recorded_ats = sorted({recorded_at for _, recorded_at in chunk})
+
+        supabase_reads["count"] += 1
+        response = requests.get(
+            f"{SUPABASE_URL}/rest/v1/{table_name}",
+            params={
+                "device_id": f"in.({','.join(device_ids)})",
+                "recorded_at": "in.({})".format(
+                    ",".join(f'"{recorded_at}"' for recorded_at in recorded_ats)
+                ),
+                "select": f"device_id,recorded_at,{select_clause}",
+            },
+            headers=supabase_headers(),
+            timeout=20,
+        )
+
+        if response.status_code != 200:
+            print(
+                f"Error fetching {table_name} for {len(chunk)} recordings: "
+                f"{response.status_code} {response.text}"
+            )
+            return None
+
+        for row in response.json():
+            key = get_recording_key(row["device_id"], row["recorded_at"])
+            if key in wanted:
+                rows[key] = row
+
+    return rows
+
+
+def get_recording_key(device_id, recorded_at):
+    """
+    (device_id, UTC datetime) so timestamps serialized differently by each table still match
+    """
+    try:
+        timestamp = datetime.fromisoformat(recorded_at)
+    except ValueError:
+        return device_id, recorded_at
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return device_id, timestamp.astimezone(timezone.utc)
+
+
+def claim_stage(stage, device_id, recorded_at, from_statuses, to_status, local_date=None):
+    """
+    Conditional status transition in one round trip (claim_spot_stage RPC, see
+    production/lambda-functions/supabase-claim-spot-stage.sql); inserts a placeholder
+    row if the recording has none yet
+
+    Returns:
+        dict with claimed, previous_status, new_status and completed
+    """
+    supabase_reads["count"] += 1
+    response = requests.post(
+        f"{SUPABASE_URL}/rest/v1/rpc/claim_spot_stage",
+        json={
+            "p_stage": stage,
+            "p_device_id": device_id,
+            "p_recorded_at": recorded_at,
+            "p_from_statuses": from_statuses,
+            "p_to_status": to_status,
+            "p_local_date": local_date,
         },
-        headers=supabase_headers(),
+        headers={**supabase_headers(), "Content-Type": "application/json"},
         timeout=10,
     )
 
     if response.status_code != 200:
-        print(
-            f"Error fetching {table_name} for {device_id}/{recorded_at}: "
+        raise RuntimeError(
+            f"Failed to claim {stage} for {device_id}/{recorded_at}: "
             f"{response.status_code} {response.text}"
         )
-        return None
 
     data = response.json()
-    return data[0] if data else None
+    return data[0] if isinstance(data, list) else data
 
 
 def upsert_row(table_name, payload, on_conflict):
@@ -409,36 +936,218 @@ def patch_rows(table_name, filters, payload):
         return []
 
 
-def get_recent_completed_candidates():
+def get_recent_completed_candidates(cursor=None):
+    """
+    One keyset page of completed recordings in the lookback window, ordered by
+    (recorded_at, device_id) and starting after the cursor position
+
+    Raises:
+        RuntimeError: The spot_features query failed (an empty page would read as caught up)
+    """
     cutoff = datetime.now(timezone.utc) - timedelta(
         minutes=RECONCILIATION_LOOKBACK_MINUTES
     )
+    params = {
+        "created_at": f"gte.{cutoff.isoformat()}",
+        **{field: "eq.completed" for field in get_required_feature_fields()},
+        "select": "device_id,recorded_at,local_date,created_at",
+        "order": "recorded_at.asc,device_id.asc",
+        "limit": str(RECONCILIATION_BATCH_SIZE),
+    }
+    if cursor and cursor.get("recorded_at"):
+        params["or"] = (
+            f'(recorded_at.gt."{cursor["recorded_at"]}",'
+            f'and(recorded_at.eq."{cursor["recorded_at"]}",device_id.gt."{cursor["device_id"]}"))'
+        )
 
     response = requests.get(
         f"{SUPABASE_URL}/rest/v1/spot_features",
-        params={
-            "created_at": f"gte.{cutoff.isoformat()}",
-            "vibe_status": "eq.completed",
-            "behavior_status": "eq.completed",
-            "emotion_status": "eq.completed",
-            "select": "device_id,recorded_at,local_date,created_at",
-            "order": "recorded_at.asc",
-            "limit": str(RECONCILIATION_BATCH_SIZE),
-        },
+        params=params,
         headers=supabase_headers(),
         timeout=20,
     )
 
     if response.status_code != 200:
-        print(
-            f"Error fetching reconciliation candidates: "
+        raise RuntimeError(
+            f"Failed to fetch reconciliation candidates: "
             f"{response.status_code} {response.text}"
         )
-        return []
 
     return response.json()
 
 
+class SupabaseCursorStore:
+    """
+    Reconciliation cursors in Supabase (reconciliation_cursors table, one row per sweep)
+    """
+
+    def load(self, name):
+        response = requests.get(
+            f"{SUPABASE_URL}/rest/v1/reconciliation_cursors",
+            params={
+                "name": f"eq.{name}",
+                "select": "recorded_at,device_id,pass_started_at,caught_up",
+            },
+            headers=supabase_headers(),
+            timeout=10,
+        )
+        if response.status_code != 200:
+            raise RuntimeError(f"{response.status_code} {response.text}")
+        rows = response.json()
+        return rows[0] if rows else None
+
+    def save(self, name, cursor):
+        upsert_row(
+            "reconciliation_cursors",
+            {**cursor, "name": name, "updated_at": datetime.now(timezone.utc).isoformat()},
+            "name",
+        )
+
+
+class SQLiteCursorStore:
+    """
+    Local stand-in for the reconciliation cursors (same interface, SQLite file)
+    """
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path)
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS reconciliation_cursors ("
+                "name TEXT PRIMARY KEY, recorded_at TEXT, device_id TEXT, "
+                "pass_started_at TEXT, caught_up INTEGER, updated_at TEXT)"
+            )
+
+    def load(self, name):
+        row = self.conn.execute(
+            "SELECT recorded_at, device_id, pass_started_at, caught_up "
+            "FROM reconciliation_cursors WHERE name = ?",
+            (name,),
+        ).fetchone()
+        if not row:
+            return None
+        return {
+            "recorded_at": row[0],
+            "device_id": row[1],
+            "pass_started_at": row[2],
+            "caught_up": bool(row[3]),
+        }
+
+    def save(self, name, cursor):
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO reconciliation_cursors "
+                "(name, recorded_at, device_id, pass_started_at, caught_up, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    name,
+                    cursor["recorded_at"],
+                    cursor["device_id"],
+                    cursor["pass_started_at"],
+                    int(cursor["caught_up"]),
+                    datetime.now(timezone.utc).isoformat(),
+                ),
+            )
+
+
+def get_cursor_store():
+    if RECONCILIATION_CURSOR_BACKEND == "sqlite":
+        return SQLiteCursorStore(RECONCILIATION_CURSOR_SQLITE_PATH)
+    return SupabaseCursorStore()
+
+
+def load_cursor(store):
+    """
+    Returns None (start a new pass) if there is no cursor or it cannot be read
+    """
+    try:
+        return store.load(RECONCILIATION_CURSOR_NAME)
+    except Exception as e:
+        print(f"Warning: Could not load reconciliation cursor: {e}")
+        return None
+
+
+def save_cursor(store, cursor):
+    try:
+        store.save(RECONCILIATION_CURSOR_NAME, cursor)
+    except Exception as e:
+        # The next run repeats the pages since the last saved position
+        print(f"Warning: Could not save reconciliation cursor: {e}")
+
+
+class SupabaseCompletionStore:
+    """
+    Completion bitmasks in Supabase (feature_completion_masks table). The OR is done by
+    the set_feature_completion_bits RPC under a row lock, so exactly one caller sees
+    the mask become complete.
+    """
+
+    def set_bits(self, device_id, recorded_at, bits):
+        response = requests.post(
+            f"{SUPABASE_URL}/rest/v1/rpc/set_feature_completion_bits",
+            json={"p_device_id": device_id, "p_recorded_at": recorded_at, "p_bits": bits},
+            headers={**supabase_headers(), "Content-Type": "application/json"},
+            timeout=10,
+        )
+        if response.status_code != 200:
+            raise RuntimeError(f"{response.status_code} {response.text}")
+        data = response.json()
+        row = data[0] if isinstance(data, list) else data
+        return row["previous_mask"], row["mask"]
+
+
+class SQLiteCompletionStore:
+    """
+    Local stand-in for the completion bitmasks (same interface, SQLite file)
+    """
+
+    def __init__(self, path):
+        # Shared by the container's threads; the lock serializes them, BEGIN IMMEDIATE
+        # serializes other connections to the same file
+        self.conn = sqlite3.connect(path, isolation_level=None, timeout=10, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS feature_completion_masks ("
+            "device_id TEXT NOT NULL, recorded_at TEXT NOT NULL, mask INTEGER NOT NULL, "
+            "updated_at TEXT, PRIMARY KEY (device_id, recorded_at))"
+        )
+
+    def set_bits(self, device_id, recorded_at, bits):
+        key = get_recording_key(device_id, recorded_at)
+        recorded_at = key[1].isoformat() if isinstance(key[1], datetime) else key[1]
+
+        # BEGIN IMMEDIATE takes the write lock before the read (conditional update)
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.conn.execute(
+                    "SELECT mask FROM feature_completion_masks WHERE device_id = ? AND recorded_at = ?",
+                    (device_id, recorded_at),
+                ).fetchone()
+                previous_mask = row[0] if row else 0
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO feature_completion_masks "
+                    "(device_id, recorded_at, mask, updated_at) VALUES (?, ?, ?, ?)",
+                    (device_id, recorded_at, previous_mask | bits, datetime.now(timezone.utc).isoformat()),
+                )
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+        return previous_mask, previous_mask | bits
+
+
+def get_completion_store():
+    if COMPLETION_JOIN_BACKEND == "none":
+        return None
+    if completion_store["store"] is None:
+        if COMPLETION_JOIN_BACKEND == "sqlite":
+            completion_store["store"] = SQLiteCompletionStore(COMPLETION_JOIN_SQLITE_PATH)
+        else:
+            completion_store["store"] = SupabaseCompletionStore()
+    return completion_store["store"]
+
+
 def supabase_headers():
     return {
         "apikey": SUPABASE_KEY,
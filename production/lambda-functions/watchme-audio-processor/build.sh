@@ -13,9 +13,13 @@ echo "📦 Building Lambda package..."
 echo "📝 Copying lambda_function.py from local directory..."
 cp lambda_function.py build/
 
-# 依存関係をインストール（requestsのみ必要）
+# 依存関係をインストール（requests, numpy）
+# numpyはLambda実行環境（Linux x86_64 / Python 3.11）向けのwheelを取得する
+# （ビルド環境のPythonのバージョンに関係なく cp311 のwheelを選ぶ）
 echo "📚 Installing dependencies..."
-pip3 install --target ./build requests --quiet
+pip3 install --target ./build -r requirements.txt \
+  --platform manylinux2014_x86_64 --python-version 3.11 --implementation cp --abi cp311 \
+  --only-binary=:all: --quiet
 
 # ZIPファイルを作成
 echo "🗜️ Creating function.zip..."
@@ -3,15 +3,140 @@ import boto3
 import os
 import requests
 import hashlib
+import sqlite3
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 from urllib.parse import unquote_plus
 
 # Environment variables - FIFO Queue URLs
 ASR_QUEUE_URL = os.environ.get('ASR_QUEUE_URL', 'https://sqs.ap-southeast-2.amazonaws.com/754724220380/watchme-asr-queue-v2.fifo')
 SED_QUEUE_URL = os.environ.get('SED_QUEUE_URL', 'https://sqs.ap-southeast-2.amazonaws.com/754724220380/watchme-sed-queue-v2.fifo')
 SER_QUEUE_URL = os.environ.get('SER_QUEUE_URL', 'https://sqs.ap-southeast-2.amazonaws.com/754724220380/watchme-ser-queue-v2.fifo')
+# Bulk-lane FIFO queues (camera-roll / wearable imports); empty = same queue as interactive
+ASR_BULK_QUEUE_URL = os.environ.get('ASR_BULK_QUEUE_URL', '')
+SED_BULK_QUEUE_URL = os.environ.get('SED_BULK_QUEUE_URL', '')
+SER_BULK_QUEUE_URL = os.environ.get('SER_BULK_QUEUE_URL', '')
 SUPABASE_URL = os.environ.get('SUPABASE_URL')
 SUPABASE_KEY = os.environ.get('SUPABASE_KEY')
 
+# (label, api_type, queue_url, bulk_queue_url) for each feature extraction stage
+FEATURE_QUEUES = (
+    ('ASR', 'asr', ASR_QUEUE_URL, ASR_BULK_QUEUE_URL),
+    ('SED', 'sed', SED_QUEUE_URL, SED_BULK_QUEUE_URL),
+    ('SER', 'ser', SER_QUEUE_URL, SER_BULK_QUEUE_URL),
+)
+# SendMessageBatch accepts at most 10 entries per call
+SQS_BATCH_SIZE = 10
+
+# Records whose fan-out failed are re-submitted to this function as a new async event
+# holding only them, up to FANOUT_RETRY_MAX_ATTEMPTS times (the retry waits
+# FANOUT_RETRY_DELAY_SECONDS, doubling per attempt). After that the invocation fails,
+# so Lambda's own async retries and on-failure destination take over
+FANOUT_RETRY_MAX_ATTEMPTS = int(os.environ.get('FANOUT_RETRY_MAX_ATTEMPTS', '3'))
+FANOUT_RETRY_DELAY_SECONDS = float(os.environ.get('FANOUT_RETRY_DELAY_SECONDS', '2'))
+
+# file_path values per audio_files lookup (keeps the in.() query string short)
+AUDIO_FILES_LOOKUP_CHUNK_SIZE = int(os.environ.get('AUDIO_FILES_LOOKUP_CHUNK_SIZE', '50'))
+
+# Supabase HTTP session (keep-alive connection pool reused across warm invocations)
+supabase_session = requests.Session()
+supabase_session.headers.update({
+    "apikey": SUPABASE_KEY or "",
+    "Authorization": f"Bearer {SUPABASE_KEY}"
+})
+
+# Upload-time audio quality gate (silence / clipping / SNR)
+QC_ENABLED = os.environ.get('QC_ENABLED', 'false').lower() in {'1', 'true', 'yes'}
+QC_MIN_RMS_DBFS = float(os.environ.get('QC_MIN_RMS_DBFS', '-55'))
+QC_MAX_CLIPPING_RATIO = float(os.environ.get('QC_MAX_CLIPPING_RATIO', '0.01'))
+QC_MIN_SNR_DB = float(os.environ.get('QC_MIN_SNR_DB', '3'))
+# api_types still fanned out for recordings that fail QC (e.g. "asr"); empty = skip all
+QC_FALLBACK_STAGES = {
+    stage.strip() for stage in os.environ.get('QC_FALLBACK_STAGES', '').split(',') if stage.strip()
+}
+QC_CHUNK_BYTES = int(os.environ.get('QC_CHUNK_BYTES', str(256 * 1024)))
+QC_MAX_HEADER_BYTES = 64 * 1024
+QC_FRAME_MS = 20
+QC_CLIP_LEVEL = 0.999
+QC_NOISE_PERCENTILE = 10
+QC_SIGNAL_PERCENTILE = 90
+
+# Decode-once canonical artifact (16 kHz mono raw PCM) shared by ASR/SED/SER
+CANONICAL_AUDIO_ENABLED = os.environ.get('CANONICAL_AUDIO_ENABLED', 'false').lower() in {'1', 'true', 'yes'}
+# "f32" (float32) or "i16" (int16), little-endian, no header
+CANONICAL_AUDIO_FORMAT = os.environ.get('CANONICAL_AUDIO_FORMAT', 'f32')
+CANONICAL_SAMPLE_RATE = 16000
+CANONICAL_AUDIO_SUFFIXES = ('.16k.f32', '.16k.i16')
+CANONICAL_FILTER_TAPS = 63
+CANONICAL_PART_BYTES = 8 * 1024 * 1024
+
+# Priority lanes: interactive mic recordings vs. bulk imports
+# Upload source is read from the audio_files column, the S3 object metadata, then the key prefix
+PRIORITY_SOURCE_COLUMN = os.environ.get('PRIORITY_SOURCE_COLUMN', '')
+PRIORITY_METADATA_KEY = os.environ.get('PRIORITY_METADATA_KEY', '')
+BULK_KEY_PREFIXES = tuple(
+    prefix.strip() for prefix in os.environ.get('BULK_KEY_PREFIXES', '').split(',') if prefix.strip()
+)
+BULK_SOURCES = {
+    source.strip()
+    for source in os.environ.get('BULK_SOURCES', 'camera_roll,import,wearable').split(',')
+    if source.strip()
+}
+
+# Content-hash dedup of re-uploaded audio (persists beyond the FIFO 5-minute window)
+CONTENT_DEDUP_ENABLED = os.environ.get('CONTENT_DEDUP_ENABLED', 'false').lower() in {'1', 'true', 'yes'}
+# "etag" (from the S3 event, no extra read) or "sha256" (streamed hash of the object)
+CONTENT_DEDUP_KEY = os.environ.get('CONTENT_DEDUP_KEY', 'etag')
+CONTENT_DEDUP_TTL_HOURS = float(os.environ.get('CONTENT_DEDUP_TTL_HOURS', '168'))
+# "supabase" (audio_content_index table) or "sqlite" (local stand-in for tests)
+CONTENT_DEDUP_BACKEND = os.environ.get('CONTENT_DEDUP_BACKEND', 'supabase')
+CONTENT_DEDUP_SQLITE_PATH = os.environ.get('CONTENT_DEDUP_SQLITE_PATH', '/tmp/audio_content_index.db')
+content_index = None
+# A re-upload is skipped only while the earlier recording's stages (spot_features) are in one
+# of these states; failed or missing results are fanned out again
+FEATURE_STATUS_FIELDS = {'asr': 'vibe_status', 'sed': 'behavior_status', 'ser': 'emotion_status'}
+CONTENT_DEDUP_LIVE_STATUSES = {'pending', 'processing', 'completed'}
+
+# Stage registry (which feature stages each upload is fanned out to)
+# "env" (queue URL env vars), "json" (STAGE_REGISTRY_JSON) or "supabase" (pipeline_stage_registry)
+STAGE_REGISTRY_SOURCE = os.environ.get('STAGE_REGISTRY_SOURCE', 'env')
+STAGE_REGISTRY_JSON = os.environ.get('STAGE_REGISTRY_JSON', '')
+STAGE_REGISTRY_TTL_SECONDS = float(os.environ.get('STAGE_REGISTRY_TTL_SECONDS', '300'))
+# Demo devices have no real audio in S3 (KNOWN_ISSUES issue 3); denied in the env registry
+DEMO_DEVICE_IDS = {
+    device_id.strip()
+    for device_id in os.environ.get('DEMO_DEVICE_IDS', '9f7d6e27-98c3-4c19-bdfb-f7fda58b9a93').split(',')
+    if device_id.strip()
+}
+stage_registry = None
+stage_registry_loaded_at = 0.0
+
+# Default FIFO MessageGroupId strategy per stage
+# "device" (one group per device, strictly serial), "recording" (one group per recording)
+# or "sharded" (GROUP_ID_SHARDS groups per device, recordings hashed onto them)
+GROUP_ID_STRATEGY = os.environ.get('GROUP_ID_STRATEGY', 'device')
+GROUP_ID_SHARDS = int(os.environ.get('GROUP_ID_SHARDS', '4'))
+GROUP_ID_STRATEGIES = {'device', 'recording', 'sharded'}
+
+# numpy is imported on the first decode (QC / canonical audio), so cold starts
+# with both disabled do not pay for it
+np = None
+
+# AWS clients (created once per container and reused across warm invocations)
+sqs = boto3.client('sqs', region_name='ap-southeast-2')
+s3 = boto3.client('s3', region_name='ap-southeast-2')
+lambda_client = boto3.client('lambda', region_name='ap-southeast-2')
+
+
+class FanOutError(Exception):
+    """
+    Records could not be queued and were not re-submitted; raised so that Lambda's
+    async retry (and finally the on-failure destination) handles the event
+    """
+
+
 def get_deduplication_id(device_id, recorded_at, api_type):
     """
     Generate FIFO Queue Deduplication ID
@@ -29,149 +154,1299 @@ def get_deduplication_id(device_id, recorded_at, api_type):
     return hashlib.sha256(unique_string.encode()).hexdigest()[:80]
 
 
-def get_recorded_at_from_audio_files(file_path):
+def get_recorded_at_from_audio_files(file_paths):
+    """
+    Get recorded_at and device_id from audio_files table for many file_paths
+    Uses one file_path=in.(...) query per chunk on the pooled Supabase session
+
+    Args:
+        file_paths: S3 file paths (e.g., files/{device_id}/{date}/{time_slot}/audio.wav)
+
+    Returns:
+        dict: file_path -> (recorded_at, device_id, upload_source); paths not found are omitted
+        (upload_source is None unless PRIORITY_SOURCE_COLUMN is set)
+    """
+    found = {}
+    unique_paths = list(dict.fromkeys(file_paths))
+    select = "file_path,recorded_at,device_id"
+    if PRIORITY_SOURCE_COLUMN:
+        select += f",{PRIORITY_SOURCE_COLUMN}"
+
+    for start in range(0, len(unique_paths), AUDIO_FILES_LOOKUP_CHUNK_SIZE):
+        chunk = unique_paths[start:start + AUDIO_FILES_LOOKUP_CHUNK_SIZE]
+        try:
+            response = supabase_session.get(
+                f"{SUPABASE_URL}/rest/v1/audio_files",
+                params={
+                    "file_path": format_in_filter(chunk),
+                    "select": select
+                },
+                timeout=10
+            )
+
+            if response.status_code != 200:
+                print(f"Error getting recorded_at: {response.status_code} {response.text}")
+                continue
+
+            for row in response.json():
+                found[row['file_path']] = (
+                    row.get('recorded_at'),
+                    row.get('device_id'),
+                    row.get(PRIORITY_SOURCE_COLUMN) if PRIORITY_SOURCE_COLUMN else None
+                )
+
+        except Exception as e:
+            print(f"Error getting recorded_at: {e}")
+
+    print(f"Found recorded_at for {len(found)}/{len(unique_paths)} file paths")
+    for file_path in unique_paths:
+        if file_path not in found:
+            print(f"Warning: Could not find recorded_at for file_path: {file_path}")
+
+    return found
+
+
+def format_in_filter(values):
+    """
+    PostgREST in.() filter with each value double-quoted, so commas, colons and
+    parentheses inside values are accepted
+    """
+    quoted = ','.join('"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"' for value in values)
+    return f"in.({quoted})"
+
+
+def build_feature_job(bucket_name, object_key, recorded_at, device_id, context):
+    """
+    Build the feature job for a single S3 object
+
+    Args:
+        bucket_name: S3 bucket name
+        object_key: S3 object key
+        recorded_at: recorded_at from audio_files (None if not found)
+        device_id: device_id from audio_files (None if not found)
+        context: Lambda context (aws_request_id is used as timestamp)
+
+    Returns:
+        job dict, or None if device_id cannot be determined
+    """
+    if not recorded_at or not device_id:
+        # Fallback: extract device_id from path if not found in DB
+        # Format: files/{device_id}/{date}/{time_slot}/audio.wav
+        parts = object_key.split('/')
+        if len(parts) >= 4:
+            device_id = parts[1]
+            print(f"Using device_id from path: {device_id}")
+        else:
+            print(f"Error: Cannot determine device_id and recorded_at for {object_key}")
+            return None
+
+    return {
+        'file_path': object_key,
+        'device_id': device_id,
+        'recorded_at': recorded_at,  # This is the key field for new pipeline
+        'bucket_name': bucket_name,
+        'timestamp': context.aws_request_id
+    }
+
+
+class UnsupportedWavFormatError(ValueError):
+    """
+    Valid WAV file in a sample format the decoder does not handle (e.g. 8/24-bit PCM)
     """
-    Get recorded_at from audio_files table using file_path
+
+
+def import_numpy():
+    """
+    Import numpy into the module namespace on first use
+    """
+    global np
+    if np is None:
+        import numpy
+        np = numpy
+
+
+def parse_wav_header(header):
+    """
+    Parse RIFF/WAVE header up to the start of the data chunk
 
     Args:
-        file_path: S3 file path (e.g., files/{device_id}/{date}/{time_slot}/audio.wav)
+        header: Leading bytes of the WAV file
 
     Returns:
-        recorded_at: UTC timestamp string or None if not found
+        (fmt dict, data_offset), or (None, None) if more bytes are needed
+
+    Raises:
+        UnsupportedWavFormatError: Valid WAV in a sample format that is not decoded
+        ValueError: Not a valid WAV file
+    """
+    if len(header) < 12:
+        return None, None
+    if header[:4] != b'RIFF' or header[8:12] != b'WAVE':
+        raise ValueError('Not a RIFF/WAVE file')
+
+    fmt = None
+    offset = 12
+    while offset + 8 <= len(header):
+        chunk_id = header[offset:offset + 4]
+        chunk_size = struct.unpack('<I', header[offset + 4:offset + 8])[0]
+
+        if chunk_id == b'data':
+            if fmt is None:
+                raise ValueError('data chunk before fmt chunk')
+            # Streamed WAVs may carry a placeholder size (0 or 0xFFFFFFFF)
+            byte_rate = fmt['sample_rate'] * fmt['block_align']
+            fmt['duration_sec'] = chunk_size / byte_rate if 0 < chunk_size < 0xFFFFFFFF and byte_rate else None
+            return fmt, offset + 8
+
+        if chunk_id == b'fmt ':
+            if offset + 8 + 16 > len(header):
+                return None, None
+            audio_format, channels, sample_rate, _, block_align, bits = struct.unpack(
+                '<HHIIHH', header[offset + 8:offset + 24]
+            )
+            if audio_format == 0xFFFE and offset + 8 + 26 <= len(header):
+                # WAVE_FORMAT_EXTENSIBLE: real format is the first 2 bytes of SubFormat
+                audio_format = struct.unpack('<H', header[offset + 32:offset + 34])[0]
+            if audio_format == 1 and bits in (16, 32):
+                dtype, scale = np.dtype(f'<i{bits // 8}'), float(2 ** (bits - 1))
+            elif audio_format == 3 and bits == 32:
+                dtype, scale = np.dtype('<f4'), 1.0
+            else:
+                raise UnsupportedWavFormatError(f'Unsupported WAV format: format={audio_format}, bits={bits}')
+            fmt = {
+                'channels': channels,
+                'sample_rate': sample_rate,
+                'block_align': block_align,
+                'dtype': dtype,
+                'scale': scale
+            }
+
+        # Chunks are word aligned
+        offset += 8 + chunk_size + (chunk_size & 1)
+
+    return None, None
+
+
+def iter_wav_samples(bucket_name, object_key):
     """
+    Stream a WAV object from S3 and yield mono float32 samples chunk by chunk
+    The file is never held in memory as a whole
+
+    Args:
+        bucket_name: S3 bucket name
+        object_key: S3 object key
+
+    Yields:
+        (fmt, samples): fmt dict from parse_wav_header, samples in [-1, 1]
+
+    Raises:
+        ValueError: Not a supported WAV file
+    """
+    body = s3.get_object(Bucket=bucket_name, Key=object_key)['Body']
+
+    header = b''
+    fmt = None
+    pending = b''
+
+    for chunk in body.iter_chunks(chunk_size=QC_CHUNK_BYTES):
+        if fmt is None:
+            header += chunk
+            fmt, data_offset = parse_wav_header(header)
+            if fmt is None:
+                if len(header) > QC_MAX_HEADER_BYTES:
+                    raise ValueError('data chunk not found in WAV header')
+                continue
+            chunk = header[data_offset:]
+
+        # Keep partial sample frames for the next chunk
+        data = pending + chunk
+        usable = len(data) - len(data) % fmt['block_align']
+        pending = data[usable:]
+        if not usable:
+            continue
+
+        samples = np.frombuffer(data[:usable], dtype=fmt['dtype']).astype(np.float32) / fmt['scale']
+        yield fmt, samples.reshape(-1, fmt['channels']).mean(axis=1)
+
+    if fmt is None:
+        raise ValueError('WAV file has no audio data')
+
+
+class AudioQualityMeter:
+    """
+    Accumulates QC metrics (RMS, clipping ratio, SNR proxy) over streamed samples
+    Only per-frame RMS values are kept in memory
+    """
+
+    def __init__(self, sample_rate):
+        self.sample_rate = sample_rate
+        self.frame_samples = max(1, int(sample_rate * QC_FRAME_MS / 1000))
+        self.leftover = np.empty(0, dtype=np.float32)
+        self.total_samples = 0
+        self.sum_squares = 0.0
+        self.clipped = 0
+        self.frame_rms = []
+
+    def update(self, samples):
+        self.total_samples += samples.size
+        self.sum_squares += float(np.dot(samples, samples))
+        self.clipped += int(np.count_nonzero(np.abs(samples) >= QC_CLIP_LEVEL))
+
+        # Frame-level RMS for the SNR proxy (incomplete frame carried over)
+        samples = np.concatenate((self.leftover, samples))
+        whole = samples.size - samples.size % self.frame_samples
+        if whole:
+            frames = samples[:whole].reshape(-1, self.frame_samples)
+            self.frame_rms.append(np.sqrt(np.mean(frames * frames, axis=1)))
+        self.leftover = samples[whole:]
+
+    def result(self):
+        """
+        Returns:
+            dict: duration_sec, rms_dbfs, clipping_ratio, snr_db
+
+        Raises:
+            ValueError: No samples were seen
+        """
+        if self.total_samples == 0:
+            raise ValueError('WAV file has no audio data')
+
+        rms = np.sqrt(self.sum_squares / self.total_samples)
+        metrics = {
+            'duration_sec': round(self.total_samples / self.sample_rate, 3),
+            'rms_dbfs': round(float(20 * np.log10(max(rms, 1e-10))), 2),
+            'clipping_ratio': round(self.clipped / self.total_samples, 6),
+            'snr_db': None
+        }
+
+        if self.frame_rms:
+            # SNR proxy: loud frames (speech/events) vs. quiet frames (noise floor)
+            energies = np.concatenate(self.frame_rms) ** 2
+            noise, signal = np.percentile(energies, [QC_NOISE_PERCENTILE, QC_SIGNAL_PERCENTILE])
+            metrics['snr_db'] = round(float(10 * np.log10(max(signal, 1e-20) / max(noise, 1e-20))), 2)
+
+        return metrics
+
+
+class StreamResampler:
+    """
+    Streaming resampler to CANONICAL_SAMPLE_RATE (windowed-sinc low-pass + linear interpolation)
+    Filter history and interpolation position are carried across chunks
+    """
+
+    def __init__(self, sample_rate):
+        self.ratio = sample_rate / CANONICAL_SAMPLE_RATE
+
+        # Low-pass before decimation (anti-aliasing)
+        self.taps = None
+        if self.ratio > 1:
+            cutoff = 0.45 / self.ratio
+            n = np.arange(CANONICAL_FILTER_TAPS) - (CANONICAL_FILTER_TAPS - 1) / 2
+            taps = 2 * cutoff * np.sinc(2 * cutoff * n) * np.hamming(CANONICAL_FILTER_TAPS)
+            self.taps = (taps / taps.sum()).astype(np.float32)
+            self.history = np.zeros(CANONICAL_FILTER_TAPS - 1, dtype=np.float32)
+
+        # Linear interpolation state: buffer starts at input index `base`
+        self.buffer = np.empty(0, dtype=np.float32)
+        self.base = 0
+        self.next_pos = 0.0
+
+    def process(self, samples):
+        if self.taps is not None:
+            padded = np.concatenate((self.history, samples))
+            self.history = padded[-(CANONICAL_FILTER_TAPS - 1):]
+            samples = np.convolve(padded, self.taps, mode='valid').astype(np.float32)
+
+        if self.ratio == 1:
+            return samples
+
+        buffer = np.concatenate((self.buffer, samples))
+        last = self.base + buffer.size - 1
+        count = int((last - self.next_pos) // self.ratio) + 1 if self.next_pos <= last else 0
+        positions = self.next_pos + self.ratio * np.arange(count)
+        output = np.interp(positions - self.base, np.arange(buffer.size), buffer).astype(np.float32)
+        self.next_pos += count * self.ratio
+        drop = min(int(self.next_pos) - self.base, buffer.size)
+        self.buffer = buffer[drop:]
+        self.base += drop
+        return output
+
+
+class CanonicalAudioWriter:
+    """
+    Writes streamed CANONICAL_SAMPLE_RATE mono samples to S3 as raw little-endian
+    float32 (f32) or int16 (i16), via multipart upload for long files
+    """
+
+    def __init__(self, bucket_name, key):
+        self.bucket_name = bucket_name
+        self.key = key
+        self.dtype = np.dtype('<f4') if CANONICAL_AUDIO_FORMAT == 'f32' else np.dtype('<i2')
+        self.pending = bytearray()
+        self.upload_id = None
+        self.parts = []
+        self.sample_count = 0
+
+    def update(self, samples):
+        if self.dtype == np.dtype('<i2'):
+            samples = np.clip(samples * 32767, -32768, 32767)
+        self.pending += samples.astype(self.dtype).tobytes()
+        self.sample_count += samples.size
+
+        if len(self.pending) >= CANONICAL_PART_BYTES:
+            self._upload_part()
+
+    def _upload_part(self):
+        if self.upload_id is None:
+            self.upload_id = s3.create_multipart_upload(
+                Bucket=self.bucket_name,
+                Key=self.key,
+                ContentType='application/octet-stream',
+                Metadata=self.metadata()
+            )['UploadId']
+        part_number = len(self.parts) + 1
+        response = s3.upload_part(
+            Bucket=self.bucket_name,
+            Key=self.key,
+            UploadId=self.upload_id,
+            PartNumber=part_number,
+            Body=bytes(self.pending)
+        )
+        self.parts.append({'ETag': response['ETag'], 'PartNumber': part_number})
+        self.pending = bytearray()
+
+    def metadata(self):
+        return {
+            'sample-rate': str(CANONICAL_SAMPLE_RATE),
+            'channels': '1',
+            'dtype': CANONICAL_AUDIO_FORMAT
+        }
+
+    def close(self):
+        """
+        Finish the upload
+
+        Returns:
+            dict describing the artifact (added to the SQS message as canonical_audio)
+        """
+        if self.upload_id is None:
+            s3.put_object(
+                Bucket=self.bucket_name,
+                Key=self.key,
+                Body=bytes(self.pending),
+                ContentType='application/octet-stream',
+                Metadata=self.metadata()
+            )
+        else:
+            if self.pending:
+                self._upload_part()
+            s3.complete_multipart_upload(
+                Bucket=self.bucket_name,
+                Key=self.key,
+                UploadId=self.upload_id,
+                MultipartUpload={'Parts': self.parts}
+            )
+
+        return {
+            'key': self.key,
+            'sample_rate': CANONICAL_SAMPLE_RATE,
+            'channels': 1,
+            'dtype': 'float32' if CANONICAL_AUDIO_FORMAT == 'f32' else 'int16',
+            'byte_order': 'little',
+            'sample_count': self.sample_count
+        }
+
+    def abort(self):
+        if self.upload_id is not None:
+            try:
+                s3.abort_multipart_upload(Bucket=self.bucket_name, Key=self.key, UploadId=self.upload_id)
+            except Exception as e:
+                print(f"Warning: Failed to abort multipart upload for {self.key}: {e}")
+
+
+def get_canonical_audio_key(object_key):
+    """
+    Canonical artifact key next to the original (files/.../audio.wav -> files/.../audio.16k.f32)
+    """
+    return f"{os.path.splitext(object_key)[0]}.{CANONICAL_SAMPLE_RATE // 1000}k.{CANONICAL_AUDIO_FORMAT}"
+
+
+def is_derived_audio_key(object_key):
+    """
+    True for objects written by this Lambda (canonical artifact)
+    """
+    return object_key.endswith(CANONICAL_AUDIO_SUFFIXES)
+
+
+def get_qc_verdict(metrics):
+    """
+    Decide the QC verdict from metrics and configured thresholds
+
+    Returns:
+        'passed', 'silent', 'clipped' or 'low_snr'
+    """
+    if metrics['rms_dbfs'] < QC_MIN_RMS_DBFS:
+        return 'silent'
+    if metrics['clipping_ratio'] > QC_MAX_CLIPPING_RATIO:
+        return 'clipped'
+    if metrics['snr_db'] is not None and metrics['snr_db'] < QC_MIN_SNR_DB:
+        return 'low_snr'
+    return 'passed'
+
+
+def preprocess_audio(job, run_qc, write_canonical):
+    """
+    Decode the WAV once and feed the QC meter and/or the canonical artifact writer
+    QC verdict is recorded in audio_files
+
+    Args:
+        job: Feature job dict
+        run_qc: Compute the QC verdict
+        write_canonical: Write the 16 kHz mono canonical artifact
+
+    Returns:
+        dict: qc_status (None if QC could not run, 'skipped' for a WAV format it cannot
+        decode), qc_metrics, canonical_audio (or None)
+    """
+    outcome = {'qc_status': None, 'qc_metrics': None, 'canonical_audio': None}
+    meter = None
+    resampler = None
+    writer = None
+    started = False
+
     try:
-        response = requests.get(
+        import_numpy()
+        for fmt, samples in iter_wav_samples(job['bucket_name'], job['file_path']):
+            if not started:
+                started = True
+                if run_qc:
+                    meter = AudioQualityMeter(fmt['sample_rate'])
+                if write_canonical:
+                    writer = CanonicalAudioWriter(job['bucket_name'], get_canonical_audio_key(job['file_path']))
+                    resampler = StreamResampler(fmt['sample_rate'])
+
+            if meter:
+                meter.update(samples)
+            if writer:
+                writer.update(resampler.process(samples))
+
+        if run_qc:
+            if meter is None:
+                raise ValueError('WAV file has no audio data')
+            outcome['qc_metrics'] = meter.result()
+            outcome['qc_status'] = get_qc_verdict(outcome['qc_metrics'])
+        if writer:
+            try:
+                outcome['canonical_audio'] = writer.close()
+                print(f"Canonical audio written: {outcome['canonical_audio']['key']}")
+            except Exception as e:
+                writer.abort()
+                print(f"Warning: Canonical audio upload failed for {job['file_path']}: {e}")
+
+    except UnsupportedWavFormatError as e:
+        # Not corrupt: the stage APIs decode more formats than this Lambda, so fan out
+        if writer:
+            writer.abort()
+        print(f"Warning: Audio preprocessing skipped for {job['file_path']}: {e}")
+        if not run_qc:
+            return outcome
+        outcome = {'qc_status': 'skipped', 'qc_metrics': {'error': str(e)}, 'canonical_audio': None}
+
+    except ValueError as e:
+        if writer:
+            writer.abort()
+        if not run_qc:
+            print(f"Warning: Audio preprocessing skipped for {job['file_path']}: {e}")
+            return outcome
+        outcome['qc_metrics'] = {'error': str(e)}
+        outcome['qc_status'] = 'corrupt'
+
+    except Exception as e:
+        # S3/network errors must not block the pipeline
+        if writer:
+            writer.abort()
+        print(f"Warning: Audio preprocessing skipped for {job['file_path']}: {e}")
+        return {'qc_status': None, 'qc_metrics': None, 'canonical_audio': None}
+
+    if run_qc:
+        print(f"QC {outcome['qc_status']} for {job['file_path']}: {json.dumps(outcome['qc_metrics'])}")
+        update_audio_file_qc(job['file_path'], outcome['qc_status'], outcome['qc_metrics'])
+
+    return outcome
+
+
+def update_audio_file_qc(file_path, verdict, metrics):
+    """
+    Record QC verdict and metrics in audio_files (qc_status, qc_metrics)
+    """
+    try:
+        response = supabase_session.patch(
             f"{SUPABASE_URL}/rest/v1/audio_files",
+            params={"file_path": f"eq.{file_path}"},
+            json={"qc_status": verdict, "qc_metrics": metrics},
+            headers={"Prefer": "return=minimal"},
+            timeout=10
+        )
+        if response.status_code not in (200, 204):
+            print(f"Warning: Failed to record QC for {file_path}: {response.status_code} {response.text}")
+    except Exception as e:
+        print(f"Warning: Failed to record QC for {file_path}: {e}")
+
+
+class SupabaseContentIndex:
+    """
+    Content dedup index stored in Supabase (audio_content_index table)
+    """
+
+    def lookup(self, content_keys, now):
+        found = {}
+        for start in range(0, len(content_keys), AUDIO_FILES_LOOKUP_CHUNK_SIZE):
+            chunk = content_keys[start:start + AUDIO_FILES_LOOKUP_CHUNK_SIZE]
+            response = supabase_session.get(
+                f"{SUPABASE_URL}/rest/v1/audio_content_index",
+                params={
+                    "content_key": format_in_filter(chunk),
+                    "expires_at": f"gt.{now.isoformat()}",
+                    "select": "content_key,device_id,recorded_at,file_path"
+                },
+                timeout=10
+            )
+            if response.status_code != 200:
+                raise RuntimeError(f"{response.status_code} {response.text}")
+            for row in response.json():
+                found[row['content_key']] = row
+        return found
+
+    def register(self, entries):
+        response = supabase_session.post(
+            f"{SUPABASE_URL}/rest/v1/audio_content_index",
+            params={"on_conflict": "content_key"},
+            json=entries,
+            headers={"Prefer": "resolution=merge-duplicates,return=minimal"},
+            timeout=10
+        )
+        if response.status_code not in (200, 201, 204):
+            raise RuntimeError(f"{response.status_code} {response.text}")
+
+
+class SQLiteContentIndex:
+    """
+    Local stand-in for the content dedup index (same interface, SQLite file)
+    """
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS audio_content_index ("
+            "content_key TEXT PRIMARY KEY, device_id TEXT, recorded_at TEXT, "
+            "file_path TEXT, expires_at TEXT)"
+        )
+
+    def lookup(self, content_keys, now):
+        placeholders = ','.join('?' * len(content_keys))
+        rows = self.conn.execute(
+            "SELECT content_key, device_id, recorded_at, file_path FROM audio_content_index "
+            f"WHERE content_key IN ({placeholders}) AND expires_at > ?",
+            [*content_keys, now.isoformat()]
+        ).fetchall()
+        return {
+            row[0]: {'content_key': row[0], 'device_id': row[1], 'recorded_at': row[2], 'file_path': row[3]}
+            for row in rows
+        }
+
+    def register(self, entries):
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO audio_content_index "
+                "(content_key, device_id, recorded_at, file_path, expires_at) "
+                "VALUES (:content_key, :device_id, :recorded_at, :file_path, :expires_at)",
+                entries
+            )
+
+
+def get_content_index():
+    """
+    Return the content dedup index for this container (created once)
+    """
+    global content_index
+    if content_index is None:
+        if CONTENT_DEDUP_BACKEND == 'sqlite':
+            content_index = SQLiteContentIndex(CONTENT_DEDUP_SQLITE_PATH)
+        else:
+            content_index = SupabaseContentIndex()
+    return content_index
+
+
+def get_content_key(job, etag):
+    """
+    Build the content-addressed dedup key for one uploaded object
+
+    Args:
+        job: Feature job dict
+        etag: S3 ETag from the event record (None if missing)
+
+    Returns:
+        "{device_id}:{etag|sha256}:{hex}" or None if the content hash is unavailable
+    """
+    if CONTENT_DEDUP_KEY == 'sha256':
+        # Streamed SHA-256 of the object body (never loaded as a whole)
+        digest = hashlib.sha256()
+        body = s3.get_object(Bucket=job['bucket_name'], Key=job['file_path'])['Body']
+        for chunk in body.iter_chunks(chunk_size=QC_CHUNK_BYTES):
+            digest.update(chunk)
+        return f"{job['device_id']}:sha256:{digest.hexdigest()}"
+
+    if not etag:
+        return None
+    return f"{job['device_id']}:etag:{etag.strip(chr(34))}"
+
+
+def find_duplicate_uploads(jobs, etags, stages):
+    """
+    Look up already processed audio content for the given jobs
+
+    A job is a duplicate only when the earlier upload of the same content is the same
+    recording (device_id and recorded_at) and its stages are completed or still in
+    progress in spot_features (see is_earlier_fanout_live). Same content under another
+    recording is fanned out again, because the results are stored per recording and
+    nothing would fill the new one.
+
+    Args:
+        jobs: List of (index, job) tuples
+        etags: dict index -> S3 ETag
+        stages: Stage registry
+
+    Returns:
+        (content_keys, duplicates): dict index -> content key,
+        dict index -> earlier recording ({device_id, recorded_at, file_path})
+    """
+    content_keys = {}
+    for index, job in jobs:
+        try:
+            content_key = get_content_key(job, etags.get(index))
+        except Exception as e:
+            print(f"Warning: Could not hash {job['file_path']}: {e}")
+            continue
+        if content_key:
+            content_keys[index] = content_key
+
+    duplicates = {}
+    if not content_keys:
+        return content_keys, duplicates
+
+    try:
+        known = get_content_index().lookup(
+            list(dict.fromkeys(content_keys.values())), datetime.now(timezone.utc)
+        )
+    except Exception as e:
+        # Index unavailable: fall back to FIFO deduplication only
+        print(f"Warning: Content dedup lookup failed: {e}")
+        return content_keys, duplicates
+
+    fanned_out = {}
+    for index, job in jobs:
+        content_key = content_keys.get(index)
+        if not content_key:
+            continue
+        row = known.get(content_key)
+        earlier_uploads = ([row] if row else []) + fanned_out.get(content_key, [])
+        earlier = next((upload for upload in earlier_uploads if is_same_recording(upload, job)), None)
+        # A copy earlier in this event is being sent now; only index entries need checking
+        if earlier and earlier is row and not is_earlier_fanout_live(earlier, job, stages):
+            print(f"Earlier fan-out of {earlier['file_path']} has failed or missing results, fanning out {job['file_path']}")
+            earlier = None
+        if earlier:
+            # Retried PUT / re-upload of a recording that was already fanned out
+            # (or the same object twice in this event)
+            duplicates[index] = {
+                'device_id': earlier['device_id'],
+                'recorded_at': earlier['recorded_at'],
+                'file_path': earlier['file_path']
+            }
+            continue
+        if earlier_uploads:
+            print(f"Same audio content as {earlier_uploads[0]['file_path']} under another recording, fanning out {job['file_path']}")
+        fanned_out.setdefault(content_key, []).append(job)
+
+    return content_keys, duplicates
+
+
+def is_same_recording(earlier, job):
+    """
+    True if both refer to the same recording (device_id and recorded_at, any ISO 8601 form)
+    """
+    if earlier['device_id'] != job['device_id'] or not earlier['recorded_at'] or not job['recorded_at']:
+        return False
+    try:
+        return (
+            datetime.fromisoformat(str(earlier['recorded_at']).replace('Z', '+00:00'))
+            == datetime.fromisoformat(str(job['recorded_at']).replace('Z', '+00:00'))
+        )
+    except ValueError:
+        return earlier['recorded_at'] == job['recorded_at']
+
+
+def get_stage_statuses(device_id, recorded_at):
+    """
+    Feature stage statuses of one recording from spot_features
+
+    Returns:
+        dict: status field -> status ({} if the row does not exist), or None if the query failed
+    """
+    try:
+        response = supabase_session.get(
+            f"{SUPABASE_URL}/rest/v1/spot_features",
             params={
-                "file_path": f"eq.{file_path}",
-                "select": "recorded_at,device_id"
+                "device_id": f"eq.{device_id}",
+                "recorded_at": f"eq.{recorded_at}",
+                "select": ','.join(FEATURE_STATUS_FIELDS.values())
             },
-            headers={
-                "apikey": SUPABASE_KEY,
-                "Authorization": f"Bearer {SUPABASE_KEY}"
+            timeout=10
+        )
+        if response.status_code != 200:
+            print(f"Warning: Failed to get stage statuses: {response.status_code} {response.text}")
+            return None
+        data = response.json()
+        return data[0] if data else {}
+    except Exception as e:
+        print(f"Warning: Failed to get stage statuses: {e}")
+        return None
+
+
+def is_earlier_fanout_live(earlier, job, stages):
+    """
+    True if every stage this job would be sent to is pending, processing or completed
+    for the earlier recording
+
+    The index is written when the fan-out is queued, so it says nothing about the outcome.
+    A failed stage, a recording with no spot_features row or a failed lookup means there
+    may be nothing to reuse: the job is fanned out again (FIFO deduplication still drops
+    it within 5 minutes of the earlier send).
+    """
+    fields = [
+        FEATURE_STATUS_FIELDS[stage['api_type']]
+        for stage in stages
+        if stage['api_type'] in FEATURE_STATUS_FIELDS and stage_applies(stage, job)
+    ]
+    if not fields:
+        return True
+
+    statuses = get_stage_statuses(earlier['device_id'], earlier['recorded_at'])
+    if statuses is None:
+        return False
+    return all(statuses.get(field) in CONTENT_DEDUP_LIVE_STATUSES for field in fields)
+
+
+def register_content_keys(entries):
+    """
+    Record fanned-out content in the dedup index (expires after CONTENT_DEDUP_TTL_HOURS)
+    """
+    if not entries:
+        return
+
+    expires_at = (datetime.now(timezone.utc) + timedelta(hours=CONTENT_DEDUP_TTL_HOURS)).isoformat()
+    try:
+        get_content_index().register([{**entry, 'expires_at': expires_at} for entry in entries])
+    except Exception as e:
+        print(f"Warning: Content dedup register failed: {e}")
+
+
+def get_default_stage_registry():
+    """
+    Stage registry built from the legacy queue URL environment variables
+    """
+    return [
+        {
+            'label': label,
+            'api_type': api_type,
+            'queue_url': queue_url,
+            'bulk_queue_url': bulk_queue_url or queue_url,
+            'group_id_template': f"{{device_id}}-{api_type}",
+            'group_id_strategy': GROUP_ID_STRATEGY,
+            'group_shards': GROUP_ID_SHARDS,
+            'enabled': True,
+            'device_allow': [],
+            'device_deny': sorted(DEMO_DEVICE_IDS),
+            'sampling_rate': 1.0
+        }
+        for label, api_type, queue_url, bulk_queue_url in FEATURE_QUEUES
+    ]
+
+
+def normalize_stage(stage):
+    """
+    Fill defaults for one stage registry entry
+
+    Raises:
+        ValueError: api_type or queue_url is missing, group_id_strategy is unknown or
+        group_id_template uses a field other than device_id / recorded_at / file_path
+    """
+    if not stage.get('api_type') or not stage.get('queue_url'):
+        raise ValueError(f"Stage requires api_type and queue_url: {json.dumps(stage)}")
+    if stage.get('group_id_strategy', GROUP_ID_STRATEGY) not in GROUP_ID_STRATEGIES:
+        raise ValueError(f"Unknown group_id_strategy: {json.dumps(stage)}")
+
+    api_type = stage['api_type']
+    group_id_template = stage.get('group_id_template') or f"{{device_id}}-{api_type}"
+    try:
+        group_id_template.format(device_id='', recorded_at='', file_path='')
+    except (KeyError, IndexError, ValueError) as e:
+        raise ValueError(f"Invalid group_id_template ({e!r}): {json.dumps(stage)}")
+
+    return {
+        'label': stage.get('label', api_type.upper()),
+        'api_type': api_type,
+        'queue_url': stage['queue_url'],
+        'bulk_queue_url': stage.get('bulk_queue_url') or stage['queue_url'],
+        'group_id_template': group_id_template,
+        'group_id_strategy': stage.get('group_id_strategy') or GROUP_ID_STRATEGY,
+        'group_shards': max(1, int(stage.get('group_shards') or GROUP_ID_SHARDS)),
+        'enabled': bool(stage.get('enabled', True)),
+        'device_allow': list(stage.get('device_allow') or []),
+        'device_deny': list(stage.get('device_deny') or []),
+        'sampling_rate': float(stage.get('sampling_rate', 1.0))
+    }
+
+
+def load_stage_registry():
+    """
+    Load stage definitions from STAGE_REGISTRY_SOURCE
+
+    Sources:
+        env: ASR/SED/SER_QUEUE_URL (+ DEMO_DEVICE_IDS as deny list)
+        json: STAGE_REGISTRY_JSON (inline JSON or a file path), {"stages": [...]} or [...]
+        supabase: pipeline_stage_registry table (one row per stage)
+    """
+    if STAGE_REGISTRY_SOURCE == 'json':
+        raw = STAGE_REGISTRY_JSON
+        if not raw.lstrip().startswith(('{', '[')):
+            with open(raw) as f:
+                raw = f.read()
+        document = json.loads(raw)
+        stages = document.get('stages', []) if isinstance(document, dict) else document
+    elif STAGE_REGISTRY_SOURCE == 'supabase':
+        response = supabase_session.get(
+            f"{SUPABASE_URL}/rest/v1/pipeline_stage_registry",
+            params={
+                "select": "label,api_type,queue_url,bulk_queue_url,group_id_template,group_id_strategy,group_shards,enabled,device_allow,device_deny,sampling_rate",
+                "order": "api_type.asc"
             },
             timeout=10
         )
+        if response.status_code != 200:
+            raise RuntimeError(f"{response.status_code} {response.text}")
+        stages = response.json()
+    else:
+        return get_default_stage_registry()
 
-        if response.status_code == 200:
-            data = response.json()
-            if data and len(data) > 0:
-                recorded_at = data[0].get('recorded_at')
-                device_id = data[0].get('device_id')
-                print(f"Found recorded_at: {recorded_at} for device: {device_id}")
-                return recorded_at, device_id
+    return [normalize_stage(stage) for stage in stages]
 
-        print(f"Warning: Could not find recorded_at for file_path: {file_path}")
-        return None, None
 
+def get_stage_registry():
+    """
+    Return the stage registry, reloading it at most every STAGE_REGISTRY_TTL_SECONDS
+    The last good registry (or the env default) is kept if a reload fails
+    """
+    global stage_registry, stage_registry_loaded_at
+    now = time.monotonic()
+
+    if stage_registry is None or now - stage_registry_loaded_at >= STAGE_REGISTRY_TTL_SECONDS:
+        try:
+            stage_registry = load_stage_registry()
+            print(f"Loaded stage registry ({STAGE_REGISTRY_SOURCE}): {json.dumps(stage_registry)}")
+        except Exception as e:
+            print(f"Warning: Failed to load stage registry ({STAGE_REGISTRY_SOURCE}): {e}")
+            if stage_registry is None:
+                stage_registry = get_default_stage_registry()
+        stage_registry_loaded_at = now
+
+    return stage_registry
+
+
+def stage_applies(stage, job):
+    """
+    Check whether a stage should receive this job (enabled, allow/deny lists, sampling)
+    Sampling is deterministic per recording so retries make the same decision
+    """
+    device_id = job['device_id']
+
+    if not stage['enabled']:
+        return False
+    if stage['device_allow'] and device_id not in stage['device_allow']:
+        return False
+    if device_id in stage['device_deny']:
+        return False
+    if stage['sampling_rate'] >= 1.0:
+        return True
+
+    digest = hashlib.sha256(f"{device_id}-{job['recorded_at']}-{stage['api_type']}".encode()).hexdigest()
+    return int(digest[:8], 16) / 0x100000000 < stage['sampling_rate']
+
+
+def get_priority_lane(job, upload_source):
+    """
+    Classify an upload into the interactive lane (record now, see result now)
+    or the bulk lane (camera-roll / wearable imports)
+
+    Args:
+        job: Feature job dict
+        upload_source: Source from audio_files (None if unknown)
+
+    Returns:
+        (lane, source)
+    """
+    source = upload_source
+
+    if not source and PRIORITY_METADATA_KEY:
+        try:
+            metadata = s3.head_object(Bucket=job['bucket_name'], Key=job['file_path']).get('Metadata', {})
+            source = metadata.get(PRIORITY_METADATA_KEY)
+        except Exception as e:
+            print(f"Warning: Could not read metadata for {job['file_path']}: {e}")
+
+    if not source and BULK_KEY_PREFIXES and job['file_path'].startswith(BULK_KEY_PREFIXES):
+        source = 'import'
+
+    return ('bulk' if source in BULK_SOURCES else 'interactive'), source
+
+
+def get_message_group_id(stage, job):
+    """
+    FIFO MessageGroupId of one job for a stage (see GROUP_ID_STRATEGY)
+    Recordings of one group are processed strictly one at a time; different groups in parallel.
+    The shard is a stable hash of the recording, so retries land in the same group.
+    """
+    group_id = stage['group_id_template'].format(**job)
+
+    if stage['group_id_strategy'] == 'device':
+        return group_id
+
+    digest = hashlib.sha256(f"{job['device_id']}-{job['recorded_at']}".encode()).hexdigest()
+    if stage['group_id_strategy'] == 'recording':
+        return f"{group_id}-{digest[:16]}"
+    if stage['group_shards'] <= 1:
+        return group_id
+    return f"{group_id}-s{int(digest[:8], 16) % stage['group_shards']}"
+
+
+def build_stage_message(stage, job):
+    """
+    Build the SQS entry of one stage for one job (without the batch 'Id')
+    """
+    return {
+        'MessageBody': json.dumps(job),
+        'MessageGroupId': get_message_group_id(stage, job),
+        'MessageDeduplicationId': get_deduplication_id(job['device_id'], job['recorded_at'], stage['api_type'])
+    }
+
+
+def send_feature_batches(stage, lane, jobs):
+    """
+    Send one feature stage's messages with SendMessageBatch (max 10 entries per call)
+
+    Args:
+        stage: Stage registry entry (label, api_type, queue_url, bulk_queue_url, group_id_template)
+        lane: Priority lane ('interactive' or 'bulk'), selects the queue
+        jobs: List of (index, job) tuples
+
+    Returns:
+        (message_ids, errors): dicts keyed by job index
+    """
+    label = stage['label'] if lane == 'interactive' else f"{stage['label']} ({lane})"
+    queue_url = stage['bulk_queue_url'] if lane == 'bulk' else stage['queue_url']
+    message_ids = {}
+    errors = {}
+    messages = []
+    for index, job in jobs:
+        try:
+            messages.append((index, build_stage_message(stage, job)))
+        except (KeyError, IndexError, ValueError) as e:
+            # A bad group_id_template fails only this stage of the job
+            print(f"Error building {label} message for {job['file_path']}: {e!r}")
+            errors[index] = f"Invalid group_id_template: {e!r}"
+
+    for start in range(0, len(messages), SQS_BATCH_SIZE):
+        chunk = messages[start:start + SQS_BATCH_SIZE]
+        entries = [{'Id': str(position), **entry} for position, (_, entry) in enumerate(chunk)]
+
+        try:
+            response = sqs.send_message_batch(QueueUrl=queue_url, Entries=entries)
+        except Exception as e:
+            print(f"Error sending batch to {label} FIFO queue: {e}")
+            for index, _ in chunk:
+                errors[index] = str(e)
+            continue
+
+        for entry in response.get('Successful', []):
+            index = chunk[int(entry['Id'])][0]
+            message_ids[index] = entry['MessageId']
+        for entry in response.get('Failed', []):
+            index = chunk[int(entry['Id'])][0]
+            errors[index] = f"{entry.get('Code')}: {entry.get('Message')}"
+
+        print(f"Batch sent to {label} FIFO queue: {len(response.get('Successful', []))} succeeded, {len(response.get('Failed', []))} failed")
+
+    return message_ids, errors
+
+
+def wait_before_retry(attempt, context):
+    """
+    Back off before a re-submitted attempt, leaving time for the fan-out itself
+    """
+    delay = FANOUT_RETRY_DELAY_SECONDS * 2 ** (attempt - 1)
+    delay = max(0.0, min(delay, context.get_remaining_time_in_millis() / 1000 - 15))
+    print(f"Fan-out retry attempt {attempt}/{FANOUT_RETRY_MAX_ATTEMPTS}, waiting {delay:.1f}s")
+    time.sleep(delay)
+
+
+def resubmit_failed_records(records, attempt, context):
+    """
+    Re-submit records to this function as a new asynchronous event holding only them
+
+    Args:
+        records: S3 event records whose fan-out failed
+        attempt: Attempt number of the new event (1 for the first retry)
+        context: Lambda context (invoked_function_arn)
+
+    Returns:
+        True if Lambda accepted the event
+    """
+    try:
+        response = lambda_client.invoke(
+            FunctionName=context.invoked_function_arn,
+            InvocationType='Event',
+            Payload=json.dumps({'Records': records, 'fanoutRetry': {'attempt': attempt}}).encode()
+        )
     except Exception as e:
-        print(f"Error getting recorded_at: {e}")
-        return None, None
+        print(f"Error re-submitting {len(records)} S3 records: {e}")
+        return False
+
+    if response.get('StatusCode') != 202:
+        print(f"Error re-submitting {len(records)} S3 records: status {response.get('StatusCode')}")
+        return False
+
+    print(f"Re-submitted {len(records)} S3 records for fan-out retry (attempt {attempt}/{FANOUT_RETRY_MAX_ATTEMPTS})")
+    return True
 
 
 def lambda_handler(event, context):
     """
-    Receive S3 event and send to 3 SQS queues for parallel processing
+    Receive S3 event and send to the feature SQS queues for parallel processing
     Processing time: 1-2 seconds
 
     Flow:
-    1. S3 event triggers this Lambda
-    2. Query audio_files table to get recorded_at
-    3. Send message to 3 SQS queues (ASR, SED, SER) in parallel
+    1. S3 event triggers this Lambda (every record of the event is processed)
+    2. Query audio_files table once (in.() query) to get recorded_at for all objects
+    3. (CONTENT_DEDUP_ENABLED) Skip audio whose content was already processed
+    4. (QC_ENABLED / CANONICAL_AUDIO_ENABLED) Decode each WAV once while streaming it:
+       skip fan-out for silent/clipped/noisy/corrupt audio and write the 16 kHz artifact
+    5. Send messages to the applicable stage queues (stage registry) concurrently with SendMessageBatch
+
+    A record is queued only when all its stages succeed. Records with failedStages are
+    re-submitted to this function as {'Records': [...], 'fanoutRetry': {'attempt': n}}
+    (only those records, up to FANOUT_RETRY_MAX_ATTEMPTS), each with fanoutRetryStages
+    listing the api_types to send again; stages that were sent are not repeated. If re-submission fails or the
+    attempts are used up, FanOutError is raised so Lambda's async retry applies.
+    Records that cannot be processed at all (malformed, no device_id) are only reported.
     """
 
     print(f"Received S3 event: {json.dumps(event)}")
 
-    # SQS client
-    sqs = boto3.client('sqs', region_name='ap-southeast-2')
+    records = event.get('Records', [])
+    attempt = int(event.get('fanoutRetry', {}).get('attempt', 0))
+    if attempt:
+        wait_before_retry(attempt, context)
+    results = [None] * len(records)
+    objects = {}
+    etags = {}
+    retry_stages = {}
+    jobs = []
 
-    try:
-        # Extract information from S3 event
-        s3_record = event['Records'][0]['s3']
-        bucket_name = s3_record['bucket']['name']
-        object_key = unquote_plus(s3_record['object']['key'])
+    for index, record in enumerate(records):
+        try:
+            s3_record = record['s3']
+            bucket_name = s3_record['bucket']['name']
+            object_key = unquote_plus(s3_record['object']['key'])
+        except Exception as e:
+            print(f"Error processing S3 record: {str(e)}")
+            results[index] = {'status': 'failed', 'error': str(e)}
+            continue
+
+        if is_derived_audio_key(object_key):
+            # Our own artifacts (written next to the original): never fan out
+            print(f"Ignoring derived audio object: {bucket_name}/{object_key}")
+            results[index] = {'file_path': object_key, 'status': 'ignored'}
+            continue
 
         print(f"Processing S3 object: {bucket_name}/{object_key}")
+        objects[index] = (bucket_name, object_key)
+        etags[index] = s3_record['object'].get('eTag')
+        if 'fanoutRetryStages' in record:
+            # Re-submitted record: only the stages whose send failed
+            retry_stages[index] = set(record['fanoutRetryStages'])
 
-        # Get recorded_at from audio_files table
-        recorded_at, device_id = get_recorded_at_from_audio_files(object_key)
+    # Get recorded_at for all objects from audio_files table
+    audio_files = get_recorded_at_from_audio_files([object_key for _, object_key in objects.values()])
 
-        if not recorded_at or not device_id:
-            # Fallback: extract device_id from path if not found in DB
-            # Format: files/{device_id}/{date}/{time_slot}/audio.wav
-            parts = object_key.split('/')
-            if len(parts) >= 4:
-                device_id = parts[1]
-                print(f"Using device_id from path: {device_id}")
-            else:
-                print(f"Error: Cannot determine device_id and recorded_at for {object_key}")
-                return {'statusCode': 400, 'body': 'Cannot determine device_id and recorded_at'}
-
-        # Prepare SQS message with recorded_at
-        message = {
-            'file_path': object_key,
-            'device_id': device_id,
-            'recorded_at': recorded_at,  # This is the key field for new pipeline
-            'bucket_name': bucket_name,
-            'timestamp': context.aws_request_id
+    for index, (bucket_name, object_key) in objects.items():
+        recorded_at, device_id, upload_source = audio_files.get(object_key, (None, None, None))
+        job = build_feature_job(bucket_name, object_key, recorded_at, device_id, context)
+
+        if job is None:
+            results[index] = {'status': 'failed', 'error': 'Cannot determine device_id and recorded_at'}
+            continue
+
+        lane, source = get_priority_lane(job, upload_source)
+        job['priority_lane'] = lane
+        if source:
+            job['upload_source'] = source
+
+        jobs.append((index, job))
+
+    # api_types each job is fanned out to (enabled flag, device allow/deny lists, sampling)
+    stages = get_stage_registry()
+
+    content_keys = {}
+    if CONTENT_DEDUP_ENABLED and jobs:
+        content_keys, duplicates = find_duplicate_uploads(jobs, etags, stages)
+        for index, job in jobs:
+            if index in duplicates:
+                print(f"Duplicate audio content for {job['file_path']}, already processed as {json.dumps(duplicates[index])}")
+                results[index] = {
+                    'file_path': job['file_path'],
+                    'device_id': job['device_id'],
+                    'recorded_at': job['recorded_at'],
+                    'status': 'duplicate',
+                    'duplicateOf': duplicates[index]
+                }
+        jobs = [(index, job) for index, job in jobs if index not in duplicates]
+
+    job_stages = {
+        index: {stage['api_type'] for stage in stages if stage_applies(stage, job)}
+        for index, job in jobs
+    }
+    for index in job_stages:
+        if index in retry_stages:
+            job_stages[index] &= retry_stages[index]
+    qc_verdicts = {}
+    preprocess_jobs = [(index, job) for index, job in jobs if job_stages[index]]
+
+    if (QC_ENABLED or CANONICAL_AUDIO_ENABLED) and preprocess_jobs:
+        with ThreadPoolExecutor(max_workers=min(len(preprocess_jobs), 4)) as executor:
+            outcomes = list(executor.map(
+                lambda item: preprocess_audio(item[1], QC_ENABLED, CANONICAL_AUDIO_ENABLED),
+                preprocess_jobs
+            ))
+
+        for (index, job), outcome in zip(preprocess_jobs, outcomes):
+            if outcome['canonical_audio']:
+                # Downstream APIs can mmap / ranged-GET this instead of decoding again
+                job['canonical_audio'] = outcome['canonical_audio']
+            if QC_ENABLED:
+                qc_verdicts[index] = outcome['qc_status']
+                if outcome['qc_status'] not in (None, 'passed', 'skipped'):
+                    job_stages[index] &= QC_FALLBACK_STAGES
+
+    # Send to the stage FIFO SQS queues concurrently, up to 10 messages per call
+    message_ids = {index: {} for index, _ in jobs}
+    failed_stages = {index: {} for index, _ in jobs}
+    failed_api_types = {index: set() for index, _ in jobs}
+    enqueued_at = datetime.now(timezone.utc).isoformat()
+    for _, job in jobs:
+        # Lets workers measure queue wait per lane (end-to-end latency target)
+        job['enqueued_at'] = enqueued_at
+
+    stage_jobs = []
+    for stage in stages:
+        jobs_for_stage = [(index, job) for index, job in jobs if stage['api_type'] in job_stages[index]]
+        if stage['bulk_queue_url'] == stage['queue_url']:
+            # No separate bulk queue: one batch stream for both lanes
+            stage_jobs.append((stage, 'interactive', jobs_for_stage))
+            continue
+        for lane in ('interactive', 'bulk'):
+            stage_jobs.append((stage, lane, [
+                (index, job) for index, job in jobs_for_stage if job['priority_lane'] == lane
+            ]))
+    stage_jobs = [(stage, lane, jobs_for_stage) for stage, lane, jobs_for_stage in stage_jobs if jobs_for_stage]
+
+    with ThreadPoolExecutor(max_workers=max(len(stage_jobs), 1)) as executor:
+        futures = [
+            (stage, executor.submit(send_feature_batches, stage, lane, jobs_for_stage))
+            for stage, lane, jobs_for_stage in stage_jobs
+        ]
+
+    for stage, future in futures:
+        sent, errors = future.result()
+        for index, message_id in sent.items():
+            message_ids[index][stage['label']] = message_id
+        for index, error in errors.items():
+            failed_stages[index][stage['label']] = error
+            failed_api_types[index].add(stage['api_type'])
+
+    for index, job in jobs:
+        result = {
+            'file_path': job['file_path'],
+            'device_id': job['device_id'],
+            'recorded_at': job['recorded_at'],
+            'priorityLane': job['priority_lane'],
+            'messageIds': message_ids[index]
         }
+        if index in qc_verdicts:
+            result['qcStatus'] = qc_verdicts[index]
 
-        message_body = json.dumps(message)
+        if failed_stages[index]:
+            result.update({'status': 'failed', 'failedStages': failed_stages[index]})
+        elif not job_stages[index]:
+            result['status'] = 'skipped'
+            reason = f"QC {qc_verdicts[index]}" if qc_verdicts.get(index) else 'no applicable stages'
+            print(f"Skipped fan-out ({reason}) for Device: {job['device_id']}, Recorded at: {job['recorded_at']}")
+        else:
+            result['status'] = 'queued'
+            print(f"Successfully sent to {len(job_stages[index])} queues for Device: {job['device_id']}, Recorded at: {job['recorded_at']}")
+        results[index] = result
 
-        # Send to all 3 FIFO SQS queues in parallel
-        message_ids = []
+    register_content_keys([
+        {
+            'content_key': content_keys[index],
+            'device_id': job['device_id'],
+            'recorded_at': job['recorded_at'],
+            'file_path': job['file_path']
+        }
+        for index, job in jobs
+        if index in content_keys and results[index]['status'] != 'failed'
+    ])
 
-        # Send to ASR FIFO queue
-        message_group_id_asr = f"{device_id}-asr"
-        deduplication_id_asr = get_deduplication_id(device_id, recorded_at, "asr")
-        response_asr = sqs.send_message(
-            QueueUrl=ASR_QUEUE_URL,
-            MessageBody=message_body,
-            MessageGroupId=message_group_id_asr,
-            MessageDeduplicationId=deduplication_id_asr
-        )
-        message_ids.append(('ASR', response_asr['MessageId']))
-        print(f"Message sent to ASR FIFO queue: {response_asr['MessageId']}, GroupId={message_group_id_asr}")
-
-        # Send to SED FIFO queue
-        message_group_id_sed = f"{device_id}-sed"
-        deduplication_id_sed = get_deduplication_id(device_id, recorded_at, "sed")
-        response_sed = sqs.send_message(
-            QueueUrl=SED_QUEUE_URL,
-            MessageBody=message_body,
-            MessageGroupId=message_group_id_sed,
-            MessageDeduplicationId=deduplication_id_sed
-        )
-        message_ids.append(('SED', response_sed['MessageId']))
-        print(f"Message sent to SED FIFO queue: {response_sed['MessageId']}, GroupId={message_group_id_sed}")
-
-        # Send to SER FIFO queue
-        message_group_id_ser = f"{device_id}-ser"
-        deduplication_id_ser = get_deduplication_id(device_id, recorded_at, "ser")
-        response_ser = sqs.send_message(
-            QueueUrl=SER_QUEUE_URL,
-            MessageBody=message_body,
-            MessageGroupId=message_group_id_ser,
-            MessageDeduplicationId=deduplication_id_ser
-        )
-        message_ids.append(('SER', response_ser['MessageId']))
-        print(f"Message sent to SER FIFO queue: {response_ser['MessageId']}, GroupId={message_group_id_ser}")
+    failed_records = [
+        record for record, result in zip(records, results) if result['status'] == 'failed'
+    ]
+    # Stages that were sent stay sent: the retry carries only the failed ones
+    retry_records = [
+        {**records[index], 'fanoutRetryStages': sorted(api_types)}
+        for index, api_types in failed_api_types.items() if api_types
+    ]
 
-        print(f"Successfully sent to all 3 queues for Device: {device_id}, Recorded at: {recorded_at}")
+    if retry_records:
+        if attempt >= FANOUT_RETRY_MAX_ATTEMPTS or not resubmit_failed_records(retry_records, attempt + 1, context):
+            # Lambda retries the whole event; stages that were sent are dropped by the
+            # FIFO deduplication (same deduplication ID within 5 minutes)
+            raise FanOutError(f"{len(retry_records)}/{len(records)} S3 records could not be queued")
 
+    if failed_records:
+        print(f"{len(failed_records)}/{len(records)} S3 records failed ({len(retry_records)} re-submitted)")
         return {
-            'statusCode': 200,
+            'statusCode': 500 if len(failed_records) == len(records) else 207,
             'body': json.dumps({
-                'message': 'Successfully queued for parallel processing',
-                'messageIds': dict(message_ids),
-                'device_id': device_id,
-                'recorded_at': recorded_at
+                'message': 'Some records could not be queued',
+                'results': results,
+                'failedRecords': failed_records,
+                'resubmittedRecords': len(retry_records)
             })
         }
 
-    except Exception as e:
-        print(f"Error processing S3 event: {str(e)}")
-        return {
-            'statusCode': 500,
-            'body': json.dumps({'error': str(e)})
-        }
\ No newline at end of file
+    return {
+        'statusCode': 200,
+        'body': json.dumps({
+            'message': 'Successfully queued for parallel processing',
+            'results': results
+        })
+    }
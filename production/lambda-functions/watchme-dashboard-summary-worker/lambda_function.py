@@ -2,25 +2,50 @@ import json
 import boto3
 import requests
 import os
+import threading
+import time
 from datetime import datetime
 
 # 環境変数
 API_BASE_URL = os.environ.get('API_BASE_URL', 'https://api.hey-watch.me')
 ANALYSIS_QUEUE_URL = os.environ.get('ANALYSIS_QUEUE_URL', 'https://sqs.ap-southeast-2.amazonaws.com/975050024946/watchme-dashboard-analysis-queue')
 
+# デッドライン: APIのタイムアウトはLambdaの残り時間から決める
+# DEADLINE_RESERVE_SECONDS はメッセージを返却するための予備時間
+API_TIMEOUT_SECONDS = 180
+DEADLINE_RESERVE_SECONDS = float(os.environ.get('DEADLINE_RESERVE_SECONDS', '10'))
+MIN_API_CALL_SECONDS = float(os.environ.get('MIN_API_CALL_SECONDS', '20'))
+# 処理中のメッセージの可視性タイムアウトを延長する間隔と延長後の秒数
+HEARTBEAT_INTERVAL_SECONDS = float(os.environ.get('HEARTBEAT_INTERVAL_SECONDS', '60'))
+HEARTBEAT_EXTENSION_SECONDS = int(os.environ.get('HEARTBEAT_EXTENSION_SECONDS', '180'))
+HANDBACK_DELAY_SECONDS = int(os.environ.get('HANDBACK_DELAY_SECONDS', '5'))
+
 # SQSクライアント
 sqs = boto3.client('sqs', region_name='ap-southeast-2')
+lambda_deadline = {'at': None}
+
+
+class DeadlineExceeded(Exception):
+    pass
+
 
 def lambda_handler(event, context):
     """
     Dashboard Summary Worker Lambda
     SQSメッセージを処理してプロンプト生成APIを呼び出し、
     結果を次のキューに送信
+
+    Lambdaのタイムアウトまでに終わらないメッセージは、途中で強制終了される前に
+    短い可視性タイムアウトで返却し batchItemFailures で報告する
+    （イベントソースマッピングに ReportBatchItemFailures が必要）
     """
     
-    print(f"Processing Dashboard Summary: {len(event['Records'])} messages")
+    records = event['Records']
+    print(f"Processing Dashboard Summary: {len(records)} messages")
+    lambda_deadline['at'] = time.monotonic() + context.get_remaining_time_in_millis() / 1000
     
-    for record in event['Records']:
+    for index, record in enumerate(records):
+        heartbeat = VisibilityHeartbeat(record)
         try:
             # メッセージ本文を解析
             message = json.loads(record['body'])
@@ -40,7 +65,8 @@ def lambda_handler(event, context):
             print(f"Triggered by recording: {recorded_at}")
 
             # 1. Dashboard Summary API (Daily Aggregator)
-            summary_result = call_dashboard_summary_api(device_id, local_date)
+            with heartbeat:
+                summary_result = call_dashboard_summary_api(device_id, local_date)
             
             if summary_result['success']:
                 # 2. 成功したら次のキュー（Analysis Queue）にメッセージを送信
@@ -67,21 +93,82 @@ def lambda_handler(event, context):
                 # エラーの場合、SQSのリトライ機能により自動的に再試行される
                 raise Exception(f"Dashboard summary failed: {summary_result.get('error')}")
             
+        except DeadlineExceeded as e:
+            # 残りのメッセージはすぐに再配信されるよう返却する
+            remaining = records[index:]
+            print(f"{str(e)}: handing back {len(remaining)} messages")
+            for pending in remaining:
+                set_visibility(pending, HANDBACK_DELAY_SECONDS)
+            return {'batchItemFailures': [{'itemIdentifier': r['messageId']} for r in remaining]}
+
         except Exception as e:
             print(f"Error processing message: {str(e)}")
             # 例外を再発生させてSQSのリトライを有効にする
             raise
     
-    return {
-        'statusCode': 200,
-        'body': json.dumps('Dashboard summary processing completed')
-    }
+    return {'batchItemFailures': []}
+
+
+def api_timeout():
+    """
+    Lambdaの残り時間から予備時間を引いたAPIタイムアウト（最大 API_TIMEOUT_SECONDS）
+
+    Raises:
+        DeadlineExceeded: 残り時間が MIN_API_CALL_SECONDS 未満
+    """
+    if lambda_deadline['at'] is None:
+        return API_TIMEOUT_SECONDS
+    remaining = lambda_deadline['at'] - time.monotonic() - DEADLINE_RESERVE_SECONDS
+    if remaining < MIN_API_CALL_SECONDS:
+        raise DeadlineExceeded(f"Only {max(remaining, 0):.0f}s left for an API call")
+    return min(API_TIMEOUT_SECONDS, remaining)
+
+
+class VisibilityHeartbeat:
+    """
+    ブロックの実行中、HEARTBEAT_INTERVAL_SECONDS ごとにメッセージの可視性タイムアウトを延長し、
+    API呼び出し中に別のコンシューマーへ再配信されないようにする
+    """
+
+    def __init__(self, record):
+        self.record = record
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def __enter__(self):
+        if self.record.get('receiptHandle'):
+            self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join()
+        return False
+
+    def run(self):
+        while not self.stopped.wait(HEARTBEAT_INTERVAL_SECONDS):
+            set_visibility(self.record, HEARTBEAT_EXTENSION_SECONDS)
+
+
+def set_visibility(record, visibility_timeout):
+    # arn:aws:sqs:{region}:{account}:{queue} -> queue URL
+    _, _, _, region, account_id, queue_name = record['eventSourceARN'].split(':')
+    try:
+        sqs.change_message_visibility(
+            QueueUrl=f"https://sqs.{region}.amazonaws.com/{account_id}/{queue_name}",
+            ReceiptHandle=record['receiptHandle'],
+            VisibilityTimeout=visibility_timeout
+        )
+    except Exception as e:
+        print(f"Warning: Could not change visibility of message {record['messageId']}: {str(e)}")
 
 
 def call_dashboard_summary_api(device_id, local_date):
     """
     Dashboard Summary API (Daily Aggregator) - Generate daily prompt
     """
+    timeout = api_timeout()
     try:
         print(f"Calling Daily Aggregator API...")
         print(f"URL: {API_BASE_URL}/aggregator/daily")
@@ -94,7 +181,7 @@ def call_dashboard_summary_api(device_id, local_date):
                 "device_id": device_id,
                 "local_date": local_date
             },
-            timeout=180
+            timeout=timeout
         )
         
         if response.status_code == 200:
@@ -145,7 +232,7 @@ def call_dashboard_summary_api(device_id, local_date):
         print("Dashboard Summary API timeout")
         return {
             'success': False,
-            'error': 'API timeout after 180 seconds'
+            'error': f'API timeout after {timeout:.0f} seconds'
         }
         
     except Exception as e:
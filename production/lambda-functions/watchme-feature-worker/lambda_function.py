@@ -0,0 +1,1219 @@
+import hashlib
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timezone
+
+import boto3
+import requests
+
+DEFAULT_API_BASE_URL = "https://api.hey-watch.me"
+API_BASE_URL = os.environ.get("API_BASE_URL", DEFAULT_API_BASE_URL).rstrip("/")
+
+# Feature stages dispatched by this worker. One deployment package serves every stage:
+# STAGE (or the function name, watchme-{stage}-worker) selects the descriptor.
+# New stages are added by descriptor only, here or via STAGE_DESCRIPTORS_JSON.
+FEATURE_STAGES = {
+    "asr": {
+        "label": "ASR",
+        "endpoint_path": "/vibe-analysis/transcriber/async-process",
+        "max_concurrency": 5,
+        "admission": {
+            "source": "job_queue",
+            "job_queue_url": "https://sqs.ap-southeast-2.amazonaws.com/754724220380/watchme-asr-job-queue-v1.fifo",
+            "watermark": 50,
+        },
+        "batch": {"max_items": 10},
+    },
+    # SED/SER run on the EC2 host: at most 2 requests in flight (SCALABILITY_ROADMAP)
+    "sed": {
+        "label": "SED",
+        "endpoint_path": "/behavior-analysis/features/async-process",
+        "max_concurrency": 2,
+        "admission": {
+            "source": "job_queue",
+            "job_queue_url": "https://sqs.ap-southeast-2.amazonaws.com/754724220380/watchme-sed-job-queue-v1.fifo",
+            "watermark": 20,
+        },
+        "batch": {"max_items": 10},
+    },
+    "ser": {
+        "label": "SER",
+        "endpoint_path": "/emotion-analysis/feature-extractor/async-process",
+        "max_concurrency": 2,
+        "admission": {
+            "source": "job_queue",
+            "job_queue_url": "https://sqs.ap-southeast-2.amazonaws.com/754724220380/watchme-ser-job-queue-v1.fifo",
+            "watermark": 20,
+        },
+        "batch": {"max_items": 10},
+    },
+}
+DEFAULT_STAGE_DESCRIPTOR = {
+    "connect_timeout": 3.0,
+    "read_timeout": 10.0,
+    # Records dispatched in parallel per invocation (message groups stay sequential)
+    "max_concurrency": 1,
+    "accepted_statuses": [202],
+    # In-invocation retries on top of the SQS redelivery (1 = no retry)
+    "retry": {
+        "max_attempts": 1,
+        "backoff_seconds": 0.5,
+        "retry_statuses": [502, 503, 504],
+    },
+    # Pre-dispatch admission check against the API's backlog
+    # source: "job_queue" (depth of the API's job queue), "health" (depth_field of
+    # the API's /health response) or "none"
+    "admission": {
+        "source": "none",
+        "job_queue_url": "",
+        "health_path": "",
+        "depth_field": "queue_depth",
+        "watermark": 0,
+    },
+    # Batch submission: one POST of up to max_items jobs to {endpoint_url}/batch
+    # (or endpoint_path), answered with one result per item; 1 = single-item mode only
+    "batch": {
+        "max_items": 1,
+        "endpoint_path": "",
+    },
+    # Hedged requests: if the 202 has not arrived after the primary path's observed
+    # percentile latency, send the same job once more over endpoint_url (default: the
+    # stage endpoint on a separate connection pool) and take whichever answers first.
+    # Off until the API drops repeated Idempotency-Keys (a hedge is otherwise a second
+    # job); enable per function with HEDGE_ENABLED or per stage in the descriptor
+    "hedge": {
+        "enabled": False,
+        "endpoint_url": "",
+        "percentile": 0.95,
+        "initial_delay": 1.0,
+        "min_delay": 0.05,
+        "max_delay": 3.0,
+        # At most this share of recent dispatches may be hedged
+        "max_ratio": 0.1,
+    },
+}
+# Inline JSON or a file path: {"stage": {descriptor fields}, ...}
+STAGE_DESCRIPTORS_JSON = os.environ.get("STAGE_DESCRIPTORS_JSON", "")
+
+# Adaptive concurrency (AIMD) and circuit breaker for calls to the analysis API
+# (KNOWN_ISSUES issue 1: HTTPS timeouts / API temporarily unhealthy)
+CONTROLLER_ENABLED = os.environ.get("CONTROLLER_ENABLED", "true").lower() not in {"0", "false", "no"}
+# "local" (state kept per container), "supabase" (feature_api_controller table, shared
+# by all containers; create the table first) or "sqlite" (local stand-in)
+CONTROLLER_BACKEND = os.environ.get("CONTROLLER_BACKEND", "local")
+CONTROLLER_SQLITE_PATH = os.environ.get("CONTROLLER_SQLITE_PATH", "/tmp/feature_api_controller.db")
+CONTROLLER_SYNC_SECONDS = float(os.environ.get("CONTROLLER_SYNC_SECONDS", "5"))
+AIMD_INCREASE = float(os.environ.get("AIMD_INCREASE", "1"))
+AIMD_DECREASE = float(os.environ.get("AIMD_DECREASE", "0.5"))
+# A 202 slower than this neither raises nor cuts the limit
+SLOW_CALL_SECONDS = float(os.environ.get("SLOW_CALL_SECONDS", "2"))
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get("BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_OPEN_SECONDS = float(os.environ.get("BREAKER_OPEN_SECONDS", "60"))
+SUPABASE_URL = os.environ.get("SUPABASE_URL")
+SUPABASE_KEY = os.environ.get("SUPABASE_KEY")
+
+# Backpressure: the admission signal is cached per container; deferrals back off exponentially
+ADMISSION_CACHE_SECONDS = float(os.environ.get("ADMISSION_CACHE_SECONDS", "5"))
+ADMISSION_BASE_DELAY_SECONDS = float(os.environ.get("ADMISSION_BASE_DELAY_SECONDS", "15"))
+ADMISSION_MAX_DELAY_SECONDS = float(os.environ.get("ADMISSION_MAX_DELAY_SECONDS", "600"))
+
+# Batch submission falls back to single-item mode when the API has no batch endpoint
+BATCH_UNSUPPORTED_STATUSES = {404, 405, 501}
+BATCH_PROBE_TTL_SECONDS = float(os.environ.get("BATCH_PROBE_TTL_SECONDS", "600"))
+
+# Hedge delay: percentile of the last HEDGE_WINDOW primary latencies (initial_delay until HEDGE_MIN_SAMPLES)
+HEDGE_WINDOW = int(os.environ.get("HEDGE_WINDOW", "200"))
+HEDGE_MIN_SAMPLES = int(os.environ.get("HEDGE_MIN_SAMPLES", "20"))
+
+# Priority lanes: bulk-lane messages wait while the interactive queue has at least
+# INTERACTIVE_BACKLOG_THRESHOLD messages waiting or in flight, backing off exponentially
+# from BULK_DEFER_SECONDS up to BULK_MAX_DEFER_SECONDS
+INTERACTIVE_QUEUE_URL = os.environ.get("INTERACTIVE_QUEUE_URL", "")
+BULK_DEFER_SECONDS = int(os.environ.get("BULK_DEFER_SECONDS", "60"))
+BULK_MAX_DEFER_SECONDS = int(os.environ.get("BULK_MAX_DEFER_SECONDS", "900"))
+INTERACTIVE_BACKLOG_THRESHOLD = int(os.environ.get("INTERACTIVE_BACKLOG_THRESHOLD", "1"))
+INTERACTIVE_BACKLOG_CACHE_SECONDS = float(os.environ.get("INTERACTIVE_BACKLOG_CACHE_SECONDS", "5"))
+
+# Deferred messages (bulk lane, backpressure, open breaker) are parked in this standard queue
+# with DelaySeconds and re-sent to their FIFO queue by this worker when the delay is up, so a
+# deferral does not count as a receive and maxReceiveCount only counts real failures.
+# Unset: deferrals fall back to ChangeMessageVisibility + batchItemFailures
+DEFER_QUEUE_URL = os.environ.get("DEFER_QUEUE_URL", "")
+# SQS DelaySeconds limit
+DEFER_MAX_DELAY_SECONDS = 900
+
+
+def load_stage_descriptor():
+    """
+    Resolve the stage descriptor for this function
+
+    Precedence: FEATURE_STAGES < STAGE_DESCRIPTORS_JSON < per-function env vars
+    (API_ENDPOINT_URL, API_HOST_HEADER, VERIFY_TLS, REQUEST_CONNECT_TIMEOUT, REQUEST_READ_TIMEOUT,
+    ADMISSION_SOURCE, ADMISSION_WATERMARK, BATCH_MAX_ITEMS, HEDGE_ENABLED, HEDGE_ENDPOINT_URL,
+    HEDGE_HOST_HEADER, HEDGE_PERCENTILE, HEDGE_MAX_RATIO)
+    MAX_CONCURRENCY can only lower the descriptor's max_concurrency
+
+    Raises:
+        ValueError: The stage is unknown or has no endpoint
+    """
+    stages = {name: dict(descriptor) for name, descriptor in FEATURE_STAGES.items()}
+    if STAGE_DESCRIPTORS_JSON:
+        raw = STAGE_DESCRIPTORS_JSON
+        if not raw.lstrip().startswith("{"):
+            with open(raw) as f:
+                raw = f.read()
+        for name, descriptor in json.loads(raw).items():
+            stages[name] = {**stages.get(name, {}), **descriptor}
+
+    function_name = os.environ.get("AWS_LAMBDA_FUNCTION_NAME", "")
+    name = os.environ.get("STAGE") or function_name.removeprefix("watchme-").removesuffix("-worker")
+    if name not in stages:
+        raise ValueError(f"Unknown feature stage '{name}' (known: {', '.join(sorted(stages))})")
+
+    descriptor = {**DEFAULT_STAGE_DESCRIPTOR, **stages[name]}
+    descriptor["retry"] = {**DEFAULT_STAGE_DESCRIPTOR["retry"], **stages[name].get("retry", {})}
+    descriptor["admission"] = {**DEFAULT_STAGE_DESCRIPTOR["admission"], **stages[name].get("admission", {})}
+    descriptor["batch"] = {**DEFAULT_STAGE_DESCRIPTOR["batch"], **stages[name].get("batch", {})}
+    descriptor["hedge"] = {**DEFAULT_STAGE_DESCRIPTOR["hedge"], **stages[name].get("hedge", {})}
+    descriptor["name"] = name
+    descriptor.setdefault("label", name.upper())
+
+    if os.environ.get("API_ENDPOINT_URL"):
+        descriptor["endpoint_url"] = os.environ["API_ENDPOINT_URL"]
+    elif descriptor.get("endpoint_path"):
+        descriptor["endpoint_url"] = f"{API_BASE_URL}{descriptor['endpoint_path']}"
+    if not descriptor.get("endpoint_url"):
+        raise ValueError(f"Feature stage '{name}' has no endpoint_url or endpoint_path")
+
+    descriptor["host_header"] = os.environ.get("API_HOST_HEADER", descriptor.get("host_header", ""))
+    descriptor["verify_tls"] = os.environ.get(
+        "VERIFY_TLS", str(descriptor.get("verify_tls", True))
+    ).lower() not in {"0", "false", "no"}
+    descriptor["connect_timeout"] = float(os.environ.get("REQUEST_CONNECT_TIMEOUT", descriptor["connect_timeout"]))
+    descriptor["read_timeout"] = float(os.environ.get("REQUEST_READ_TIMEOUT", descriptor["read_timeout"]))
+    descriptor["max_concurrency"] = max(1, min(
+        int(descriptor["max_concurrency"]),
+        int(os.environ.get("MAX_CONCURRENCY", descriptor["max_concurrency"])),
+    ))
+
+    admission = descriptor["admission"]
+    admission["source"] = os.environ.get("ADMISSION_SOURCE", admission["source"])
+    admission["watermark"] = int(os.environ.get("ADMISSION_WATERMARK", admission["watermark"]))
+    if admission["source"] == "health" and not admission["health_path"]:
+        # .../async-process -> .../health on the same host (works with the private IP endpoint too)
+        admission["health_url"] = descriptor["endpoint_url"].rsplit("/", 1)[0] + "/health"
+    elif admission["health_path"]:
+        admission["health_url"] = f"{API_BASE_URL}{admission['health_path']}"
+
+    batch = descriptor["batch"]
+    batch["max_items"] = max(1, int(os.environ.get("BATCH_MAX_ITEMS", batch["max_items"])))
+    if batch["endpoint_path"]:
+        batch["endpoint_url"] = f"{API_BASE_URL}{batch['endpoint_path']}"
+    else:
+        batch["endpoint_url"] = f"{descriptor['endpoint_url']}/batch"
+
+    hedge = descriptor["hedge"]
+    hedge["enabled"] = os.environ.get("HEDGE_ENABLED", str(hedge["enabled"])).lower() not in {"0", "false", "no"}
+    # The private IP path (API_ENDPOINT_URL + API_HOST_HEADER) by default
+    hedge["endpoint_url"] = os.environ.get("HEDGE_ENDPOINT_URL") or hedge["endpoint_url"] or descriptor["endpoint_url"]
+    hedge["host_header"] = os.environ.get("HEDGE_HOST_HEADER", hedge.get("host_header", descriptor["host_header"]))
+    hedge["percentile"] = float(os.environ.get("HEDGE_PERCENTILE", hedge["percentile"]))
+    hedge["max_ratio"] = float(os.environ.get("HEDGE_MAX_RATIO", hedge["max_ratio"]))
+    return descriptor
+
+
+STAGE = load_stage_descriptor()
+
+sqs = boto3.client("sqs", region_name="ap-southeast-2")
+interactive_backlog = {"value": 0, "checked_at": 0.0}
+admission_signal = {"value": 0, "checked_at": 0.0}
+admission_lock = threading.Lock()
+batch_support = {"supported": None, "checked_at": 0.0}
+# messageId -> delay of the records deferred in the current invocation (held at the end)
+deferred_delays = {}
+
+# One keep-alive connection pool per container, sized to the stage's concurrency
+api_session = requests.Session()
+api_session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=STAGE["max_concurrency"]))
+api_session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=STAGE["max_concurrency"]))
+
+# Hedges use their own pool so they never queue behind a hung keep-alive connection
+hedge_session = requests.Session()
+hedge_session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=STAGE["max_concurrency"]))
+hedge_session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=STAGE["max_concurrency"]))
+# Primary and hedge calls run here so the dispatching thread can wait on both
+# (losing calls keep a thread until they finish or time out)
+hedge_executor = ThreadPoolExecutor(max_workers=4 * STAGE["max_concurrency"]) if STAGE["hedge"]["enabled"] else None
+
+
+class BatchUnsupportedError(Exception):
+    """
+    The API does not serve the batch submission endpoint
+    """
+
+
+class CircuitOpenError(Exception):
+    """
+    The stage's circuit breaker is open; retry_after is the remaining open time in seconds
+    """
+
+    def __init__(self, retry_after):
+        super().__init__(f"Circuit breaker is open (retry in {retry_after:.0f}s)")
+        self.retry_after = retry_after
+
+
+class SupabaseControllerStore:
+    """
+    Shared controller state in Supabase (feature_api_controller table, one row per stage)
+    """
+
+    def __init__(self):
+        self.session = requests.Session()
+        self.session.headers.update({
+            "apikey": SUPABASE_KEY,
+            "Authorization": f"Bearer {SUPABASE_KEY}",
+            "Content-Type": "application/json",
+        })
+
+    def load(self, stage_name):
+        response = self.session.get(
+            f"{SUPABASE_URL}/rest/v1/feature_api_controller",
+            params={
+                "stage": f"eq.{stage_name}",
+                "select": "concurrency_limit,breaker_state,open_until,consecutive_failures,updated_at",
+            },
+            timeout=3,
+        )
+        if response.status_code != 200:
+            raise RuntimeError(f"{response.status_code} {response.text}")
+        rows = response.json()
+        return rows[0] if rows else None
+
+    def save(self, stage_name, state):
+        response = self.session.post(
+            f"{SUPABASE_URL}/rest/v1/feature_api_controller",
+            params={"on_conflict": "stage"},
+            json={"stage": stage_name, **state},
+            headers={"Prefer": "resolution=merge-duplicates,return=minimal"},
+            timeout=3,
+        )
+        if response.status_code not in (200, 201, 204):
+            raise RuntimeError(f"{response.status_code} {response.text}")
+
+
+class SQLiteControllerStore:
+    """
+    Local stand-in for the shared controller state (same interface, SQLite file)
+    """
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS feature_api_controller ("
+                "stage TEXT PRIMARY KEY, concurrency_limit REAL, breaker_state TEXT, "
+                "open_until REAL, consecutive_failures INTEGER, updated_at REAL)"
+            )
+
+    def load(self, stage_name):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT concurrency_limit, breaker_state, open_until, consecutive_failures, updated_at "
+                "FROM feature_api_controller WHERE stage = ?",
+                (stage_name,)
+            ).fetchone()
+        if row is None:
+            return None
+        return dict(zip(("concurrency_limit", "breaker_state", "open_until", "consecutive_failures", "updated_at"), row))
+
+    def save(self, stage_name, state):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO feature_api_controller "
+                "(stage, concurrency_limit, breaker_state, open_until, consecutive_failures, updated_at) "
+                "VALUES (:stage, :concurrency_limit, :breaker_state, :open_until, :consecutive_failures, :updated_at)",
+                {"stage": stage_name, **state}
+            )
+
+
+class ApiController:
+    """
+    Client-side congestion control for one stage's API
+
+    - AIMD: the in-flight limit grows by AIMD_INCREASE / limit per fast 202 and is
+      multiplied by AIMD_DECREASE on a timeout, connection error or 5xx
+    - Circuit breaker: BREAKER_FAILURE_THRESHOLD consecutive overloads open it for
+      BREAKER_OPEN_SECONDS; afterwards one probe request decides (half-open)
+    - The state is shared through the store every CONTROLLER_SYNC_SECONDS (and
+      immediately when the breaker changes state), so all containers see the same signal.
+      Syncs run on a background thread, never on the dispatch path, and merge
+      conservatively: an open breaker is kept until it expires and the lower limit wins.
+    """
+
+    def __init__(self, stage_name, max_limit, store):
+        self.stage_name = stage_name
+        self.max_limit = max_limit
+        self.store = store
+        self.condition = threading.Condition()
+        self.in_flight = 0
+        self.limit = 1.0
+        self.breaker_state = "closed"
+        self.open_until = 0.0
+        self.consecutive_failures = 0
+        self.updated_at = 0.0
+        self.synced_at = 0.0
+        self.syncing = False
+        self.resync = False
+
+    def acquire(self):
+        """
+        Wait for an in-flight slot
+
+        Raises:
+            CircuitOpenError: The breaker is open (or half-open with a probe in flight)
+        """
+        self.request_sync()
+        with self.condition:
+            while True:
+                now = time.time()
+                if self.breaker_state == "open":
+                    if now < self.open_until:
+                        raise CircuitOpenError(self.open_until - now)
+                    self.breaker_state = "half_open"
+                if self.breaker_state == "half_open":
+                    if self.in_flight:
+                        raise CircuitOpenError(min(BREAKER_OPEN_SECONDS, 10.0))
+                    break
+                if self.in_flight < int(self.limit):
+                    break
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, outcome):
+        """
+        Record the result of one request: "fast" (quick 202), "overload" (timeout, connection
+        error, 5xx) or "neutral" (slow 202, 4xx)
+        """
+        transition = None
+        with self.condition:
+            self.in_flight -= 1
+            if outcome == "overload":
+                self.limit = max(1.0, self.limit * AIMD_DECREASE)
+                self.consecutive_failures += 1
+                if self.breaker_state == "half_open" or self.consecutive_failures >= BREAKER_FAILURE_THRESHOLD:
+                    self.breaker_state = "open"
+                    self.open_until = time.time() + BREAKER_OPEN_SECONDS
+                    transition = "open"
+            else:
+                if outcome == "fast":
+                    self.limit = min(float(self.max_limit), self.limit + AIMD_INCREASE / self.limit)
+                self.consecutive_failures = 0
+                if self.breaker_state == "half_open":
+                    self.breaker_state = "closed"
+                    self.limit = 1.0
+                    transition = "closed"
+            self.updated_at = time.time()
+            self.condition.notify_all()
+
+        if transition:
+            print(f"Circuit breaker {transition} for {self.stage_name} (limit {self.limit:.2f})")
+            self.request_sync(force=True)
+
+    def state(self):
+        return {
+            "concurrency_limit": round(self.limit, 3),
+            "breaker_state": self.breaker_state,
+            "open_until": self.open_until,
+            "consecutive_failures": self.consecutive_failures,
+            "updated_at": self.updated_at,
+        }
+
+    def request_sync(self, force=False):
+        """
+        Start a background sync when the interval has expired (or force); a forced
+        request during a running sync makes that thread sync once more
+        """
+        if self.store is None:
+            return
+        with self.condition:
+            if not force and time.time() - self.synced_at < CONTROLLER_SYNC_SECONDS:
+                return
+            self.synced_at = time.time()
+            if self.syncing:
+                self.resync = self.resync or force
+                return
+            self.syncing = True
+        threading.Thread(target=self.run_sync, daemon=True).start()
+
+    def run_sync(self):
+        try:
+            while True:
+                self.sync()
+                with self.condition:
+                    if not self.resync:
+                        return
+                    self.resync = False
+        finally:
+            with self.condition:
+                self.syncing = False
+
+    def sync(self):
+        """
+        Exchange state with the shared store: merge the shared state, then publish
+        Store errors are logged and the local state is kept
+        """
+        try:
+            shared = self.store.load(self.stage_name)
+            with self.condition:
+                if shared:
+                    self.merge(shared)
+                state = self.state()
+            self.store.save(self.stage_name, state)
+        except Exception as e:
+            print(f"Warning: Controller state sync failed for {self.stage_name}: {e}")
+
+    def merge(self, shared):
+        """
+        Merge another container's published state into ours (caller holds the condition)
+        """
+        now = time.time()
+        shared_open_until = float(shared["open_until"] or 0)
+        our_open_until = self.open_until if self.breaker_state == "open" else 0.0
+        if shared["breaker_state"] == "open" and shared_open_until > max(now, our_open_until):
+            self.breaker_state = "open"
+            self.open_until = shared_open_until
+            self.consecutive_failures = max(self.consecutive_failures, int(shared["consecutive_failures"] or 0))
+
+        # A limit published since our last update reflects the API's current state;
+        # an older one is ours to replace
+        if float(shared["updated_at"] or 0) > self.updated_at:
+            shared_limit = min(float(self.max_limit), max(1.0, float(shared["concurrency_limit"])))
+            self.limit = min(self.limit, shared_limit)
+            self.updated_at = float(shared["updated_at"])
+        self.condition.notify_all()
+
+
+def get_controller_store():
+    if not CONTROLLER_ENABLED or CONTROLLER_BACKEND == "local":
+        return None
+    if CONTROLLER_BACKEND == "sqlite":
+        return SQLiteControllerStore(CONTROLLER_SQLITE_PATH)
+    if not SUPABASE_URL or not SUPABASE_KEY:
+        print("Warning: SUPABASE_URL/SUPABASE_KEY not set, controller state is local to this container")
+        return None
+    return SupabaseControllerStore()
+
+
+controller = ApiController(STAGE["name"], STAGE["max_concurrency"], get_controller_store()) if CONTROLLER_ENABLED else None
+
+
+class HedgePolicy:
+    """
+    Adaptive hedge delay and hedge budget for one stage (per container)
+
+    - delay(): the configured percentile of the last HEDGE_WINDOW primary latencies,
+      clamped to [min_delay, max_delay]; initial_delay until HEDGE_MIN_SAMPLES are seen
+    - allow(): True while fewer than max_ratio of the recent dispatches were hedged,
+      so a slow API does not get twice the load
+    """
+
+    def __init__(self, hedge):
+        self.hedge = hedge
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=HEDGE_WINDOW)
+        self.decisions = deque(maxlen=HEDGE_WINDOW)
+
+    def delay(self):
+        with self.lock:
+            if len(self.latencies) < HEDGE_MIN_SAMPLES:
+                return self.hedge["initial_delay"]
+            ordered = sorted(self.latencies)
+        value = ordered[min(len(ordered) - 1, int(self.hedge["percentile"] * len(ordered)))]
+        return min(self.hedge["max_delay"], max(self.hedge["min_delay"], value))
+
+    def observe(self, latency):
+        with self.lock:
+            self.latencies.append(latency)
+
+    def allow(self):
+        with self.lock:
+            hedged = sum(self.decisions)
+            allowed = hedged < self.hedge["max_ratio"] * max(len(self.decisions), 1)
+            self.decisions.append(1 if allowed else 0)
+            return allowed
+
+    def record_unhedged(self):
+        with self.lock:
+            self.decisions.append(0)
+
+    def state(self):
+        delay = self.delay()
+        with self.lock:
+            return {
+                "delay": round(delay, 3),
+                "samples": len(self.latencies),
+                "hedged_ratio": round(sum(self.decisions) / max(len(self.decisions), 1), 3),
+            }
+
+
+hedge_policy = HedgePolicy(STAGE["hedge"]) if STAGE["hedge"]["enabled"] else None
+
+
+def lambda_handler(event, context):
+    """
+    Process SQS messages and trigger the stage's API async processing
+
+    Records are dispatched concurrently (up to the stage's max_concurrency), one
+    message group at a time per thread so FIFO order within a group is kept.
+    With batch submission, admitted records go out in POSTs of up to batch max_items.
+    Failed records are returned as batchItemFailures so only they are retried;
+    records that already got a 202 are not dispatched again.
+    Bulk-lane messages are deferred while the interactive queue still has messages,
+    so the fast lane drains first. Deferred records (and the rest of their group in
+    this batch) are parked in DEFER_QUEUE_URL and reported as processed; records from
+    that queue are re-sent to their FIFO queue (see forward_deferred_records).
+    The event source mappings must use ReportBatchItemFailures.
+    """
+    records = event['Records']
+    if is_defer_queue_record(records[0]):
+        return forward_deferred_records(records)
+
+    print(f"Processing {len(records)} messages from {STAGE['label']} queue")
+    deferred_delays.clear()
+
+    groups = {}
+    for record in records:
+        group_id = record.get('attributes', {}).get('MessageGroupId', record['messageId'])
+        groups.setdefault(group_id, []).append(record)
+
+    if len(records) > 1 and use_batch_submission(STAGE):
+        statuses = process_batch(list(groups.values()))
+    else:
+        workers = min(STAGE["max_concurrency"], len(groups))
+        if workers > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                outcomes = [outcome for group in executor.map(process_group, groups.values()) for outcome in group]
+        else:
+            outcomes = [outcome for group in groups.values() for outcome in process_group(group)]
+        statuses = dict(outcomes)
+
+    if DEFER_QUEUE_URL:
+        hold_deferred_records(groups.values(), statuses)
+
+    batch_item_failures = [
+        {"itemIdentifier": record['messageId']}
+        for record in records
+        if statuses[record['messageId']] not in ('dispatched', 'held')
+    ]
+    deferred = sum(1 for status in statuses.values() if status in ('deferred', 'held'))
+
+    if deferred:
+        print(f"Deferred {deferred} messages (interactive backlog, backpressure or open breaker)")
+    if batch_item_failures:
+        print(f"Returning {len(batch_item_failures)} of {len(records)} messages for retry")
+
+    return {'batchItemFailures': batch_item_failures}
+
+
+def process_group(records):
+    """
+    Dispatch the records of one message group in order
+
+    Returns:
+        list of (messageId, status): dispatched, failed, deferred or skipped
+        (skipped: after a failed or deferred record of the same FIFO group)
+    """
+    label = STAGE["label"]
+    outcomes = []
+
+    for record in records:
+        if outcomes and outcomes[-1][1] != 'dispatched':
+            outcomes.append((record['messageId'], 'skipped'))
+            continue
+
+        try:
+            message = admit_record(record)
+            if message is None:
+                outcomes.append((record['messageId'], 'deferred'))
+                continue
+
+            dispatch(STAGE, message)
+            count_dispatched()
+            print(f"{label} processing started successfully for {message['file_path']}")
+            outcomes.append((record['messageId'], 'dispatched'))
+
+        except CircuitOpenError as e:
+            # Back off instead of calling a failing API
+            print(f"{e}: deferring message {record['messageId']}")
+            defer_record(record, int(e.retry_after) + 1)
+            outcomes.append((record['messageId'], 'deferred'))
+
+        except Exception as e:
+            print(f"Error processing message {record['messageId']}: {str(e)}")
+            outcomes.append((record['messageId'], 'failed'))
+
+    return outcomes
+
+
+def admit_record(record):
+    """
+    Parse one record and run the pre-dispatch checks (bulk lane, backpressure)
+
+    Returns:
+        The message dict, or None if the record was deferred
+    """
+    message = json.loads(record['body'])
+
+    if should_defer_bulk_message(message):
+        delay = get_backoff_delay(record, message, BULK_DEFER_SECONDS, BULK_MAX_DEFER_SECONDS)
+        print(f"Interactive {STAGE['label']} queue busy: deferring bulk message {record['messageId']} for {delay}s")
+        defer_record(record, delay)
+        return None
+
+    if not admit(STAGE):
+        delay = get_backoff_delay(record, message, ADMISSION_BASE_DELAY_SECONDS, ADMISSION_MAX_DELAY_SECONDS)
+        print(f"{STAGE['label']} API over its watermark: deferring message {record['messageId']} for {delay}s")
+        defer_record(record, delay)
+        return None
+
+    print(f"Processing {STAGE['label']} for device {message['device_id']} at {message['recorded_at']}")
+    log_queue_wait(message)
+    return message
+
+
+def use_batch_submission(stage):
+    if stage["batch"]["max_items"] <= 1:
+        return False
+    if batch_support["supported"] is False:
+        # Re-probe now and then in case the API gained the batch endpoint
+        return time.monotonic() - batch_support["checked_at"] >= BATCH_PROBE_TTL_SECONDS
+    return True
+
+
+def process_batch(groups):
+    """
+    Submit the admitted records in batches of up to the stage's batch max_items
+
+    Records go out in waves holding the next record of each message group, so a
+    group never has two items in flight. The first deferred, failed or rejected
+    record of a group skips the rest of that group (FIFO order, as in process_group).
+
+    Returns:
+        dict messageId -> status (dispatched, failed, deferred or skipped)
+    """
+    statuses = {}
+    queues = [list(records) for records in groups]
+
+    while queues:
+        pending = []
+        for records in queues:
+            record = records[0]
+            try:
+                message = admit_record(record)
+            except Exception as e:
+                print(f"Error processing message {record['messageId']}: {str(e)}")
+                statuses[record['messageId']] = 'failed'
+                continue
+            if message is None:
+                statuses[record['messageId']] = 'deferred'
+                continue
+            pending.append((record, message))
+
+        size = STAGE["batch"]["max_items"]
+        chunks = [pending[start:start + size] for start in range(0, len(pending), size)]
+        workers = min(STAGE["max_concurrency"], len(chunks))
+        if workers > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(submit_chunk, chunks))
+        else:
+            results = [submit_chunk(chunk) for chunk in chunks]
+        for chunk_statuses in results:
+            statuses.update(chunk_statuses)
+
+        remaining = []
+        for head, *rest in queues:
+            if statuses[head['messageId']] != 'dispatched':
+                for record in rest:
+                    statuses[record['messageId']] = 'skipped'
+            elif rest:
+                remaining.append(rest)
+        queues = remaining
+
+    return statuses
+
+
+def submit_chunk(chunk):
+    """
+    Submit one chunk with a batch POST (single-item dispatch if the API has no batch endpoint)
+
+    Returns:
+        dict messageId -> status
+    """
+    label = STAGE["label"]
+    statuses = {}
+
+    try:
+        results = dispatch_batch(STAGE, [message for _, message in chunk])
+    except BatchUnsupportedError:
+        print(f"{label} API has no batch endpoint, falling back to single-item dispatch")
+        results = None
+    except CircuitOpenError as e:
+        print(f"{e}: deferring {len(chunk)} messages")
+        for record, _ in chunk:
+            defer_record(record, int(e.retry_after) + 1)
+            statuses[record['messageId']] = 'deferred'
+        return statuses
+    except Exception as e:
+        print(f"Error submitting {label} batch of {len(chunk)}: {str(e)}")
+        return {record['messageId']: 'failed' for record, _ in chunk}
+
+    if results is None:
+        for record, message in chunk:
+            try:
+                dispatch(STAGE, message)
+                count_dispatched()
+                statuses[record['messageId']] = 'dispatched'
+            except CircuitOpenError as e:
+                defer_record(record, int(e.retry_after) + 1)
+                statuses[record['messageId']] = 'deferred'
+            except Exception as e:
+                print(f"Error processing message {record['messageId']}: {str(e)}")
+                statuses[record['messageId']] = 'failed'
+        return statuses
+
+    for (record, message), (accepted, error) in zip(chunk, results):
+        if accepted:
+            count_dispatched()
+            statuses[record['messageId']] = 'dispatched'
+        else:
+            print(f"{label} rejected {message['file_path']}: {error}")
+            statuses[record['messageId']] = 'failed'
+
+    print(f"{label} batch submitted: {sum(1 for accepted, _ in results if accepted)}/{len(chunk)} accepted")
+    return statuses
+
+
+def dispatch_batch(stage, messages):
+    """
+    Batch submission contract:
+        POST {batch endpoint} {"items": [{"file_path", "device_id", "recorded_at"}, ...]}
+        -> 200/207 {"results": [{"accepted": bool, "status": int, "error": str}, ...]} (item order)
+
+    Returns:
+        list of (accepted, error) per item
+
+    Raises:
+        BatchUnsupportedError: The API answered 404/405/501 (cached for BATCH_PROBE_TTL_SECONDS)
+        CircuitOpenError: The API's circuit breaker is open
+        Exception: The batch as a whole failed
+    """
+    if controller:
+        controller.acquire()
+    started = time.monotonic()
+    outcome = "overload"
+
+    try:
+        response = api_session.post(
+            stage["batch"]["endpoint_url"],
+            json={
+                "items": [
+                    {
+                        "file_path": message['file_path'],
+                        "device_id": message['device_id'],
+                        "recorded_at": message['recorded_at']
+                    }
+                    for message in messages
+                ]
+            },
+            headers={"Host": stage["host_header"]} if stage["host_header"] else None,
+            verify=stage["verify_tls"],
+            timeout=(stage["connect_timeout"], stage["read_timeout"]),
+        )
+
+        if response.status_code in BATCH_UNSUPPORTED_STATUSES:
+            outcome = "neutral"
+            batch_support.update(supported=False, checked_at=time.monotonic())
+            raise BatchUnsupportedError()
+        if response.status_code not in (200, 207):
+            if response.status_code < 500:
+                outcome = "neutral"
+            print(f"Response: {response.text}")
+            raise Exception(f"Failed to submit {stage['label']} batch: {response.status_code}")
+
+        results = response.json().get("results") or []
+        if len(results) != len(messages):
+            outcome = "neutral"
+            raise Exception(f"Batch response has {len(results)} results for {len(messages)} items")
+
+        outcome = "fast" if time.monotonic() - started < SLOW_CALL_SECONDS else "neutral"
+        batch_support.update(supported=True, checked_at=time.monotonic())
+        return [(bool(result.get("accepted")), result.get("error")) for result in results]
+    finally:
+        if controller:
+            controller.release(outcome)
+
+
+def dispatch(stage, message):
+    """
+    Call the stage's async endpoint (returns 202 immediately), retrying per the stage's retry policy
+
+    Raises:
+        CircuitOpenError: The API's circuit breaker is open
+        Exception: The API did not accept the job after all attempts
+    """
+    retry = stage["retry"]
+    attempts = max(1, int(retry["max_attempts"]))
+
+    for attempt in range(1, attempts + 1):
+        if controller:
+            controller.acquire()
+        started = time.monotonic()
+        outcome = "overload"
+        try:
+            response = post_job(stage, message)
+        except requests.exceptions.RequestException as e:
+            if attempt == attempts:
+                raise
+            print(f"Warning: {stage['label']} request failed (attempt {attempt}/{attempts}): {e}")
+        else:
+            if response.status_code in stage["accepted_statuses"]:
+                outcome = "fast" if time.monotonic() - started < SLOW_CALL_SECONDS else "neutral"
+                return response
+            if response.status_code < 500:
+                outcome = "neutral"
+
+            error_msg = f"Failed to start {stage['label']} processing: {response.status_code}"
+            if attempt == attempts or response.status_code not in retry["retry_statuses"]:
+                print(f"Response: {response.text}")
+                raise Exception(error_msg)
+            print(f"Warning: {error_msg} (attempt {attempt}/{attempts})")
+        finally:
+            if controller:
+                controller.release(outcome)
+
+        time.sleep(retry["backoff_seconds"] * 2 ** (attempt - 1))
+
+
+def post_job(stage, message):
+    """
+    POST one job to the stage endpoint, hedged when the stage has hedging enabled
+
+    The hedge is sent once the primary has not answered within the policy's delay;
+    the first response wins (a request error only loses if the other call also fails).
+    Both calls carry the same Idempotency-Key so the API can drop the loser; redeliveries
+    and in-invocation retries get a new key.
+
+    Raises:
+        requests.exceptions.RequestException: Every call failed
+    """
+    key = uuid.uuid4().hex
+    if not hedge_policy:
+        return send_job(api_session, stage["endpoint_url"], stage["host_header"], stage, message, key)[0]
+
+    primary = hedge_executor.submit(
+        send_job, api_session, stage["endpoint_url"], stage["host_header"], stage, message, key
+    )
+    # The primary latency is recorded even when the hedge wins (timeouts count as read_timeout)
+    primary.add_done_callback(
+        lambda future: hedge_policy.observe(
+            future.result()[1] if not future.exception() else stage["read_timeout"]
+        )
+    )
+
+    done, _ = wait([primary], timeout=hedge_policy.delay())
+    if done:
+        hedge_policy.record_unhedged()
+        return primary.result()[0]
+    if not hedge_policy.allow():
+        return primary.result()[0]
+
+    print(f"{stage['label']} primary slower than {hedge_policy.delay():.2f}s, hedging {message['file_path']}")
+    hedge = hedge_executor.submit(
+        send_job, hedge_session, stage["hedge"]["endpoint_url"], stage["hedge"]["host_header"], stage, message, key
+    )
+    pending = {primary, hedge}
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if not future.exception():
+                return future.result()[0]
+            error = future.exception()
+    raise error
+
+
+def send_job(session, url, host_header, stage, message, key):
+    """
+    Returns:
+        (response, latency seconds)
+    """
+    headers = {"Idempotency-Key": key}
+    if host_header:
+        headers["Host"] = host_header
+    started = time.monotonic()
+    response = session.post(
+        url,
+        json={
+            "file_path": message['file_path'],
+            "device_id": message['device_id'],
+            "recorded_at": message['recorded_at']
+        },
+        headers=headers,
+        verify=stage["verify_tls"],
+        timeout=(stage["connect_timeout"], stage["read_timeout"]),
+    )
+    return response, time.monotonic() - started
+
+
+def admit(stage):
+    """
+    Pre-dispatch admission check: False while the API's backlog is at or over its watermark
+    The signal is refreshed at most every ADMISSION_CACHE_SECONDS; unreadable signals admit
+    """
+    admission = stage["admission"]
+    if admission["source"] == "none" or admission["watermark"] <= 0:
+        return True
+
+    # One thread refreshes the signal; the others use the cached value meanwhile
+    now = time.monotonic()
+    with admission_lock:
+        refresh = now - admission_signal["checked_at"] >= ADMISSION_CACHE_SECONDS
+        if refresh:
+            admission_signal["checked_at"] = now
+
+    if refresh:
+        try:
+            value = read_admission_signal(stage)
+        except Exception as e:
+            print(f"Warning: Could not read {stage['label']} admission signal: {e}")
+            value = 0
+        with admission_lock:
+            admission_signal["value"] = value
+
+    with admission_lock:
+        return admission_signal["value"] < admission["watermark"]
+
+
+def count_dispatched():
+    """
+    Count our own job in the cached admission signal until the next refresh
+    (dispatching threads update it concurrently)
+    """
+    with admission_lock:
+        admission_signal["value"] += 1
+
+
+def read_admission_signal(stage):
+    """
+    Current backlog of the stage's API (jobs waiting or running)
+    """
+    admission = stage["admission"]
+
+    if admission["source"] == "job_queue":
+        attributes = sqs.get_queue_attributes(
+            QueueUrl=admission["job_queue_url"],
+            AttributeNames=["ApproximateNumberOfMessages", "ApproximateNumberOfMessagesNotVisible"],
+        )["Attributes"]
+        return int(attributes["ApproximateNumberOfMessages"]) + int(attributes["ApproximateNumberOfMessagesNotVisible"])
+
+    response = api_session.get(
+        admission["health_url"],
+        headers={"Host": stage["host_header"]} if stage["host_header"] else None,
+        verify=stage["verify_tls"],
+        timeout=(stage["connect_timeout"], 2),
+    )
+    if response.status_code == 503:
+        # Unhealthy: hold everything back until the next refresh
+        return admission["watermark"]
+    response.raise_for_status()
+    return int(response.json().get(admission["depth_field"]) or 0)
+
+
+def get_backoff_delay(record, message, base_delay, max_delay):
+    """
+    Exponential backoff with jitter based on how often the message was deferred
+    (deferrals through DEFER_QUEUE_URL are counted in the body, visibility
+    deferrals in the receive count)
+    """
+    receive_count = int(record.get('attributes', {}).get('ApproximateReceiveCount', 1))
+    attempt = receive_count + int(message.get('deferrals', 0))
+    delay = min(max_delay, base_delay * 2 ** min(attempt - 1, 20))
+    return int(delay * random.uniform(0.5, 1.0)) + 1
+
+
+def should_defer_bulk_message(message):
+    """
+    True while the interactive queue has INTERACTIVE_BACKLOG_THRESHOLD messages waiting or
+    in flight; counting in-flight ones keeps the two lanes from dispatching to the API at
+    the same time (SED/SER EC2 in-flight limit, deploy-new-lambdas.sh)
+    """
+    if message.get('priority_lane') != 'bulk' or not INTERACTIVE_QUEUE_URL:
+        return False
+
+    now = time.monotonic()
+    if now - interactive_backlog["checked_at"] >= INTERACTIVE_BACKLOG_CACHE_SECONDS:
+        try:
+            attributes = sqs.get_queue_attributes(
+                QueueUrl=INTERACTIVE_QUEUE_URL,
+                AttributeNames=["ApproximateNumberOfMessages", "ApproximateNumberOfMessagesNotVisible"],
+            )["Attributes"]
+            interactive_backlog["value"] = (
+                int(attributes["ApproximateNumberOfMessages"]) + int(attributes["ApproximateNumberOfMessagesNotVisible"])
+            )
+        except Exception as e:
+            # Unknown backlog: do not hold bulk work back
+            print(f"Warning: Could not read interactive queue depth: {e}")
+            interactive_backlog["value"] = 0
+        interactive_backlog["checked_at"] = now
+
+    return interactive_backlog["value"] >= max(INTERACTIVE_BACKLOG_THRESHOLD, 1)
+
+
+def get_queue_url(record):
+    # arn:aws:sqs:{region}:{account}:{queue} -> queue URL
+    _, _, _, region, account_id, queue_name = record['eventSourceARN'].split(':')
+    return f"https://sqs.{region}.amazonaws.com/{account_id}/{queue_name}"
+
+
+def defer_record(record, visibility_timeout):
+    if DEFER_QUEUE_URL:
+        # Parked in the defer queue by hold_deferred_records at the end of the invocation
+        deferred_delays[record['messageId']] = visibility_timeout
+        return
+    change_visibility(record, visibility_timeout)
+
+
+def change_visibility(record, visibility_timeout):
+    try:
+        sqs.change_message_visibility(
+            QueueUrl=get_queue_url(record),
+            ReceiptHandle=record['receiptHandle'],
+            VisibilityTimeout=min(visibility_timeout, 43200),
+        )
+    except Exception as e:
+        # The message still comes back after the queue's own visibility timeout
+        print(f"Warning: Could not delay message {record['messageId']}: {e}")
+
+
+def hold_deferred_records(groups, statuses):
+    """
+    Park each group's deferred record and the records skipped after it in DEFER_QUEUE_URL
+    as one message (group order kept), delayed by the deferral time
+
+    Parked records are marked 'held' and not returned as batchItemFailures. If the send
+    fails, the deferred record falls back to a visibility delay and the run is handed back.
+    """
+    entries = []
+    for records in groups:
+        start = next(
+            (position for position, record in enumerate(records) if record['messageId'] in deferred_delays),
+            None,
+        )
+        if start is None:
+            continue
+        run = [records[start]] + [
+            record for record in records[start + 1:] if statuses[record['messageId']] == 'skipped'
+        ]
+        entries.append((run, deferred_delays[records[start]['messageId']]))
+
+    for offset in range(0, len(entries), 10):
+        chunk = entries[offset:offset + 10]
+        try:
+            response = sqs.send_message_batch(
+                QueueUrl=DEFER_QUEUE_URL,
+                Entries=[
+                    {
+                        'Id': str(index),
+                        'MessageBody': json.dumps(build_deferred_envelope(run)),
+                        'DelaySeconds': max(0, min(int(delay), DEFER_MAX_DELAY_SECONDS)),
+                    }
+                    for index, (run, delay) in enumerate(chunk)
+                ],
+            )
+            failed = {int(entry['Id']) for entry in response.get('Failed', [])}
+        except Exception as e:
+            print(f"Warning: Could not park deferred messages: {e}")
+            failed = set(range(len(chunk)))
+
+        for index, (run, delay) in enumerate(chunk):
+            if index in failed:
+                change_visibility(run[0], delay)
+                continue
+            for record in run:
+                statuses[record['messageId']] = 'held'
+
+
+def build_deferred_envelope(run):
+    """
+    Defer queue message for one group run: everything needed to re-send it to its FIFO queue
+    The deferral count goes into each body; the new deduplication ID is derived from the
+    old one and the count, so a repeated forward within 5 minutes is dropped by SQS
+    """
+    messages = []
+    for record in run:
+        attributes = record.get('attributes', {})
+        body = json.loads(record['body'])
+        body['deferrals'] = int(body.get('deferrals', 0)) + 1
+        previous_id = attributes.get('MessageDeduplicationId', record['messageId'])
+        messages.append({
+            'group_id': attributes.get('MessageGroupId', record['messageId']),
+            'deduplication_id': hashlib.sha256(
+                f"{previous_id}-deferred-{body['deferrals']}".encode()
+            ).hexdigest()[:80],
+            'body': json.dumps(body),
+        })
+    return {'queue_url': get_queue_url(run[0]), 'messages': messages}
+
+
+def is_defer_queue_record(record):
+    return bool(DEFER_QUEUE_URL) and record['eventSourceARN'].split(':')[-1] == DEFER_QUEUE_URL.rsplit('/', 1)[-1]
+
+
+def forward_deferred_records(records):
+    """
+    Re-send parked group runs to their FIFO queues (in order, one SendMessageBatch per run)
+    A run that could not be fully sent is returned as a batchItemFailure and re-sent;
+    the entries that went through are dropped by FIFO deduplication.
+    """
+    batch_item_failures = []
+    for record in records:
+        envelope = json.loads(record['body'])
+        messages = envelope['messages']
+        try:
+            for offset in range(0, len(messages), 10):
+                response = sqs.send_message_batch(
+                    QueueUrl=envelope['queue_url'],
+                    Entries=[
+                        {
+                            'Id': str(index),
+                            'MessageBody': message['body'],
+                            'MessageGroupId': message['group_id'],
+                            'MessageDeduplicationId': message['deduplication_id'],
+                        }
+                        for index, message in enumerate(messages[offset:offset + 10])
+                    ],
+                )
+                if response.get('Failed'):
+                    raise RuntimeError(f"{len(response['Failed'])} entries failed: {response['Failed'][0].get('Message')}")
+        except Exception as e:
+            print(f"Error forwarding deferred messages {record['messageId']}: {e}")
+            batch_item_failures.append({"itemIdentifier": record['messageId']})
+
+    print(f"Forwarded {len(records) - len(batch_item_failures)} of {len(records)} deferred runs to {STAGE['label']} queues")
+    return {'batchItemFailures': batch_item_failures}
+
+
+def log_queue_wait(message):
+    enqueued_at = message.get('enqueued_at')
+    if not enqueued_at:
+        return
+
+    wait_ms = (datetime.now(timezone.utc) - datetime.fromisoformat(enqueued_at)).total_seconds() * 1000
+    print(f"Queue wait: lane={message.get('priority_lane', 'interactive')} stage={STAGE['label']} wait_ms={wait_ms:.0f}")
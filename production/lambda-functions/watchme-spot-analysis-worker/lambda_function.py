@@ -1,5 +1,7 @@
 import json
 import os
+import threading
+import time
 
 import boto3
 import requests
@@ -14,17 +16,108 @@ DASHBOARD_SUMMARY_QUEUE_URL = os.environ.get(
 
 FEATURE_STATUS_FIELDS = ("vibe_status", "behavior_status", "emotion_status")
 
+# Outbound timeouts are derived from the remaining Lambda time. API calls keep
+# DEADLINE_RESERVE_SECONDS for status updates and handing the message back, and are
+# not started with less than MIN_API_CALL_SECONDS left.
+API_TIMEOUT_SECONDS = 180
+SUPABASE_TIMEOUT_SECONDS = 10
+DEADLINE_RESERVE_SECONDS = float(os.environ.get("DEADLINE_RESERVE_SECONDS", "10"))
+MIN_API_CALL_SECONDS = float(os.environ.get("MIN_API_CALL_SECONDS", "20"))
+# Visibility is extended every interval while a message is in progress
+HEARTBEAT_INTERVAL_SECONDS = float(os.environ.get("HEARTBEAT_INTERVAL_SECONDS", "30"))
+HEARTBEAT_EXTENSION_SECONDS = int(os.environ.get("HEARTBEAT_EXTENSION_SECONDS", "90"))
+HANDBACK_DELAY_SECONDS = int(os.environ.get("HANDBACK_DELAY_SECONDS", "5"))
+
 sqs = boto3.client("sqs", region_name="ap-southeast-2")
+lambda_deadline = {"at": None}
 
 
-def lambda_handler(event, context):
-    print(f"Processing {len(event['Records'])} spot analysis messages")
+class DeadlineExceeded(Exception):
+    pass
+
 
-    for record in event["Records"]:
+def lambda_handler(event, context):
+    """
+    Messages that cannot finish before the Lambda timeout are handed back with a short
+    visibility delay and reported in batchItemFailures (the mapping must use
+    ReportBatchItemFailures), instead of being killed mid-call and redelivered later.
+    """
+    records = event["Records"]
+    print(f"Processing {len(records)} spot analysis messages")
+    lambda_deadline["at"] = time.monotonic() + context.get_remaining_time_in_millis() / 1000
+
+    for index, record in enumerate(records):
         message = json.loads(record["body"])
-        process_spot_analysis(message)
+        try:
+            with VisibilityHeartbeat(record):
+                process_spot_analysis(message)
+        except DeadlineExceeded as e:
+            remaining = records[index:]
+            print(f"{e}: handing back {len(remaining)} messages")
+            for pending in remaining:
+                set_visibility(pending, HANDBACK_DELAY_SECONDS)
+            return {"batchItemFailures": [{"itemIdentifier": r["messageId"]} for r in remaining]}
+
+    return {"batchItemFailures": []}
+
+
+def api_timeout():
+    """
+    Raises:
+        DeadlineExceeded: Less than MIN_API_CALL_SECONDS would be left for the call
+    """
+    if lambda_deadline["at"] is None:
+        return API_TIMEOUT_SECONDS
+    remaining = lambda_deadline["at"] - time.monotonic() - DEADLINE_RESERVE_SECONDS
+    if remaining < MIN_API_CALL_SECONDS:
+        raise DeadlineExceeded(f"Only {max(remaining, 0):.0f}s left for an API call")
+    return min(API_TIMEOUT_SECONDS, remaining)
+
+
+def supabase_timeout():
+    if lambda_deadline["at"] is None:
+        return SUPABASE_TIMEOUT_SECONDS
+    return max(1.0, min(SUPABASE_TIMEOUT_SECONDS, lambda_deadline["at"] - time.monotonic() - 1))
+
+
+class VisibilityHeartbeat:
+    """
+    Extend the record's visibility every HEARTBEAT_INTERVAL_SECONDS while the block runs,
+    so a long API call is not redelivered to another consumer
+    """
+
+    def __init__(self, record):
+        self.record = record
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def __enter__(self):
+        if self.record.get("receiptHandle"):
+            self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join()
+        return False
+
+    def run(self):
+        while not self.stopped.wait(HEARTBEAT_INTERVAL_SECONDS):
+            set_visibility(self.record, HEARTBEAT_EXTENSION_SECONDS)
 
-    return {"statusCode": 200, "body": json.dumps("Spot analysis completed")}
+
+def set_visibility(record, visibility_timeout):
+    # arn:aws:sqs:{region}:{account}:{queue} -> queue URL
+    _, _, _, region, account_id, queue_name = record["eventSourceARN"].split(":")
+    try:
+        sqs.change_message_visibility(
+            QueueUrl=f"https://sqs.{region}.amazonaws.com/{account_id}/{queue_name}",
+            ReceiptHandle=record["receiptHandle"],
+            VisibilityTimeout=visibility_timeout,
+        )
+    except Exception as e:
+        print(f"Warning: Could not change visibility of message {record['messageId']}: {e}")
 
 
 def process_spot_analysis(message):
@@ -102,7 +195,7 @@ def ensure_aggregator_completed(
         agg_response = requests.post(
             f"{API_BASE_URL}/aggregator/spot",
             json={"device_id": device_id, "recorded_at": recorded_at},
-            timeout=180,
+            timeout=api_timeout(),
         )
 
         if agg_response.status_code != 200:
@@ -133,51 +226,17 @@ def ensure_aggregator_completed(
 
 
 def claim_aggregator_processing(device_id, recorded_at, local_date):
-    aggregator_row = fetch_single_row(
-        "spot_aggregators",
+    # queued / processing are re-claimable so a redelivered message can take over;
+    # only a completed aggregator stops the run
+    claim = claim_stage(
+        "aggregator",
         device_id,
         recorded_at,
-        "aggregator_status,prompt",
+        ["pending", "failed", "queued", "processing"],
+        "processing",
+        local_date,
     )
-
-    if aggregator_row:
-        updated_rows = patch_rows(
-            "spot_aggregators",
-            {
-                "device_id": f"eq.{device_id}",
-                "recorded_at": f"eq.{recorded_at}",
-                "or": (
-                    "(aggregator_status.is.null,"
-                    "aggregator_status.eq.pending,"
-                    "aggregator_status.eq.failed,"
-                    "aggregator_status.eq.queued,"
-                    "aggregator_status.eq.processing)"
-                ),
-            },
-            {"aggregator_status": "processing"},
-        )
-        return bool(updated_rows) or not is_aggregator_completed(
-            fetch_single_row(
-                "spot_aggregators",
-                device_id,
-                recorded_at,
-                "aggregator_status,prompt",
-            )
-        )
-
-    payload = {
-        "device_id": device_id,
-        "recorded_at": recorded_at,
-        "prompt": "",
-        "context_data": {"pipeline_state": "processing"},
-        "aggregator_status": "processing",
-    }
-
-    if local_date:
-        payload["local_date"] = local_date
-
-    upsert_row("spot_aggregators", payload, "device_id,recorded_at")
-    return True
+    return claim["claimed"] or not claim["completed"]
 
 
 def ensure_profiler_completed(device_id, recorded_at, local_date, trigger_source):
@@ -196,7 +255,7 @@ def ensure_profiler_completed(device_id, recorded_at, local_date, trigger_source
         prof_response = requests.post(
             f"{API_BASE_URL}/profiler/spot-profiler",
             json={"device_id": device_id, "recorded_at": recorded_at},
-            timeout=180,
+            timeout=api_timeout(),
         )
 
         if prof_response.status_code != 200:
@@ -227,50 +286,15 @@ def ensure_profiler_completed(device_id, recorded_at, local_date, trigger_source
 
 
 def claim_profiler_processing(device_id, recorded_at, local_date):
-    profiler_row = fetch_single_row(
-        "spot_results",
+    claim = claim_stage(
+        "profiler",
         device_id,
         recorded_at,
-        "profiler_status,profile_result,summary,vibe_score",
+        ["pending", "failed", "queued", "processing"],
+        "processing",
+        local_date,
     )
-
-    if profiler_row:
-        updated_rows = patch_rows(
-            "spot_results",
-            {
-                "device_id": f"eq.{device_id}",
-                "recorded_at": f"eq.{recorded_at}",
-                "or": (
-                    "(profiler_status.is.null,"
-                    "profiler_status.eq.pending,"
-                    "profiler_status.eq.failed,"
-                    "profiler_status.eq.queued,"
-                    "profiler_status.eq.processing)"
-                ),
-            },
-            {"profiler_status": "processing"},
-        )
-        return bool(updated_rows) or not is_profiler_completed(
-            fetch_single_row(
-                "spot_results",
-                device_id,
-                recorded_at,
-                "profiler_status,profile_result,summary,vibe_score",
-            )
-        )
-
-    payload = {
-        "device_id": device_id,
-        "recorded_at": recorded_at,
-        "profile_result": {"pipeline_state": "processing"},
-        "profiler_status": "processing",
-    }
-
-    if local_date:
-        payload["local_date"] = local_date
-
-    upsert_row("spot_results", payload, "device_id,recorded_at")
-    return True
+    return claim["claimed"] or not claim["completed"]
 
 
 def get_feature_statuses(device_id, recorded_at):
@@ -282,7 +306,7 @@ def get_feature_statuses(device_id, recorded_at):
             "select": "vibe_status,behavior_status,emotion_status,local_date",
         },
         headers=supabase_headers(),
-        timeout=10,
+        timeout=supabase_timeout(),
     )
 
     if response.status_code != 200:
@@ -355,7 +379,7 @@ def fetch_single_row(table_name, device_id, recorded_at, select_clause):
             "select": select_clause,
         },
         headers=supabase_headers(),
-        timeout=10,
+        timeout=supabase_timeout(),
     )
 
     if response.status_code != 200:
@@ -368,26 +392,37 @@ def fetch_single_row(table_name, device_id, recorded_at, select_clause):
     return data[0] if data else None
 
 
-def upsert_row(table_name, payload, on_conflict):
+def claim_stage(stage, device_id, recorded_at, from_statuses, to_status, local_date=None):
+    """
+    Conditional status transition in one round trip (claim_spot_stage RPC, see
+    production/lambda-functions/supabase-claim-spot-stage.sql); inserts a placeholder
+    row if the recording has none yet
+
+    Returns:
+        dict with claimed, previous_status, new_status and completed
+    """
     response = requests.post(
-        f"{SUPABASE_URL}/rest/v1/{table_name}",
-        params={"on_conflict": on_conflict},
-        json=payload,
-        headers={
-            **supabase_headers(),
-            "Content-Type": "application/json",
-            "Prefer": "resolution=merge-duplicates,return=representation",
+        f"{SUPABASE_URL}/rest/v1/rpc/claim_spot_stage",
+        json={
+            "p_stage": stage,
+            "p_device_id": device_id,
+            "p_recorded_at": recorded_at,
+            "p_from_statuses": from_statuses,
+            "p_to_status": to_status,
+            "p_local_date": local_date,
         },
-        timeout=10,
+        headers={**supabase_headers(), "Content-Type": "application/json"},
+        timeout=supabase_timeout(),
     )
 
-    if response.status_code not in {200, 201}:
+    if response.status_code != 200:
         raise RuntimeError(
-            f"Failed to upsert into {table_name}: "
+            f"Failed to claim {stage} for {device_id}/{recorded_at}: "
             f"{response.status_code} {response.text}"
         )
 
-    return response.json()
+    data = response.json()
+    return data[0] if isinstance(data, list) else data
 
 
 def patch_rows(table_name, filters, payload):
@@ -400,7 +435,7 @@ def patch_rows(table_name, filters, payload):
             "Content-Type": "application/json",
             "Prefer": "return=representation",
         },
-        timeout=10,
+        timeout=supabase_timeout(),
     )
 
     if response.status_code not in {200, 204}:
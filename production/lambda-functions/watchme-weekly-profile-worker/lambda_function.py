@@ -1,6 +1,7 @@
 import json
 import requests
 import os
+import time
 from datetime import datetime, timedelta
 
 # Environment variables
@@ -10,6 +11,37 @@ SUPABASE_KEY = os.environ.get('SUPABASE_KEY')
 # Device IDs to process (comma-separated)
 DEVICE_IDS = os.environ.get('DEVICE_IDS', '9f7d6e27-98c3-4c19-bdfb-f7fda58b9a93').split(',')
 
+# API timeouts are derived from the remaining Lambda time (capped at API_TIMEOUT_SECONDS)
+# so a slow call fails cleanly instead of the whole invocation being killed.
+# A device is skipped when less than MIN_API_CALL_SECONDS would be left for each of its
+# remaining calls; the daily run picks it up again.
+API_TIMEOUT_SECONDS = 180
+DEADLINE_RESERVE_SECONDS = float(os.environ.get('DEADLINE_RESERVE_SECONDS', '10'))
+MIN_API_CALL_SECONDS = float(os.environ.get('MIN_API_CALL_SECONDS', '30'))
+
+lambda_deadline = {'at': None}
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+def api_timeout(calls=1):
+    """
+    Args:
+        calls: API calls still to make, including this one; the timeout leaves
+            MIN_API_CALL_SECONDS for each of the later ones
+
+    Raises:
+        DeadlineExceeded: Less than MIN_API_CALL_SECONDS would be left for one of the calls
+    """
+    if lambda_deadline['at'] is None:
+        return API_TIMEOUT_SECONDS
+    remaining = lambda_deadline['at'] - time.monotonic() - DEADLINE_RESERVE_SECONDS
+    if remaining < MIN_API_CALL_SECONDS * calls:
+        raise DeadlineExceeded(f"Only {max(remaining, 0):.0f}s left for {calls} API call(s)")
+    return min(API_TIMEOUT_SECONDS, remaining - MIN_API_CALL_SECONDS * (calls - 1))
+
 def get_latest_local_date(device_id):
     """
     Get the latest local_date from spot_features for a device
@@ -48,8 +80,10 @@ def lambda_handler(event, context):
     Processes the week containing the latest recording's date (Monday-Sunday)
 
     IMPORTANT: Uses local_date from device, NOT UTC calculation
+    Devices that cannot be processed before the Lambda timeout are reported with step 'deadline'
     """
 
+    lambda_deadline['at'] = time.monotonic() + context.get_remaining_time_in_millis() / 1000
     print(f"Starting Weekly Profile Worker")
     print(f"Processing {len(DEVICE_IDS)} device(s)")
 
@@ -83,6 +117,9 @@ def lambda_handler(event, context):
             print(f"Yesterday (device time): {yesterday.isoformat()}")
             print(f"Week start date (Monday): {week_start_date.isoformat()}")
 
+            # Both API calls must fit before the Lambda deadline
+            api_timeout(calls=2)
+
             # Step 1: Call Weekly Aggregator API
             aggregator_result = call_weekly_aggregator_api(device_id, week_start_date)
 
@@ -96,6 +133,20 @@ def lambda_handler(event, context):
                 })
                 continue
 
+            # The aggregator may have used most of its timeout: re-check before the profiler
+            try:
+                api_timeout()
+            except DeadlineExceeded as e:
+                print(f"Deferring profiler for {device_id}: {str(e)}")
+                results.append({
+                    'device_id': device_id,
+                    'success': False,
+                    'error': str(e),
+                    'step': 'deadline',
+                    'aggregator_completed': True
+                })
+                continue
+
             # Step 2: Call Weekly Profiler API
             profiler_result = call_weekly_profiler_api(device_id, week_start_date)
 
@@ -119,6 +170,15 @@ def lambda_handler(event, context):
                 'profiler_memorable_events': profiler_result.get('memorable_events_count', 0)
             })
 
+        except DeadlineExceeded as e:
+            print(f"Skipping device {device_id}: {str(e)}")
+            results.append({
+                'device_id': device_id,
+                'success': False,
+                'error': str(e),
+                'step': 'deadline'
+            })
+
         except Exception as e:
             print(f"Error processing device {device_id}: {str(e)}")
             results.append({
@@ -162,6 +222,8 @@ def call_weekly_aggregator_api(device_id, week_start_date):
     Returns:
         dict: {'success': bool, 'spot_count': int, 'error': str}
     """
+    # Leave time for the profiler call that follows
+    timeout = api_timeout(calls=2)
     try:
         url = f"{API_BASE_URL}/aggregator/weekly"
         payload = {
@@ -175,7 +237,7 @@ def call_weekly_aggregator_api(device_id, week_start_date):
         response = requests.post(
             url,
             json=payload,
-            timeout=180
+            timeout=timeout
         )
 
         if response.status_code == 200:
@@ -205,7 +267,7 @@ def call_weekly_aggregator_api(device_id, week_start_date):
         print("Weekly Aggregator API timeout")
         return {
             'success': False,
-            'error': 'API timeout after 180 seconds'
+            'error': f'API timeout after {timeout:.0f} seconds'
         }
 
     except Exception as e:
@@ -227,6 +289,7 @@ def call_weekly_profiler_api(device_id, week_start_date):
     Returns:
         dict: {'success': bool, 'memorable_events_count': int, 'error': str}
     """
+    timeout = api_timeout()
     try:
         url = f"{API_BASE_URL}/profiler/weekly-profiler"
         payload = {
@@ -240,7 +303,7 @@ def call_weekly_profiler_api(device_id, week_start_date):
         response = requests.post(
             url,
             json=payload,
-            timeout=180
+            timeout=timeout
         )
 
         if response.status_code == 200:
@@ -271,7 +334,7 @@ def call_weekly_profiler_api(device_id, week_start_date):
         print("Weekly Profiler API timeout")
         return {
             'success': False,
-            'error': 'API timeout after 180 seconds'
+            'error': f'API timeout after {timeout:.0f} seconds'
         }
 
     except Exception as e:
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+"""
+WatchMe Audio Fan-out Benchmark
+===============================
+watchme-audio-processor の ASR/SED/SER へのファンアウトについて、
+変更前（ハンドラ内で boto3 クライアントを作成し、3キューへ順番に send_message）と
+現在の lambda_handler（モジュールで1回作成したクライアントで、ステージごとに並列に
+SendMessageBatch）のハンドラ処理時間（p50 / p95 / p99）をスタブSQSで比較するスクリプト
+
+- スタブSQSは1回の呼び出しごとに --sqs-latency-ms（対数正規分布のジッター付き）待つ
+- 変更前の経路では、本物の boto3.client('sqs') の作成コストも計測に含める（通信はしない）
+- audio_files の参照はスタブに置き換える（--lookup-ms 待つ。両方の経路で同じ）
+- 同じイベントで両方の経路が送った MessageDeduplicationId が一致することも確認する
+
+使用方法:
+    python3 audio_fanout_benchmark.py [--invocations 200] [--records 1]
+        [--sqs-latency-ms 20] [--lookup-ms 0] [--seed 0] [--json]
+
+オプション:
+    --invocations    : 各経路のハンドラ呼び出し回数
+    --records        : 1イベントあたりのS3レコード数（変更前の経路はレコードごとに順番に処理）
+    --sqs-latency-ms : スタブSQSの1呼び出しあたりの平均応答時間（ミリ秒）
+    --lookup-ms      : audio_files 参照の応答時間（ミリ秒）
+    --seed           : ジッターの乱数シード
+    --json           : 結果をJSON形式で出力
+
+依存: boto3 / requests がインストールされていること（numpy はQC・正規化音声を有効にしたときだけ必要）
+"""
+
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import math
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+from types import SimpleNamespace
+
+import boto3
+
+PROCESSOR_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "..",
+    "lambda-functions",
+    "watchme-audio-processor",
+    "lambda_function.py",
+)
+DEVICE_ID = "d067d407-cf73-4174-a9c1-d91fb60d64d0"
+
+
+class StubSQS:
+    """
+    send_message / send_message_batch のスタブ（呼び出しごとに応答時間だけ待つ）
+    """
+
+    def __init__(self, latency_ms, seed):
+        self.latency_ms = latency_ms
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.dedup_ids = []
+
+    def wait(self):
+        with self.lock:
+            self.calls += 1
+            # 平均が latency_ms になる対数正規分布（sigma 0.5）
+            delay = self.latency_ms * self.rng.lognormvariate(-0.125, 0.5)
+        time.sleep(delay / 1000)
+
+    def send_message(self, QueueUrl, MessageBody, MessageGroupId, MessageDeduplicationId):
+        self.wait()
+        with self.lock:
+            self.dedup_ids.append(MessageDeduplicationId)
+            return {"MessageId": f"stub-{self.calls}"}
+
+    def send_message_batch(self, QueueUrl, Entries):
+        self.wait()
+        with self.lock:
+            self.dedup_ids.extend(entry["MessageDeduplicationId"] for entry in Entries)
+            return {
+                "Successful": [{"Id": entry["Id"], "MessageId": f"stub-{self.calls}-{entry['Id']}"} for entry in Entries],
+                "Failed": [],
+            }
+
+
+def load_processor():
+    for flag in ("QC_ENABLED", "CANONICAL_AUDIO_ENABLED", "CONTENT_DEDUP_ENABLED"):
+        os.environ[flag] = "false"
+    os.environ["STAGE_REGISTRY_SOURCE"] = "env"
+    spec = importlib.util.spec_from_file_location("audio_processor", PROCESSOR_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def baseline_handler(processor, stub, event, context, lookup):
+    """
+    変更前のハンドラのファンアウト部分（クライアントをハンドラ内で作成し、3キューへ順番に送信）
+    """
+    boto3.client("sqs", region_name="ap-southeast-2")
+    for record in event["Records"]:
+        object_key = record["s3"]["object"]["key"]
+        recorded_at, device_id, _ = lookup([object_key])[object_key]
+        message_body = json.dumps({
+            "file_path": object_key,
+            "device_id": device_id,
+            "recorded_at": recorded_at,
+            "bucket_name": record["s3"]["bucket"]["name"],
+            "timestamp": context.aws_request_id,
+        })
+        for _, api_type, queue_url, _ in processor.FEATURE_QUEUES:
+            stub.send_message(
+                QueueUrl=queue_url,
+                MessageBody=message_body,
+                MessageGroupId=f"{device_id}-{api_type}",
+                MessageDeduplicationId=processor.get_deduplication_id(device_id, recorded_at, api_type),
+            )
+
+
+def build_event(invocation, records):
+    keys = [
+        f"files/{DEVICE_ID}/2025-01-01/{invocation:04d}-{index}/audio.wav"
+        for index in range(records)
+    ]
+    return {
+        "Records": [
+            {"s3": {"bucket": {"name": "watchme-vault"}, "object": {"key": key, "eTag": f'"{key}"'}}}
+            for key in keys
+        ]
+    }
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def summarize(name, samples, stub):
+    return {
+        "path": name,
+        "p50_ms": round(percentile(samples, 0.50), 2),
+        "p95_ms": round(percentile(samples, 0.95), 2),
+        "p99_ms": round(percentile(samples, 0.99), 2),
+        "mean_ms": round(statistics.mean(samples), 2),
+        "sqs_calls": stub.calls,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Audio processor fan-out latency benchmark")
+    parser.add_argument("--invocations", type=int, default=200)
+    parser.add_argument("--records", type=int, default=1)
+    parser.add_argument("--sqs-latency-ms", type=float, default=20)
+    parser.add_argument("--lookup-ms", type=float, default=0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args()
+
+    processor = load_processor()
+
+    def lookup(file_paths):
+        time.sleep(args.lookup_ms / 1000)
+        return {file_path: ("2025-01-01T00:00:00+00:00", DEVICE_ID, None) for file_path in file_paths}
+
+    processor.get_recorded_at_from_audio_files = lookup
+    context = SimpleNamespace(aws_request_id="audio-fanout-benchmark")
+
+    baseline_stub = StubSQS(args.sqs_latency_ms, args.seed)
+    current_stub = StubSQS(args.sqs_latency_ms, args.seed)
+    processor.sqs = current_stub
+    baseline_samples = []
+    current_samples = []
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        # Warm-up: stage registry load and first-call imports are not part of the comparison
+        processor.lambda_handler(build_event(-1, 1), context)
+        current_stub.calls = 0
+        current_stub.dedup_ids.clear()
+
+        for invocation in range(args.invocations):
+            event = build_event(invocation, args.records)
+
+            started = time.perf_counter()
+            baseline_handler(processor, baseline_stub, event, context, lookup)
+            baseline_samples.append((time.perf_counter() - started) * 1000)
+
+            started = time.perf_counter()
+            processor.lambda_handler(event, context)
+            current_samples.append((time.perf_counter() - started) * 1000)
+
+    results = [
+        summarize("before (per-invocation client, sequential send_message)", baseline_samples, baseline_stub),
+        summarize("after (module client, concurrent SendMessageBatch)", current_samples, current_stub),
+    ]
+    dedup_ids_match = sorted(baseline_stub.dedup_ids) == sorted(current_stub.dedup_ids)
+
+    if args.json:
+        print(json.dumps({"results": results, "dedup_ids_match": dedup_ids_match}, indent=2))
+    else:
+        print(
+            f"{args.invocations} invocations x {args.records} records, "
+            f"stub SQS {args.sqs_latency_ms:g} ms/call, lookup {args.lookup_ms:g} ms"
+        )
+        print(f"{'path':<58} {'p50':>8} {'p95':>8} {'p99':>8} {'mean':>8} {'calls':>6}")
+        for result in results:
+            print(
+                f"{result['path']:<58} {result['p50_ms']:>8.2f} {result['p95_ms']:>8.2f} "
+                f"{result['p99_ms']:>8.2f} {result['mean_ms']:>8.2f} {result['sqs_calls']:>6}"
+            )
+        print(f"deduplication IDs identical: {'yes' if dedup_ids_match else 'NO'}")
+    sys.exit(0 if dedup_ids_match else 1)
+
+
+if __name__ == "__main__":
+    main()
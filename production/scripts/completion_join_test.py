@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+WatchMe Completion Join Concurrency Test
+========================================
+watchme-aggregator-checker の SQLiteCompletionStore（feature_completion_masks の
+ローカル代替）に対して、同じ録音のビットを複数の接続から同時に立て、
+マスクが揃う遷移（previous_mask != 7 かつ mask == 7）を見るのが
+ちょうど1呼び出しだけであることを確認するスクリプト
+
+各ラウンドで vibe / behavior / emotion の3ビットを、重複通知（同じビットの再送）を
+含めて --claimers 本のスレッドから同時に set_bits する。スレッドごとに別の
+SQLiteCompletionStore（別接続 = 別コンテナ相当）を使う。
+
+使用方法:
+    python3 completion_join_test.py [--claimers 12] [--rounds 50] [--db /tmp/completion_join_test.db]
+
+オプション:
+    --claimers : 同時に set_bits する接続数（3以上。3ビットを順に割り当てる）
+    --rounds   : 試行回数（毎回別の録音を使う）
+    --db       : テスト用 SQLite ファイル（開始時に削除する）
+
+依存: aggregator-checker の依存（boto3 / requests）がインストールされていること
+"""
+
+import argparse
+import importlib.util
+import os
+import sys
+import threading
+from datetime import datetime, timedelta, timezone
+
+CHECKER_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "..",
+    "lambda-functions",
+    "watchme-aggregator-checker",
+    "lambda_function.py",
+)
+DEVICE_ID = "d067d407-cf73-4174-a9c1-d91fb60d64d0"
+
+
+def load_checker():
+    spec = importlib.util.spec_from_file_location("aggregator_checker", CHECKER_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def run_round(checker, args, recorded_at):
+    """
+    1録音分のビットを同時に立て、(完了遷移を見た数, 最終マスク) を返す
+    """
+    bits = list(checker.FEATURE_COMPLETION_BITS.values())
+    stores = [checker.SQLiteCompletionStore(args.db) for _ in range(args.claimers)]
+    barrier = threading.Barrier(args.claimers)
+    outcomes = [None] * args.claimers
+    errors = []
+
+    def set_bits(index):
+        try:
+            barrier.wait()
+            outcomes[index] = stores[index].set_bits(DEVICE_ID, recorded_at, bits[index % len(bits)])
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=set_bits, args=(i,)) for i in range(args.claimers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for store in stores:
+        store.conn.close()
+
+    if errors:
+        raise errors[0]
+
+    full = checker.FEATURE_COMPLETION_MASK
+    transitions = sum(1 for previous, mask in outcomes if previous != full and mask == full)
+    return transitions, max(mask for _, mask in outcomes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="completion join concurrency test")
+    parser.add_argument("--claimers", type=int, default=12)
+    parser.add_argument("--rounds", type=int, default=50)
+    parser.add_argument("--db", default="/tmp/completion_join_test.db")
+    args = parser.parse_args()
+
+    if args.claimers < 3:
+        parser.error("--claimers must be at least 3 (one per feature bit)")
+    if os.path.exists(args.db):
+        os.remove(args.db)
+
+    checker = load_checker()
+    base = datetime(2025, 1, 1, tzinfo=timezone.utc)
+    failures = []
+
+    for round_index in range(args.rounds):
+        recorded_at = (base + timedelta(minutes=10 * round_index)).isoformat()
+        transitions, mask = run_round(checker, args, recorded_at)
+        if transitions != 1 or mask != checker.FEATURE_COMPLETION_MASK:
+            failures.append(f"round {round_index}: {transitions} transitions, final mask {mask:03b}")
+
+    # 同じ録音を別表記の recorded_at で送っても同じ行になること
+    store = checker.SQLiteCompletionStore(args.db)
+    store.set_bits(DEVICE_ID, "2030-01-01T09:00:00+09:00", 1)
+    _, mask = store.set_bits(DEVICE_ID, "2030-01-01T00:00:00+00:00", 6)
+    if mask != checker.FEATURE_COMPLETION_MASK:
+        failures.append(f"timestamp normalization: final mask {mask:03b}")
+    store.conn.close()
+
+    print(
+        f"{'OK  ' if not failures else 'FAIL'} {args.rounds} rounds x {args.claimers} "
+        f"concurrent set_bits: exactly one completing transition per recording"
+    )
+    for failure in failures[:5]:
+        print(f"     {failure}")
+    sys.exit(0 if not failures else 1)
+
+
+if __name__ == "__main__":
+    main()
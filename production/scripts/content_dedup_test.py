@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+"""
+WatchMe Content Dedup Test
+==========================
+watchme-audio-processor のコンテンツハッシュ重複排除を、SQLiteの代替インデックス
+（CONTENT_DEDUP_BACKEND=sqlite）とスタブSQSで確認するスクリプト
+
+lambda_handler に S3 イベントを流し、シナリオごとに結果の status と
+SQSへの送信件数を確認する。audio_files の参照はスクリプト内の辞書で置き換え、
+spot_features のステージ状態もスクリプト内の辞書で置き換え、
+Supabase / SQS / S3 には接続しない（ETagをキーにするためS3の読み込みもない）。
+
+- 同じ録音の再送（同じETag・同じ recorded_at）は、前回のステージが処理中・完了なら duplicate になり、送信しない
+- 前回のステージが failed、または spot_features に行がない場合は再びファンアウトする
+- recorded_at の表記違い（Z / +00:00）も同じ録音として扱う
+- 同じ音声でも別の録音（recorded_at が異なる）はファンアウトする
+- 1イベント内の同じオブジェクトは1回だけファンアウトする
+- 送信に失敗した録音はインデックスに登録されず、再送でファンアウトされる
+- 有効期限（CONTENT_DEDUP_TTL_HOURS）を過ぎたエントリは使わない
+
+使用方法:
+    python3 content_dedup_test.py [--db /tmp/content_dedup_test.db]
+
+オプション:
+    --db : テスト用 SQLite ファイル（開始時に削除する）
+
+依存: boto3 / requests がインストールされていること（numpy はQC・正規化音声を有効にしたときだけ必要）
+"""
+
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import sys
+from types import SimpleNamespace
+
+PROCESSOR_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "..",
+    "lambda-functions",
+    "watchme-audio-processor",
+    "lambda_function.py",
+)
+DEVICE_ID = "d067d407-cf73-4174-a9c1-d91fb60d64d0"
+
+
+class StubSQS:
+    """
+    send_message_batch のスタブ（fail_paths の file_path を含むエントリは失敗させる）
+    """
+
+    def __init__(self):
+        self.sent = []
+        self.fail_paths = set()
+
+    def send_message_batch(self, QueueUrl, Entries):
+        successful, failed = [], []
+        for entry in Entries:
+            if json.loads(entry["MessageBody"])["file_path"] in self.fail_paths:
+                failed.append({"Id": entry["Id"], "Code": "InternalError", "Message": "stub failure"})
+                continue
+            self.sent.append(entry)
+            successful.append({"Id": entry["Id"], "MessageId": f"stub-{len(self.sent)}"})
+        return {"Successful": successful, "Failed": failed}
+
+
+def load_processor(db_path):
+    os.environ["CONTENT_DEDUP_ENABLED"] = "true"
+    os.environ["CONTENT_DEDUP_BACKEND"] = "sqlite"
+    os.environ["CONTENT_DEDUP_SQLITE_PATH"] = db_path
+    os.environ["CONTENT_DEDUP_KEY"] = "etag"
+    os.environ["STAGE_REGISTRY_SOURCE"] = "env"
+    spec = importlib.util.spec_from_file_location("audio_processor", PROCESSOR_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def build_event(uploads):
+    return {
+        "Records": [
+            {"s3": {"bucket": {"name": "watchme-vault"}, "object": {"key": file_path, "eTag": etag}}}
+            for file_path, etag in uploads
+        ]
+    }
+
+
+def run_scenario(processor, stub, audio_files, name, uploads, expected):
+    """
+    uploads: [(file_path, etag, recorded_at)], expected: 録音ごとの status
+    """
+    for file_path, _, recorded_at in uploads:
+        audio_files[file_path] = (recorded_at, DEVICE_ID, None)
+
+    sent_before = len(stub.sent)
+    with contextlib.redirect_stdout(io.StringIO()):
+        response = processor.lambda_handler(
+            build_event([(file_path, etag) for file_path, etag, _ in uploads]),
+            SimpleNamespace(
+                aws_request_id="content-dedup-test",
+                invoked_function_arn="arn:aws:lambda:ap-southeast-2:754724220380:function:watchme-audio-processor",
+                get_remaining_time_in_millis=lambda: 30000,
+            ),
+        )
+    statuses = [result["status"] for result in json.loads(response["body"])["results"]]
+    stages = len(processor.get_stage_registry())
+    expected_sent = stages * sum(1 for status in expected if status == "queued")
+    sent = len(stub.sent) - sent_before
+
+    ok = statuses == expected and sent == expected_sent
+    print(f"{'OK  ' if ok else 'FAIL'} {name:<48} {statuses} ({sent} messages)")
+    if not ok:
+        print(f"     expected {expected} ({expected_sent} messages)")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="content dedup test")
+    parser.add_argument("--db", default="/tmp/content_dedup_test.db")
+    args = parser.parse_args()
+
+    if os.path.exists(args.db):
+        os.remove(args.db)
+
+    processor = load_processor(args.db)
+    stub = StubSQS()
+    audio_files = {}
+    processor.sqs = stub
+    # Failed sends are re-submitted to the function; accept without invoking anything
+    processor.lambda_client = SimpleNamespace(invoke=lambda **kwargs: {"StatusCode": 202})
+    processor.get_recorded_at_from_audio_files = lambda file_paths: {
+        file_path: audio_files[file_path] for file_path in file_paths if file_path in audio_files
+    }
+    # spot_features statuses by recorded_at (as registered in the index)
+    stage_statuses = {}
+    processor.get_stage_statuses = lambda device_id, recorded_at: stage_statuses.get(recorded_at, {})
+    processing = {field: "processing" for field in processor.FEATURE_STATUS_FIELDS.values()}
+
+    first = f"files/{DEVICE_ID}/2025-01-01/09-00/audio.wav"
+    second = f"files/{DEVICE_ID}/2025-01-01/15-00/audio.wav"
+    third = f"files/{DEVICE_ID}/2025-01-01/16-00/audio.wav"
+    failing = f"files/{DEVICE_ID}/2025-01-01/17-00/audio.wav"
+    expiring = f"files/{DEVICE_ID}/2025-01-01/18-00/audio.wav"
+    unstarted = f"files/{DEVICE_ID}/2025-01-01/19-00/audio.wav"
+
+    stage_statuses["2025-01-01T00:00:00+00:00"] = processing
+    stage_statuses["2025-01-01T07:00:00+00:00"] = processing
+    passed = [
+        run_scenario(processor, stub, audio_files, "first upload",
+                     [(first, '"etag-a"', "2025-01-01T00:00:00+00:00")], ["queued"]),
+        run_scenario(processor, stub, audio_files, "retried PUT of the same recording",
+                     [(first, '"etag-a"', "2025-01-01T00:00:00+00:00")], ["duplicate"]),
+        run_scenario(processor, stub, audio_files, "same recording, recorded_at in Z form",
+                     [(first, '"etag-a"', "2025-01-01T00:00:00Z")], ["duplicate"]),
+        run_scenario(processor, stub, audio_files, "same content under another recording",
+                     [(second, '"etag-a"', "2025-01-01T06:00:00+00:00")], ["queued"]),
+        run_scenario(processor, stub, audio_files, "same object twice in one event",
+                     [(third, '"etag-b"', "2025-01-01T07:00:00+00:00")] * 2, ["queued", "duplicate"]),
+    ]
+
+    # Earlier fan-out was queued but a stage failed downstream: fanned out again
+    stage_statuses["2025-01-01T00:00:00+00:00"] = {**processing, "behavior_status": "failed"}
+    passed.append(run_scenario(processor, stub, audio_files, "re-upload after a failed stage",
+                               [(first, '"etag-a"', "2025-01-01T00:00:00+00:00")], ["queued"]))
+    stage_statuses["2025-01-01T00:00:00+00:00"] = {field: "completed" for field in processing}
+    passed.append(run_scenario(processor, stub, audio_files, "re-upload after all stages completed",
+                               [(first, '"etag-a"', "2025-01-01T00:00:00+00:00")], ["duplicate"]))
+    passed.append(run_scenario(processor, stub, audio_files, "upload without spot_features row",
+                               [(unstarted, '"etag-e"', "2025-01-01T10:00:00+00:00")], ["queued"]))
+    passed.append(run_scenario(processor, stub, audio_files, "re-upload with no results yet",
+                               [(unstarted, '"etag-e"', "2025-01-01T10:00:00+00:00")], ["queued"]))
+
+    stub.fail_paths = {failing}
+    passed.append(run_scenario(processor, stub, audio_files, "failed send is not registered",
+                               [(failing, '"etag-c"', "2025-01-01T08:00:00+00:00")], ["failed"]))
+    stub.fail_paths = set()
+    passed.append(run_scenario(processor, stub, audio_files, "retry after the failed send",
+                               [(failing, '"etag-c"', "2025-01-01T08:00:00+00:00")], ["queued"]))
+
+    processor.CONTENT_DEDUP_TTL_HOURS = -1
+    passed.append(run_scenario(processor, stub, audio_files, "entry registered already expired",
+                               [(expiring, '"etag-d"', "2025-01-01T09:00:00+00:00")], ["queued"]))
+    passed.append(run_scenario(processor, stub, audio_files, "expired entry is ignored",
+                               [(expiring, '"etag-d"', "2025-01-01T09:00:00+00:00")], ["queued"]))
+
+    # Content keys contain ':' and must be quoted in the PostgREST in.() filter
+    in_filter = processor.format_in_filter([f"{DEVICE_ID}:etag:abc", "a,b"])
+    expected_filter = f'in.("{DEVICE_ID}:etag:abc","a,b")'
+    ok = in_filter == expected_filter
+    print(f"{'OK  ' if ok else 'FAIL'} {'in.() filter quotes content keys':<48} {in_filter}")
+    passed.append(ok)
+
+    processor.get_content_index().conn.close()
+    sys.exit(0 if all(passed) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+"""
+WatchMe Fan-out Retry Test
+==========================
+watchme-audio-processor で送信に失敗したレコードが、実際に再送されることを
+スタブSQSとスタブLambdaクライアントで確認するスクリプト
+
+lambda_handler に S3 イベントを流し、失敗したレコードだけを含むイベントが
+非同期 invoke で再投入されること、そのイベントを処理すると送信されることを確認する。
+audio_files の参照はスクリプト内の辞書で置き換え、Supabase / SQS / Lambda には接続しない。
+
+- 1レコードのSED送信が失敗すると、そのレコードだけが attempt 1 として再投入される
+  （fanoutRetryStages は失敗したステージ ["sed"] だけ）
+- 再投入イベントの処理で、そのレコードが queued になり、SEDだけが再送される
+- 再投入できない場合は FanOutError を送出する（Lambdaの非同期リトライに任せる）
+- FANOUT_RETRY_MAX_ATTEMPTS 回失敗し続けた場合も FanOutError を送出する
+- device_id を判定できないレコードは再投入しない
+
+使用方法:
+    python3 fanout_retry_test.py
+
+依存: boto3 / requests がインストールされていること
+"""
+
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import sys
+from types import SimpleNamespace
+
+PROCESSOR_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "..",
+    "lambda-functions",
+    "watchme-audio-processor",
+    "lambda_function.py",
+)
+DEVICE_ID = "d067d407-cf73-4174-a9c1-d91fb60d64d0"
+FUNCTION_ARN = "arn:aws:lambda:ap-southeast-2:754724220380:function:watchme-audio-processor"
+
+
+class StubSQS:
+    """
+    send_message_batch のスタブ（fail の (api_type, file_path) を含むエントリは失敗させる）
+    """
+
+    def __init__(self, processor):
+        self.queue_types = {
+            queue_url: api_type for _, api_type, queue_url, _ in processor.FEATURE_QUEUES
+        }
+        self.sent = []
+        self.fail = set()
+
+    def send_message_batch(self, QueueUrl, Entries):
+        api_type = self.queue_types[QueueUrl]
+        successful, failed = [], []
+        for entry in Entries:
+            file_path = json.loads(entry["MessageBody"])["file_path"]
+            if (api_type, file_path) in self.fail:
+                failed.append({"Id": entry["Id"], "Code": "InternalError", "Message": "stub failure"})
+                continue
+            self.sent.append((api_type, file_path))
+            successful.append({"Id": entry["Id"], "MessageId": f"stub-{len(self.sent)}"})
+        return {"Successful": successful, "Failed": failed}
+
+
+class StubLambda:
+    """
+    invoke のスタブ（InvocationType=Event の再投入イベントを記録する）
+    """
+
+    def __init__(self):
+        self.events = []
+        self.reject = False
+
+    def invoke(self, FunctionName, InvocationType, Payload):
+        if self.reject:
+            raise RuntimeError("stub invoke failure")
+        assert FunctionName == FUNCTION_ARN and InvocationType == "Event"
+        self.events.append(json.loads(Payload))
+        return {"StatusCode": 202}
+
+
+def load_processor():
+    os.environ["STAGE_REGISTRY_SOURCE"] = "env"
+    os.environ["CONTENT_DEDUP_ENABLED"] = "false"
+    os.environ["FANOUT_RETRY_DELAY_SECONDS"] = "0"
+    spec = importlib.util.spec_from_file_location("audio_processor", PROCESSOR_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def build_event(file_paths):
+    return {
+        "Records": [
+            {"s3": {"bucket": {"name": "watchme-vault"}, "object": {"key": file_path, "eTag": f'"{file_path}"'}}}
+            for file_path in file_paths
+        ]
+    }
+
+
+def invoke(processor, event):
+    """
+    Returns:
+        (statuses, error): status per record, or the exception raised by the handler
+    """
+    context = SimpleNamespace(
+        aws_request_id="fanout-retry-test",
+        invoked_function_arn=FUNCTION_ARN,
+        get_remaining_time_in_millis=lambda: 30000,
+    )
+    with contextlib.redirect_stdout(io.StringIO()):
+        try:
+            response = processor.lambda_handler(event, context)
+        except Exception as e:
+            return None, e
+    return [result["status"] for result in json.loads(response["body"])["results"]], None
+
+
+def check(name, ok, detail):
+    print(f"{'OK  ' if ok else 'FAIL'} {name:<52} {detail}")
+    return ok
+
+
+def main():
+    processor = load_processor()
+    sqs = StubSQS(processor)
+    lambda_client = StubLambda()
+    processor.sqs = sqs
+    processor.lambda_client = lambda_client
+    processor.get_recorded_at_from_audio_files = lambda file_paths: {
+        file_path: ("2025-01-01T00:00:00+00:00", DEVICE_ID, None)
+        for file_path in file_paths if file_path.startswith("files/")
+    }
+
+    first = f"files/{DEVICE_ID}/2025-01-01/09-00/audio.wav"
+    second = f"files/{DEVICE_ID}/2025-01-01/09-30/audio.wav"
+    passed = []
+
+    # One record's SED send fails: only that record is re-submitted
+    sqs.fail = {("sed", second)}
+    statuses, error = invoke(processor, build_event([first, second]))
+    retry_event = lambda_client.events[-1] if lambda_client.events else {}
+    passed.append(check(
+        "failed record is re-submitted alone",
+        error is None and statuses == ["queued", "failed"] and len(lambda_client.events) == 1
+        and [record["s3"]["object"]["key"] for record in retry_event["Records"]] == [second]
+        and retry_event["fanoutRetry"] == {"attempt": 1}
+        and retry_event["Records"][0].get("fanoutRetryStages") == ["sed"],
+        f"{statuses} -> {len(lambda_client.events)} re-submitted event(s)",
+    ))
+
+    # The re-submitted event is processed once SQS accepts the message; ASR/SER are not sent again
+    sqs.fail = set()
+    sent_before = len(sqs.sent)
+    statuses, error = invoke(processor, retry_event)
+    resent = sqs.sent[sent_before:]
+    passed.append(check(
+        "re-submitted record is queued (failed stage only)",
+        error is None and statuses == ["queued"] and resent == [("sed", second)] and len(lambda_client.events) == 1,
+        f"{statuses}, re-sent {sorted(api_type for api_type, _ in resent)}",
+    ))
+
+    # Re-submission rejected: the invocation fails so Lambda's async retry applies
+    sqs.fail = {("asr", first)}
+    lambda_client.reject = True
+    _, error = invoke(processor, build_event([first]))
+    passed.append(check(
+        "failed re-submission raises FanOutError",
+        isinstance(error, processor.FanOutError),
+        repr(error),
+    ))
+    lambda_client.reject = False
+
+    # Send keeps failing: re-submitted up to FANOUT_RETRY_MAX_ATTEMPTS, then raised
+    event = build_event([first])
+    attempts = 0
+    error = None
+    while error is None and attempts <= processor.FANOUT_RETRY_MAX_ATTEMPTS:
+        _, error = invoke(processor, event)
+        if error is None:
+            event = lambda_client.events[-1]
+            attempts = event["fanoutRetry"]["attempt"]
+    passed.append(check(
+        "persistent failure raises after the last attempt",
+        isinstance(error, processor.FanOutError) and attempts == processor.FANOUT_RETRY_MAX_ATTEMPTS,
+        f"{attempts} re-submissions, then {error!r}",
+    ))
+    sqs.fail = set()
+
+    # A record without device_id cannot succeed on retry: reported only
+    events_before = len(lambda_client.events)
+    statuses, error = invoke(processor, build_event(["audio.wav"]))
+    passed.append(check(
+        "record without device_id is not re-submitted",
+        error is None and statuses == ["failed"] and len(lambda_client.events) == events_before,
+        f"{statuses}",
+    ))
+
+    sys.exit(0 if all(passed) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+"""
+WatchMe Feature Worker Batch Harness
+====================================
+ASR/SED/SER ワーカー（watchme-feature-worker）に成功と失敗が混在したSQSバッチを流し、
+スタブAPIへの重複ディスパッチ数を数えるローカル検証スクリプト
+
+- スタブAPIはローカルで起動し、指定した録音の最初の数回だけ 500 を返す
+- SQSの挙動（FIFO順、batchItemFailures のメッセージだけ再配信、例外時はバッチ全体を再配信）を再現する
+- すでに 202 を受け取った録音が再度ディスパッチされた回数を「重複」として数える
+- 同じ MessageGroupId の中で、前のメッセージより先に 202 を受け取ったメッセージを「順序違反」として数える
+- スタブAPIに応答遅延を入れると、1回の呼び出しあたりのバッチ処理時間（並列ディスパッチの効果）も確認できる
+- AIMD / サーキットブレーカーの共有状態はSQLiteの代替ストア（一時ファイル）を使う
+- 受付判定（バックプレッシャー）はスタブAPIの /health が返す queue_depth を使う
+- --batch-api を付けるとスタブAPIが /async-process/batch（バッチ投入の契約）にも応答する。
+  付けない場合は 404 を返し、ワーカーは1件ずつの投入にフォールバックする
+- --slow-ratio の割合のリクエストを --slow-ms 遅らせ、HTTPSのハングを再現する（ヘッジリクエストの確認用）。
+  スタブAPIは受信済みの Idempotency-Key のリクエストには最初の応答と同じステータスを返し、ヘッジとして数える
+
+使用方法:
+    python3 feature_worker_batch_harness.py [--worker asr] [--messages 50]
+        [--batch-size 10] [--groups 10] [--fail-ratio 0.2] [--fail-attempts 2]
+        [--api-delay-ms 0] [--max-concurrency N] [--breaker-open-seconds 1]
+        [--health-depth 0] [--batch-api] [--batch-max-items 10]
+        [--slow-ratio 0] [--slow-ms 3000] [--no-hedge] [--json] [--verbose]
+
+オプション:
+    --worker        : 対象ステージ（asr / sed / ser）
+    --messages      : メッセージ数
+    --batch-size    : 1回の呼び出しで渡すレコード数
+    --groups        : MessageGroupId の数（同じグループ内は順番に処理される）
+    --fail-ratio    : 失敗させる録音の割合
+    --fail-attempts : 失敗させる録音が 500 を返す回数
+    --api-delay-ms  : スタブAPIの応答遅延（ミリ秒）
+    --max-concurrency : ワーカーの MAX_CONCURRENCY（ステージ記述子の上限以下）
+    --breaker-open-seconds : サーキットブレーカーが開いている時間（本番の既定は60秒）
+    --health-depth  : スタブAPIの /health が返す queue_depth（ウォーターマーク以上なら全件後回し）
+    --batch-api     : スタブAPIでバッチ投入を有効化
+    --batch-max-items : ワーカーの BATCH_MAX_ITEMS（1 でバッチ投入を使わない）
+    --slow-ratio    : 応答を遅らせるリクエストの割合
+    --slow-ms       : 遅らせる時間（ミリ秒）
+    --no-hedge      : ヘッジリクエストを無効化（HEDGE_ENABLED=false）
+    --json          : 結果をJSON形式で出力
+    --verbose       : ワーカーのログを表示
+
+重複が1件でもあれば終了コード1で終了する
+"""
+
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+LAMBDA_FUNCTIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambda-functions")
+QUEUE_ARN = "arn:aws:sqs:ap-southeast-2:754724220380:watchme-harness-queue.fifo"
+
+
+class StubAPI:
+    """
+    async-process エンドポイントのスタブ（file_path ごとのディスパッチ数と 202 の数を記録）
+    """
+
+    def __init__(self, failing_paths, fail_attempts, delay_ms=0, health_depth=0, batch_api=False,
+                 slow_ratio=0.0, slow_ms=0, seed=0):
+        self.failing_paths = failing_paths
+        self.fail_attempts = fail_attempts
+        self.delay_ms = delay_ms
+        self.health_depth = health_depth
+        self.batch_api = batch_api
+        self.slow_ratio = slow_ratio
+        self.slow_ms = slow_ms
+        self.rng = random.Random(seed)
+        self.health_checks = 0
+        self.posts = 0
+        self.slow_requests = 0
+        self.hedges = 0
+        self.key_statuses = {}
+        self.dispatches = Counter()
+        self.accepted = Counter()
+        self.duplicates = Counter()
+        self.accept_order = []
+        self.lock = threading.Lock()
+
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                with stub.lock:
+                    stub.posts += 1
+                if self.path.endswith("/batch"):
+                    self.batch(body)
+                    return
+                key = self.headers.get("Idempotency-Key")
+                with stub.lock:
+                    hedge_status = stub.key_statuses.get(key)
+                    if hedge_status:
+                        stub.hedges += 1
+                    slow = stub.rng.random() < stub.slow_ratio
+                    stub.slow_requests += slow and not hedge_status
+                if hedge_status:
+                    # Same job as an earlier request: answer with its status, no second job
+                    self.send_response(hedge_status)
+                    self.end_headers()
+                    self.wfile.write(b"{}")
+                    return
+                status = stub.dispatch(body["file_path"])
+                with stub.lock:
+                    stub.key_statuses[key] = status
+                time.sleep((stub.slow_ms if slow else stub.delay_ms) / 1000)
+                self.send_response(status)
+                self.end_headers()
+                self.wfile.write(b"{}")
+
+            def batch(self, body):
+                # One round trip for the whole batch, one result per item in order
+                if not stub.batch_api:
+                    self.send_response(404)
+                    self.end_headers()
+                    self.wfile.write(b'{"detail": "Not Found"}')
+                    return
+                results = []
+                for item in body["items"]:
+                    status = stub.dispatch(item["file_path"])
+                    result = {"accepted": status == 202, "status": status}
+                    if status != 202:
+                        result["error"] = "stub failure"
+                    results.append(result)
+                time.sleep(stub.delay_ms / 1000)
+                payload = json.dumps({"results": results}).encode()
+                self.send_response(200 if all(r["accepted"] for r in results) else 207)
+                self.send_header("Content-Type", "application/json")
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_GET(self):
+                stub.health_checks += 1
+                body = json.dumps({"status": "healthy", "queue_depth": stub.health_depth}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/async-process"
+
+    def dispatch(self, file_path):
+        with self.lock:
+            self.dispatches[file_path] += 1
+            if self.accepted[file_path]:
+                self.duplicates[file_path] += 1
+            if file_path in self.failing_paths and self.dispatches[file_path] <= self.fail_attempts:
+                return 500
+            if not self.accepted[file_path]:
+                self.accept_order.append(file_path)
+            self.accepted[file_path] += 1
+            return 202
+
+    def close(self):
+        self.server.shutdown()
+
+
+def load_worker(worker, endpoint_url, max_concurrency=None, breaker_open_seconds=1.0, batch_max_items=None,
+                hedge=True):
+    os.environ["STAGE"] = worker
+    os.environ["HEDGE_ENABLED"] = str(hedge).lower()
+    if batch_max_items:
+        os.environ["BATCH_MAX_ITEMS"] = str(batch_max_items)
+    os.environ["BREAKER_OPEN_SECONDS"] = str(breaker_open_seconds)
+    if max_concurrency:
+        os.environ["MAX_CONCURRENCY"] = str(max_concurrency)
+    os.environ["API_ENDPOINT_URL"] = endpoint_url
+    os.environ["API_HOST_HEADER"] = ""
+    os.environ["INTERACTIVE_QUEUE_URL"] = ""
+    os.environ["ADMISSION_SOURCE"] = "health"
+    os.environ["ADMISSION_CACHE_SECONDS"] = "0"
+    os.environ["CONTROLLER_BACKEND"] = "sqlite"
+    os.environ["CONTROLLER_SQLITE_PATH"] = os.path.join(tempfile.mkdtemp(), "feature_api_controller.db")
+    path = os.path.join(LAMBDA_FUNCTIONS_DIR, "watchme-feature-worker", "lambda_function.py")
+    spec = importlib.util.spec_from_file_location(f"watchme_{worker}_worker", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def build_messages(count, groups):
+    messages = []
+    for i in range(count):
+        recorded_at = f"2025-01-01T{i // 6:02d}:{i % 6 * 10:02d}:00+00:00"
+        messages.append({
+            "messageId": f"msg-{i:04d}",
+            "receiptHandle": f"receipt-{i:04d}",
+            "eventSourceARN": QUEUE_ARN,
+            "attributes": {"MessageGroupId": f"harness-device-{i % groups}-asr"},
+            "body": json.dumps({
+                "file_path": f"files/harness-device/{recorded_at}/audio.wav",
+                "device_id": "harness-device",
+                "recorded_at": recorded_at,
+            }),
+        })
+    return messages
+
+
+def count_order_violations(messages, accept_order):
+    """
+    同じグループの直前のメッセージより先に受け付けられたメッセージの数
+    """
+    position = {file_path: index for index, file_path in enumerate(accept_order)}
+    last_by_group = {}
+    violations = 0
+    for record in messages:
+        group = record["attributes"]["MessageGroupId"]
+        file_path = json.loads(record["body"])["file_path"]
+        previous = last_by_group.get(group)
+        if previous in position and file_path in position and position[file_path] < position[previous]:
+            violations += 1
+        last_by_group[group] = file_path
+    return violations
+
+
+def run(worker, messages, batch_size, failing_paths, fail_attempts, delay_ms=0, max_concurrency=None,
+        breaker_open_seconds=1.0, health_depth=0, batch_api=False, batch_max_items=None,
+        slow_ratio=0.0, slow_ms=0, hedge=True, seed=0, verbose=False):
+    """
+    SQSの再配信をシミュレーションしながら全メッセージが成功するまでハンドラを呼び出す
+    ブレーカーが開いてAPIを呼ばなかった呼び出しの後は、少し待ってから再配信する
+    """
+    stub = StubAPI(failing_paths, fail_attempts, delay_ms, health_depth, batch_api, slow_ratio, slow_ms, seed)
+    module = load_worker(worker, stub.url, max_concurrency, breaker_open_seconds, batch_max_items, hedge)
+    queue = list(messages)
+    invocations = 0
+    redelivered = 0
+    idle_rounds = 0
+    elapsed = []
+    started_run = time.perf_counter()
+
+    try:
+        while queue:
+            batch, queue = queue[:batch_size], queue[batch_size:]
+            invocations += 1
+            started = time.perf_counter()
+            dispatches_before = sum(stub.dispatches.values())
+            try:
+                with contextlib.redirect_stdout(sys.stdout if verbose else io.StringIO()):
+                    response = module.lambda_handler({"Records": batch}, None) or {}
+                failed_ids = {item["itemIdentifier"] for item in response.get("batchItemFailures", [])}
+            except Exception:
+                # 例外時はバッチ全体が再配信される
+                failed_ids = {record["messageId"] for record in batch}
+            elapsed.append(time.perf_counter() - started)
+
+            retry = [record for record in batch if record["messageId"] in failed_ids]
+            redelivered += len(retry)
+            queue = retry + queue
+
+            if retry and sum(stub.dispatches.values()) == dispatches_before:
+                idle_rounds += 1
+                if health_depth and idle_rounds >= 5:
+                    # Over the watermark nothing is dispatched by design
+                    break
+                time.sleep(0.1)
+            else:
+                idle_rounds = 0
+            if invocations > 100 * len(messages):
+                raise RuntimeError("Harness did not converge")
+    finally:
+        stub.close()
+    total_sec = time.perf_counter() - started_run
+
+    return {
+        "worker": worker,
+        "max_concurrency": module.STAGE["max_concurrency"],
+        "batch_max_items": module.STAGE["batch"]["max_items"],
+        "batch_supported": module.batch_support["supported"],
+        "messages": len(messages),
+        "failing_messages": len(failing_paths),
+        "invocations": invocations,
+        "redelivered": redelivered,
+        "dispatches": sum(stub.dispatches.values()),
+        "http_posts": stub.posts,
+        "accepted": sum(stub.accepted.values()),
+        "duplicate_dispatches": sum(stub.duplicates.values()),
+        "order_violations": count_order_violations(messages, stub.accept_order),
+        "health_checks": stub.health_checks,
+        "slow_requests": stub.slow_requests,
+        "hedged_requests": stub.hedges,
+        "undelivered": len(queue),
+        "mean_invocation_ms": round(1000 * sum(elapsed) / len(elapsed), 1),
+        "p95_invocation_ms": round(1000 * sorted(elapsed)[int(0.95 * (len(elapsed) - 1))], 1),
+        "max_invocation_ms": round(1000 * max(elapsed), 1),
+        "throughput_per_sec": round(sum(stub.accepted.values()) / total_sec, 1),
+        "controller": module.controller.state() if module.controller else None,
+        "hedge": module.hedge_policy.state() if module.hedge_policy else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Feature worker partial batch failure harness")
+    parser.add_argument("--worker", choices=["asr", "sed", "ser"], default="asr")
+    parser.add_argument("--messages", type=int, default=50)
+    parser.add_argument("--batch-size", type=int, default=10)
+    parser.add_argument("--groups", type=int, default=10)
+    parser.add_argument("--fail-ratio", type=float, default=0.2)
+    parser.add_argument("--fail-attempts", type=int, default=2)
+    parser.add_argument("--api-delay-ms", type=int, default=0)
+    parser.add_argument("--max-concurrency", type=int)
+    parser.add_argument("--breaker-open-seconds", type=float, default=1.0)
+    parser.add_argument("--health-depth", type=int, default=0)
+    parser.add_argument("--batch-api", action="store_true")
+    parser.add_argument("--batch-max-items", type=int)
+    parser.add_argument("--slow-ratio", type=float, default=0.0)
+    parser.add_argument("--slow-ms", type=int, default=3000)
+    parser.add_argument("--no-hedge", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    messages = build_messages(args.messages, args.groups)
+    rng = random.Random(args.seed)
+    failing_paths = {
+        json.loads(record["body"])["file_path"]
+        for record in messages
+        if rng.random() < args.fail_ratio
+    }
+
+    result = run(
+        args.worker, messages, args.batch_size, failing_paths, args.fail_attempts,
+        args.api_delay_ms, args.max_concurrency, args.breaker_open_seconds, args.health_depth,
+        args.batch_api, args.batch_max_items, args.slow_ratio, args.slow_ms, not args.no_hedge, args.seed,
+        args.verbose
+    )
+
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        for key, value in result.items():
+            print(f"{key:<22} {value}")
+
+    sys.exit(1 if result["duplicate_dispatches"] else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+"""
+WatchMe Feature Worker Defer Test
+=================================
+watchme-feature-worker の後回し（バルクレーン・受付判定・ブレーカー）が、
+受信回数を消費しない待機キュー（DEFER_QUEUE_URL）経由で行われることをスタブSQSで確認するスクリプト
+
+- 後回しにしたレコードと、同じグループで後ろにあるレコードは1件の待機メッセージ
+  （DelaySeconds 付き）になり、batchItemFailures には含まれない
+- 待機キューのレコードは元のFIFOキューへ同じ順番・同じ MessageGroupId で再送され、
+  本文の deferrals が1増え、重複排除IDは元と異なる
+- 受付判定・バルクレーンのバックオフは deferrals に応じて伸び、上限で止まる
+- バルクメッセージはインタラクティブキューの待機中＋処理中が INTERACTIVE_BACKLOG_THRESHOLD 以上のときだけ後回しにする
+- 待機キューへの送信に失敗した場合は ChangeMessageVisibility に戻し、batchItemFailures で返す
+- ディスパッチの失敗は待機キューを使わず、従来どおり batchItemFailures で返す（受信回数に数える）
+- 再送に失敗した待機レコードは batchItemFailures で返す
+
+使用方法:
+    python3 feature_worker_defer_test.py
+
+依存: boto3 / requests がインストールされていること（AWS / APIには接続しない）
+"""
+
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import sys
+
+WORKER_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "..",
+    "lambda-functions",
+    "watchme-feature-worker",
+    "lambda_function.py",
+)
+QUEUE_ARN = "arn:aws:sqs:ap-southeast-2:754724220380:watchme-sed-queue-v2.fifo"
+QUEUE_URL = "https://sqs.ap-southeast-2.amazonaws.com/754724220380/watchme-sed-queue-v2.fifo"
+DEFER_QUEUE_URL = "https://sqs.ap-southeast-2.amazonaws.com/754724220380/watchme-sed-defer-queue"
+DEFER_QUEUE_ARN = "arn:aws:sqs:ap-southeast-2:754724220380:watchme-sed-defer-queue"
+
+
+class StubSQS:
+    """
+    send_message_batch / change_message_visibility / get_queue_attributes のスタブ
+    """
+
+    def __init__(self):
+        self.batches = []
+        self.visibility = []
+        self.fail_queues = set()
+        self.fail_entries = False
+        self.in_flight = 0
+
+    def send_message_batch(self, QueueUrl, Entries):
+        if QueueUrl in self.fail_queues:
+            raise RuntimeError("stub send failure")
+        if self.fail_entries:
+            return {"Successful": [], "Failed": [{"Id": entry["Id"], "Message": "stub failure"} for entry in Entries]}
+        self.batches.append((QueueUrl, Entries))
+        return {"Successful": [{"Id": entry["Id"], "MessageId": f"stub-{entry['Id']}"} for entry in Entries], "Failed": []}
+
+    def change_message_visibility(self, QueueUrl, ReceiptHandle, VisibilityTimeout):
+        self.visibility.append((ReceiptHandle, VisibilityTimeout))
+
+    def get_queue_attributes(self, QueueUrl, AttributeNames):
+        return {"Attributes": {"ApproximateNumberOfMessages": "0", "ApproximateNumberOfMessagesNotVisible": str(self.in_flight)}}
+
+
+def load_worker():
+    os.environ["STAGE"] = "sed"
+    os.environ["DEFER_QUEUE_URL"] = DEFER_QUEUE_URL
+    os.environ["INTERACTIVE_QUEUE_URL"] = ""
+    os.environ["CONTROLLER_BACKEND"] = "local"
+    os.environ["HEDGE_ENABLED"] = "false"
+    os.environ["API_ENDPOINT_URL"] = "http://127.0.0.1:9/async-process"
+    spec = importlib.util.spec_from_file_location("watchme_sed_worker", WORKER_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def build_record(message_id, group_id, deferrals=0, arn=QUEUE_ARN):
+    body = {
+        "file_path": f"files/defer-test/{message_id}/audio.wav",
+        "device_id": "defer-test",
+        "recorded_at": f"2025-01-01T00:00:{int(message_id[-1]):02d}+00:00",
+    }
+    if deferrals:
+        body["deferrals"] = deferrals
+    return {
+        "messageId": message_id,
+        "receiptHandle": f"receipt-{message_id}",
+        "eventSourceARN": arn,
+        "attributes": {
+            "MessageGroupId": group_id,
+            "MessageDeduplicationId": f"dedup-{message_id}",
+            "ApproximateReceiveCount": "1",
+        },
+        "body": json.dumps(body),
+    }
+
+
+def invoke(worker, records):
+    with contextlib.redirect_stdout(io.StringIO()):
+        response = worker.lambda_handler({"Records": records}, None)
+    return [item["itemIdentifier"] for item in response["batchItemFailures"]]
+
+
+def check(name, ok, detail):
+    print(f"{'OK  ' if ok else 'FAIL'} {name:<52} {detail}")
+    return ok
+
+
+def main():
+    worker = load_worker()
+    sqs = StubSQS()
+    worker.sqs = sqs
+    passed = []
+
+    batch = [build_record("m1", "group-a"), build_record("m2", "group-a"), build_record("m3", "group-b")]
+
+    # Over the watermark: every group run is parked, nothing is handed back
+    worker.admit = lambda stage: False
+    for max_items, path in ((1, "per group"), (10, "batch submission")):
+        worker.STAGE["batch"]["max_items"] = max_items
+        sqs.batches.clear()
+        failures = invoke(worker, batch)
+        parked = [json.loads(entry["MessageBody"]) for _, entries in sqs.batches for entry in entries]
+        delays = [entry["DelaySeconds"] for _, entries in sqs.batches for entry in entries]
+        runs = [[json.loads(message["body"])["file_path"].split("/")[2] for message in run["messages"]] for run in parked]
+        passed.append(check(
+            f"deferred runs are parked ({path})",
+            failures == [] and sorted(runs) == [["m1", "m2"], ["m3"]] and not sqs.visibility
+            and all(0 < delay <= worker.DEFER_MAX_DELAY_SECONDS for delay in delays)
+            and all(queue_url == DEFER_QUEUE_URL for queue_url, _ in sqs.batches),
+            f"{runs}, delays {delays}, failures {failures}",
+        ))
+
+    # The parked run is re-sent to its FIFO queue in order with the deferral counted
+    defer_record = {
+        "messageId": "hold-1",
+        "receiptHandle": "receipt-hold-1",
+        "eventSourceARN": DEFER_QUEUE_ARN,
+        "attributes": {"ApproximateReceiveCount": "1"},
+        "body": sqs.batches[0][1][0]["MessageBody"],
+    }
+    sqs.batches.clear()
+    failures = invoke(worker, [defer_record])
+    queue_url, entries = sqs.batches[0] if sqs.batches else (None, [])
+    bodies = [json.loads(entry["MessageBody"]) for entry in entries]
+    passed.append(check(
+        "parked run is forwarded to the FIFO queue",
+        failures == [] and queue_url == QUEUE_URL
+        and [entry["MessageGroupId"] for entry in entries] == ["group-a", "group-a"]
+        and [body["file_path"].split("/")[2] for body in bodies] == ["m1", "m2"]
+        and all(body["deferrals"] == 1 for body in bodies)
+        and all(not entry["MessageDeduplicationId"].startswith("dedup-") for entry in entries),
+        f"{[entry['MessageGroupId'] for entry in entries]}, deferrals {[body.get('deferrals') for body in bodies]}",
+    ))
+
+    # Backoff grows with the deferral count (not with the receive count)
+    record = build_record("m4", "group-c")
+    base, cap = worker.ADMISSION_BASE_DELAY_SECONDS, worker.ADMISSION_MAX_DELAY_SECONDS
+    first = max(worker.get_backoff_delay(record, {}, base, cap) for _ in range(50))
+    later = min(worker.get_backoff_delay(record, {"deferrals": 3}, base, cap) for _ in range(50))
+    passed.append(check(
+        "admission backoff grows with deferrals",
+        later > first,
+        f"max {first}s at 0 deferrals, min {later}s at 3",
+    ))
+
+    base, cap = worker.BULK_DEFER_SECONDS, worker.BULK_MAX_DEFER_SECONDS
+    capped = max(worker.get_backoff_delay(record, {"deferrals": 50}, base, cap) for _ in range(50))
+    passed.append(check(
+        "bulk backoff is capped",
+        capped <= min(cap, worker.DEFER_MAX_DELAY_SECONDS) + 1,
+        f"max {capped}s at 50 deferrals (cap {cap}s)",
+    ))
+
+    # Bulk lane: deferred only while the interactive queue has messages in flight or waiting
+    worker.INTERACTIVE_QUEUE_URL = QUEUE_URL
+    worker.INTERACTIVE_BACKLOG_CACHE_SECONDS = 0
+    decisions = []
+    for in_flight in (0, 1):
+        sqs.in_flight = in_flight
+        decisions.append(worker.should_defer_bulk_message({"priority_lane": "bulk"}))
+    passed.append(check(
+        "bulk waits for in-flight interactive messages",
+        decisions == [False, True],
+        f"defer at 0 / 1 in flight: {decisions}",
+    ))
+    worker.INTERACTIVE_QUEUE_URL = ""
+
+    # Defer queue unavailable: back to a visibility delay, handed back as before
+    sqs.fail_queues = {DEFER_QUEUE_URL}
+    worker.STAGE["batch"]["max_items"] = 1
+    failures = invoke(worker, batch)
+    passed.append(check(
+        "failed park falls back to a visibility delay",
+        failures == ["m1", "m2", "m3"] and sorted(handle for handle, _ in sqs.visibility) == ["receipt-m1", "receipt-m3"],
+        f"failures {failures}, visibility {[handle for handle, _ in sqs.visibility]}",
+    ))
+    sqs.fail_queues = set()
+    sqs.visibility.clear()
+
+    # Real dispatch failures are not parked: they count as receives
+    worker.admit = lambda stage: True
+
+    def failing_dispatch(stage, message):
+        raise RuntimeError("stub API failure")
+
+    worker.dispatch = failing_dispatch
+    sqs.batches.clear()
+    failures = invoke(worker, batch)
+    passed.append(check(
+        "dispatch failure is handed back, not parked",
+        failures == ["m1", "m2", "m3"] and not sqs.batches and not sqs.visibility,
+        f"failures {failures}",
+    ))
+
+    # Forward failure: the parked run is retried from the defer queue
+    sqs.fail_entries = True
+    failures = invoke(worker, [defer_record])
+    passed.append(check(
+        "failed forward is returned for retry",
+        failures == ["hold-1"],
+        f"failures {failures}",
+    ))
+
+    sys.exit(0 if all(passed) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""
+WatchMe FIFO Group Sharding Simulator
+=====================================
+1台のデバイスに溜まったバックログが、MessageGroupId の戦略（デバイス単位 /
+K分割 / 録音単位）によってどれだけ早く捌けるかをシミュレーションするスクリプト
+
+SQS FIFO は同じ MessageGroupId のメッセージを1件ずつしか配信しないため、
+`{device_id}-asr` のようなデバイス単位のグループでは、コンシューマーに空きがあっても
+同じデバイスの録音は直列に処理される。
+
+グループIDは watchme-audio-processor の get_message_group_id と同じハッシュで割り当てる。
+
+使用方法:
+    python3 simulate_fifo_group_sharding.py [--recordings 144] [--consumers 8]
+        [--mean-sec 40] [--shards 1,2,4,8,16] [--runs 20] [--json]
+
+オプション:
+    --recordings : バックログの録音数（例: 144 = 10分録音 × 24時間）
+    --consumers  : 同時実行できるコンシューマー数（Lambda / APIワーカー）
+    --mean-sec   : 1件あたりの平均処理時間（秒、対数正規分布）
+    --shards     : 比較するシャード数 K（カンマ区切り）
+    --runs       : 乱数シードを変えた試行回数（中央値を表示）
+    --json       : 結果をJSON形式で出力
+"""
+
+import argparse
+import hashlib
+import heapq
+import json
+import math
+import random
+import statistics
+from datetime import datetime, timedelta, timezone
+
+DEVICE_ID = "d067d407-cf73-4174-a9c1-d91fb60d64d0"
+
+
+def get_group(recorded_at, strategy, shards):
+    """
+    watchme-audio-processor の get_message_group_id と同じ割り当て
+    """
+    group_id = f"{DEVICE_ID}-asr"
+    if strategy == "device":
+        return group_id
+
+    digest = hashlib.sha256(f"{DEVICE_ID}-{recorded_at}".encode()).hexdigest()
+    if strategy == "recording":
+        return f"{group_id}-{digest[:16]}"
+    if shards <= 1:
+        return group_id
+    return f"{group_id}-s{int(digest[:8], 16) % shards}"
+
+
+def build_backlog(recordings, mean_sec, rng):
+    """
+    10分間隔の録音と、その処理時間（対数正規分布、平均 mean_sec）
+    """
+    start = datetime(2025, 1, 1, tzinfo=timezone.utc)
+    sigma = 0.5
+    mu = math.log(mean_sec) - sigma ** 2 / 2
+    return [
+        ((start + timedelta(minutes=10 * i)).isoformat(), rng.lognormvariate(mu, sigma))
+        for i in range(recordings)
+    ]
+
+
+def simulate(backlog, consumers, strategy, shards):
+    """
+    FIFO の配信規則で全件を処理し終えるまでの時間（秒）を返す
+    - 同じグループは同時に1件まで（先頭のメッセージのみ配信可能）
+    - 空いているコンシューマーは、配信可能なグループのうち最も古いメッセージを受け取る
+    """
+    queues = {}
+    for position, (recorded_at, duration) in enumerate(backlog):
+        queues.setdefault(get_group(recorded_at, strategy, shards), []).append((position, duration))
+
+    heads = {group: 0 for group in queues}
+    in_flight = []  # (finish_time, group)
+    busy_groups = set()
+    now = 0.0
+    remaining = len(backlog)
+
+    while remaining:
+        # 空きコンシューマーに配信可能なメッセージを割り当てる
+        while len(in_flight) < consumers:
+            available = [
+                (queues[group][heads[group]][0], group)
+                for group in queues
+                if group not in busy_groups and heads[group] < len(queues[group])
+            ]
+            if not available:
+                break
+            _, group = min(available)
+            _, duration = queues[group][heads[group]]
+            heads[group] += 1
+            busy_groups.add(group)
+            heapq.heappush(in_flight, (now + duration, group))
+
+        now, group = heapq.heappop(in_flight)
+        busy_groups.discard(group)
+        remaining -= 1
+
+    return now
+
+
+def main():
+    parser = argparse.ArgumentParser(description="FIFO MessageGroupId sharding simulator")
+    parser.add_argument("--recordings", type=int, default=144)
+    parser.add_argument("--consumers", type=int, default=8)
+    parser.add_argument("--mean-sec", type=float, default=40.0)
+    parser.add_argument("--shards", default="1,2,4,8,16")
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args()
+
+    strategies = [("device", 1)]
+    strategies += [("sharded", int(k)) for k in args.shards.split(",") if int(k) > 1]
+    strategies.append(("recording", 0))
+
+    results = []
+    for strategy, shards in strategies:
+        drains = []
+        for run in range(args.runs):
+            backlog = build_backlog(args.recordings, args.mean_sec, random.Random(run))
+            drains.append(simulate(backlog, args.consumers, strategy, shards))
+        results.append({
+            "strategy": strategy,
+            "shards": shards or None,
+            "groups": len({get_group(r, strategy, shards) for r, _ in backlog}),
+            "drain_sec_median": round(statistics.median(drains), 1),
+        })
+
+    baseline = results[0]["drain_sec_median"]
+    for result in results:
+        result["speedup"] = round(baseline / result["drain_sec_median"], 2)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(
+        f"録音 {args.recordings} 件 / コンシューマー {args.consumers} / "
+        f"平均処理時間 {args.mean_sec:.0f}秒 / 試行 {args.runs} 回（中央値）"
+    )
+    print(f"{'strategy':<10} {'K':>4} {'groups':>7} {'drain(min)':>11} {'speedup':>8}")
+    for result in results:
+        print(
+            f"{result['strategy']:<10} {result['shards'] or '-':>4} {result['groups']:>7} "
+            f"{result['drain_sec_median'] / 60:>11.1f} {result['speedup']:>7.2f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()